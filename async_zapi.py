@@ -0,0 +1,294 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Non-blocking ZAPI sessions for the asyncio handoff service.
+# AsyncZapiServer sends the same requests as zapi_pool.PooledNaServer, over
+# keep-alive HTTP(S) connections driven by the asyncio event loop, so that
+# one thread can wait on the calls of many operations at a time.
+# Requests are encoded and responses decoded by zapi_pool, the results
+# are the same NaElement trees as NaServer returns.
+#
+# Requires Python 3.5 or newer (async/await).
+###############################################################################
+import ssl
+import time
+import base64
+import asyncio
+import http.client
+
+# Request encoding and response decoding shared with the threaded pool
+import zapi_pool
+
+# Timing of the ZAPI calls
+import metrics
+
+_pools = {}
+
+
+class AsyncZapiConnectionPool(object):
+    '''
+    Pool of keep-alive HTTP(S) connections to one storage array, for
+    the coroutines of one event loop.
+
+    At most max_size requests are in flight at a time, the others wait
+    for a connection. Idle connections are closed after idle_timeout
+    seconds, and are checked before reuse.
+    '''
+
+    def __init__(self, host, port, transport, user, pwd,
+                 max_size, idle_timeout):
+        self.host_ = host
+        self.port_ = port
+        self.transport_ = transport
+        self.idle_timeout_ = idle_timeout
+        self.auth_ = base64.b64encode(('%s:%s' % (user, pwd)).encode('utf-8'))
+        self.slots_ = asyncio.Semaphore(max_size)
+        # Idle connections as (reader, writer, time returned to the pool)
+        self.idle_ = []
+
+    async def new_connection(self):
+        context = None
+        if self.transport_.upper() == 'HTTPS':
+            # Filers usually have self-signed certificates,
+            # NaServer does not verify them either
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.verify_mode = ssl.CERT_NONE
+        return await asyncio.open_connection(self.host_, self.port_,
+                                             ssl=context)
+
+    def take_idle(self):
+        '''
+        Returns an idle connection that is still open, or None
+        '''
+        now = time.time()
+        while self.idle_:
+            reader, writer, t = self.idle_.pop()
+            if (now - t <= self.idle_timeout_ and not reader.at_eof() and
+                not writer.transport.is_closing()):
+                return reader, writer
+            writer.close()
+        return None
+
+    def encode_headers(self, body):
+        return ('POST %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Content-type: text/xml; charset="UTF-8"\r\n'
+                'Content-length: %d\r\n'
+                'Authorization: Basic %s\r\n'
+                'Connection: keep-alive\r\n\r\n' %
+                (zapi_pool.FILER_URL, self.host_, len(body),
+                 self.auth_.decode('ascii'))).encode('latin-1')
+
+    async def read_response(self, reader):
+        '''
+        Returns (status, reason, body, will_close) of an HTTP response
+
+        Raises zapi_pool.StaleConnection if the connection was closed
+        before any byte of the response
+        '''
+        line = await reader.readline()
+        if not line:
+            raise zapi_pool.StaleConnection('connection closed')
+        parts = line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise http.client.BadStatusLine(line)
+        status = int(parts[1])
+        reason = len(parts) > 2 and parts[2].strip() or ''
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        will_close = (connection == 'close' or
+                      (parts[0] == 'HTTP/1.0' and connection != 'keep-alive'))
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    # Skip the trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                            b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            will_close = True
+        return status, reason, body, will_close
+
+    async def send(self, reader, writer, body):
+        '''
+        Sends the request and returns the response, see read_response
+
+        Raises zapi_pool.StaleConnection if the connection failed before
+        the array answered anything, the array then has not run the
+        request
+        '''
+        try:
+            writer.write(self.encode_headers(body) + body)
+            await writer.drain()
+        except OSError as e:
+            raise zapi_pool.StaleConnection(str(e))
+        return await self.read_response(reader)
+
+    async def post(self, body):
+        '''
+        Sends a ZAPI request and returns the response body
+
+        body : encoded ZAPI request
+
+        A request that fails on a reused connection before the array
+        answered (see send) is sent once more on a new connection, the
+        array may have closed the idle connection meanwhile. Requests
+        are never sent again once the response started, ZAPI calls like
+        volume-clone-create are not idempotent.
+        '''
+        async with self.slots_:
+            conn = self.take_idle()
+            reused = conn is not None
+            if conn is None:
+                conn = await self.new_connection()
+            reader, writer = conn
+            try:
+                try:
+                    status, reason, data, will_close = \
+                        await self.send(reader, writer, body)
+                except zapi_pool.StaleConnection:
+                    if not reused:
+                        raise
+                    writer.close()
+                    reader, writer = await self.new_connection()
+                    status, reason, data, will_close = \
+                        await self.send(reader, writer, body)
+            except (http.client.HTTPException, OSError, ValueError,
+                    asyncio.IncompleteReadError):
+                writer.close()
+                raise
+            if will_close:
+                writer.close()
+            else:
+                self.idle_.append((reader, writer, time.time()))
+            if status == 401:
+                raise http.client.HTTPException("Authorization failed")
+            if status != 200:
+                raise http.client.HTTPException("Server returned HTTP %d %s"
+                                                % (status, reason))
+            return data
+
+    def close(self):
+        idle, self.idle_ = self.idle_, []
+        for reader, writer, t in idle:
+            writer.close()
+
+
+def get_pool(host, port, transport, user, pwd):
+    '''
+    Returns the connection pool for the storage array, creating it
+    on first use with the zapi_pool settings (see zapi_pool.configure)
+
+    host : Netapp hostname/ip address
+    port : ZAPI port
+    transport : HTTP/HTTPS
+    user, pwd : login credentials
+
+    Must be called from the event loop.
+    '''
+    key = (host, port, transport, user, pwd)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = AsyncZapiConnectionPool(host, port, transport, user, pwd,
+                                       zapi_pool.POOL_SIZE,
+                                       zapi_pool.IDLE_TIMEOUT)
+        _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    '''
+    Closes all the pooled connections
+    '''
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
+
+
+class AsyncZapiServer(object):
+    '''
+    Coroutine version of PooledNaServer.invoke_elem
+
+    server : a configured zapi_pool.PooledNaServer, the async server
+             talks to the same array with the same settings
+    '''
+
+    def __init__(self, server):
+        (self.host_, self.port_, self.transport_, self.user_, self.pwd_,
+         self.version_) = server.connection_info()
+
+    def array_name(self):
+        return self.host_
+
+    def pool(self):
+        return get_pool(self.host_, self.port_, self.transport_,
+                        self.user_, self.pwd_)
+
+    async def invoke_elem(self, req, **tags):
+        '''
+        Sends the request and returns the results element,
+        the call is timed in a zapi span (see metrics)
+
+        tags : tags of the span, the metrics context of the calling
+               thread is shared by all the coroutines
+        '''
+        with metrics.span('zapi', api=req.get_name(), array=self.host_,
+                          **tags) as record:
+            try:
+                data = await self.pool().post(
+                    zapi_pool.encode_request(self.version_, req))
+            except (http.client.HTTPException, OSError, ValueError,
+                    asyncio.IncompleteReadError) as e:
+                results = zapi_pool.fail_response(13001, str(e))
+            else:
+                results = zapi_pool.parse_response(data)
+            if results.results_status() == 'failed':
+                record['status'] = 'failed'
+            return results
+
+    async def invoke_elems(self, reqs, **tags):
+        '''
+        Sends independent requests at the same time and returns their
+        results elements, in the order of the requests
+        '''
+        return list(await asyncio.gather(*[self.invoke_elem(req, **tags)
+                                           for req in reqs]))
@@ -0,0 +1,176 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Parallel proxy backups.
+# BackupScheduler runs the proxy backups of independent luns on a bounded
+# pool of threads, backups of the same lun run one after another.
+# The clone steps of a backup hold a slot of the storage array and the
+# mount steps a slot of the ESX proxy host, which bounds the load put on
+# each of them whatever the number of threads.
+###############################################################################
+import threading
+import traceback
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Backups are tagged with the operation that submitted them
+import metrics
+
+# Defaults, see configure()
+WORKERS = 8
+ARRAY_LIMIT = 4
+HOST_LIMIT = 2
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def configure(workers=None, array_limit=None, host_limit=None):
+    '''
+    Sets the concurrency limits
+
+    workers : number of proxy backups run at the same time
+    array_limit : clone steps run at the same time on a storage array
+    host_limit : mount steps run at the same time on an ESX proxy host
+    '''
+    global WORKERS, ARRAY_LIMIT, HOST_LIMIT
+    if workers is not None:
+        WORKERS = max(1, workers)
+    if array_limit is not None:
+        ARRAY_LIMIT = max(1, array_limit)
+    if host_limit is not None:
+        HOST_LIMIT = max(1, host_limit)
+
+
+def get_slots(kind, name, limit):
+    '''
+    Returns the semaphore bounding the steps run on one array or host
+
+    The semaphore is keyed on the limit too, the steps started after
+    configure() changed it get a semaphore of the new limit.
+    '''
+    key = (kind, name, limit)
+    with _slots_lock:
+        slots = _slots.get(key)
+        if slots is None:
+            slots = threading.BoundedSemaphore(limit)
+            _slots[key] = slots
+    return slots
+
+
+@contextlib.contextmanager
+def array_slot(storage_array):
+    '''
+    Holds one of the ARRAY_LIMIT slots of the storage array
+    '''
+    with get_slots('array', storage_array, ARRAY_LIMIT):
+        yield
+
+
+@contextlib.contextmanager
+def host_slot(proxy_host):
+    '''
+    Holds one of the HOST_LIMIT slots of the ESX proxy host
+    '''
+    with get_slots('host', proxy_host, HOST_LIMIT):
+        yield
+
+
+class BackupScheduler(object):
+    '''
+    Runs proxy backups on a pool of threads.
+
+    Backups are submitted with the lun they back up. Backups of different
+    luns run in parallel, backups of the same lun run in submission order.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers_ = workers or WORKERS
+        self.executor_ = ThreadPoolExecutor(max_workers=self.workers_)
+        self.cond_ = threading.Condition()
+        # Backups waiting for the running backup of their lun
+        self.pending_ = {}
+        # Backups submitted and not finished yet
+        self.count_ = 0
+
+    def submit(self, lun, fn, *args):
+        '''
+        Runs fn(*args) on the pool
+
+        lun : the lun backed up by fn
+
+        fn runs with the metrics tags of the caller, e.g. its operation
+        '''
+        tags = metrics.current_tags()
+        with self.cond_:
+            self.count_ += 1
+            queue = self.pending_.get(lun)
+            if queue is not None:
+                queue.append((fn, args, tags))
+                return
+            self.pending_[lun] = collections.deque()
+        self.executor_.submit(self.run, lun, fn, args, tags)
+
+    def run(self, lun, fn, args, tags):
+        while True:
+            try:
+                with metrics.context(**tags):
+                    fn(*args)
+            except SystemExit:
+                # The proxy backup steps exit on errors, after logging them
+                pass
+            except Exception:
+                traceback.print_exc()
+
+            with self.cond_:
+                self.count_ -= 1
+                self.cond_.notify_all()
+                queue = self.pending_[lun]
+                if not queue:
+                    del self.pending_[lun]
+                    return
+                fn, args, tags = queue.popleft()
+
+    def wait_for_worker(self):
+        '''
+        Waits until fewer backups than workers are submitted,
+        so that callers do not hold backups the pool cannot start yet
+        '''
+        with self.cond_:
+            while self.count_ >= self.workers_:
+                self.cond_.wait()
+
+    def wait(self):
+        '''
+        Waits for all the submitted backups to finish
+        '''
+        with self.cond_:
+            while self.count_:
+                self.cond_.wait()
+
+    def shutdown(self):
+        self.wait()
+        self.executor_.shutdown()
@@ -0,0 +1,327 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Background proxy backup worker.
+# When the handoff scripts run with --async-backup, CREATE_SNAP only queues
+# the proxy backup of the snapshot in the script db and starts this worker.
+# The worker runs the queued backups until the queue is empty, backups of
+# different luns run in parallel (see backup_scheduler). Only one worker
+# runs at a time for a WORK_DIR.
+# After the backups, the worker destroys the clones replaced by them
+# (see collect_retired_clones in the handoff scripts).
+#
+# Run with --status to show the state of the most recent backup jobs.
+###############################################################################
+import optparse
+import sys
+import time
+import importlib
+import threading
+import traceback
+
+# Script DB is used to store/load the cloned lun
+# information and the credentials
+import script_db
+
+# Credentials are decrypted once and shared by the whole process
+import cred_provider
+
+# Only one worker drains the queue at a time
+from file_lock import FileLock
+
+# Parallel proxy backups
+import backup_scheduler
+
+# One VADP script run for the luns mounted at the same time
+import vadp_batch
+
+# In-process VADP operations when pyVmomi is installed
+import vadp_client
+
+# Timing of the backup steps
+import metrics
+
+WORK_DIR =  r'C:\rvbd_handoff_scripts'
+DEFAULT_SCRIPT = 'netapp_c_mode_handoff_script'
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+class BackupWorker(object):
+    '''
+    Runs the proxy backups queued in the script db.
+
+    module : the handoff script module, it must provide set_script_path,
+             connect_array and run_proxy_backup, and may provide
+             collect_retired_clones
+    work_dir : WORK_DIR of the handoff scripts
+    '''
+
+    def __init__(self, module, work_dir):
+        self.module_ = module
+        self.work_dir_ = work_dir
+        self.conns_ = {}
+        self.lock_ = threading.Lock()
+
+    def get_conn(self, cdb, storage_array):
+        with self.lock_:
+            conn = self.conns_.get(storage_array)
+            if conn is None:
+                conn = self.module_.connect_array(cdb, storage_array)
+                self.conns_[storage_array] = conn
+        return conn
+
+    def run_job(self, job):
+        '''
+        Runs one backup job on a scheduler thread and records its result
+
+        sqlite connections cannot be shared between threads, each job
+        uses its own script db connection. Credentials come from the
+        provider shared by the process.
+        '''
+        cdb = cred_provider.get_provider(self.work_dir_ + r'\cred_db')
+        sdb = script_db.ScriptDB(self.work_dir_ + r'\script_db')
+        try:
+            self.run_backup(cdb, sdb, job)
+        finally:
+            sdb.close()
+            cdb.close()
+
+    def run_backup(self, cdb, sdb, job):
+        '''
+        Runs one backup job and records its result
+        '''
+        job_id, lun, snap_name, access_group, proxy_host, array = job
+        script_log("%s: running backup job %d for lun %s snapshot %s\n" %
+                   (time.ctime(), job_id, lun, snap_name))
+        state = script_db.JOB_FAILED
+        error = ''
+        try:
+            conn = self.get_conn(cdb, array)
+            with metrics.context(operation='PROXY_BACKUP', array=array):
+                if self.module_.run_proxy_backup(cdb, sdb, conn, lun,
+                                                 snap_name, access_group,
+                                                 proxy_host):
+                    state = script_db.JOB_DONE
+                else:
+                    error = 'Failed to mount the cloned lun'
+        except SystemExit:
+            # The proxy backup steps exit on errors, the details
+            # were logged by the step itself
+            error = 'Proxy backup aborted, see the worker log'
+        except Exception as e:
+            traceback.print_exc()
+            error = str(e)
+
+        sdb.finish_backup_job(job_id, state, error)
+        script_log("\n%s: backup job %d %s %s\n" %
+                   (time.ctime(), job_id, state, error))
+
+    def run_jobs(self, sdb):
+        '''
+        Runs the queued jobs until the queue is empty
+        '''
+        scheduler = backup_scheduler.BackupScheduler()
+        try:
+            # We hold the worker lock, so jobs still marked as
+            # running were left by a worker that died
+            sdb.requeue_backup_jobs()
+            while True:
+                # Only claim a job when it can start, jobs left in the
+                # queue can still be superseded by newer snapshots
+                scheduler.wait_for_worker()
+                job = sdb.claim_backup_job()
+                if not job:
+                    break
+                scheduler.submit(job[1], self.run_job, job)
+        finally:
+            scheduler.shutdown()
+
+    def collect_clones(self, sdb):
+        '''
+        Destroys the clones retired by the backups, on each array
+        '''
+        cdb = cred_provider.get_provider(self.work_dir_ + r'\cred_db')
+        try:
+            for array in sdb.get_retired_arrays():
+                try:
+                    conn = self.get_conn(cdb, array)
+                    with metrics.context(operation='CLONE_GC', array=array):
+                        left = self.module_.collect_retired_clones(sdb, conn)
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                if left:
+                    script_log("\n%s: %d retired clones left on %s\n" %
+                               (time.ctime(), left, array))
+        finally:
+            cdb.close()
+
+    def drain(self):
+        '''
+        Runs the queued jobs until the queue is empty, then destroys
+        the retired clones.
+
+        Returns without running anything if another worker is
+        already draining the queue.
+        '''
+        lock = FileLock(self.work_dir_ + r'\backup_worker.lock')
+        while lock.acquire(blocking=False):
+            self.module_.set_script_path(self.work_dir_)
+            sdb = script_db.ScriptDB(self.work_dir_ + r'\script_db')
+            try:
+                sdb.setup()
+                self.run_jobs(sdb)
+                collected = time.time()
+                if hasattr(self.module_, 'collect_retired_clones'):
+                    self.collect_clones(sdb)
+            finally:
+                lock.release()
+
+            # A job queued or a clone retired after we looked for them but
+            # before we released the lock would have been left behind by
+            # its producer. Clones we failed to destroy wait for the next run.
+            queued = sdb.count_backup_jobs(script_db.JOB_QUEUED) + \
+                     sdb.count_retired_clones(collected)
+            sdb.close()
+            if not queued:
+                break
+
+
+def print_status(work_dir, serial, limit):
+    '''
+    Prints the most recent backup jobs
+
+    work_dir : WORK_DIR of the handoff scripts
+    serial : only show the jobs of this lun, if set
+    limit : number of jobs to show
+    '''
+    sdb = script_db.ScriptDB(work_dir + r'\script_db')
+    sdb.setup()
+    for job in sdb.get_backup_jobs(serial, limit):
+        job_id, lun, snap_name, proxy_host, state, error, created, updated = job
+        print ("%d %s %s %s %s queued: %s updated: %s %s" %
+               (job_id, lun, snap_name, proxy_host, state,
+                time.ctime(created), time.ctime(updated), error or ''))
+    sdb.close()
+
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option("--work-dir",
+                      type="string",
+                      default=WORK_DIR,
+                      help="Directory path to the handoff scripts")
+    parser.add_option("--script",
+                      type="string",
+                      default=DEFAULT_SCRIPT,
+                      help="Handoff script module running the backups")
+    parser.add_option("--backup-workers",
+                      type="int",
+                      default=backup_scheduler.WORKERS,
+                      help="Number of proxy backups run in parallel")
+    parser.add_option("--array-limit",
+                      type="int",
+                      default=backup_scheduler.ARRAY_LIMIT,
+                      help="Clones created in parallel on the storage array")
+    parser.add_option("--host-limit",
+                      type="int",
+                      default=backup_scheduler.HOST_LIMIT,
+                      help="Clones mounted in parallel on a proxy host")
+    parser.add_option("--vadp-batch-window",
+                      type="float",
+                      default=vadp_batch.BACKUP_WINDOW,
+                      help="Seconds a mount waits for other clones to mount"
+                           " with it, 0 disables batching")
+    parser.add_option("--no-metrics",
+                      dest="metrics",
+                      action="store_false",
+                      default=True,
+                      help="Do not record the timing of the backup steps")
+    parser.add_option("--vadp-engine",
+                      type="choice",
+                      choices=['auto', 'python', 'perl'],
+                      default=vadp_client.ENGINE,
+                      help="Run the VADP operations in process (python) or"
+                           " with the Perl scripts")
+    parser.add_option("--vadp-discovery-timeout",
+                      type="int",
+                      default=vadp_client.DISCOVERY_DEADLINE,
+                      help="Seconds allowed for a cloned lun and its"
+                           " datastore to show up on the proxy host")
+    parser.add_option("--array-transport",
+                      type="choice",
+                      choices=['HTTPS', 'HTTP'],
+                      default='HTTPS',
+                      help="Transport used for the ZAPI calls to the array")
+    parser.add_option("--array-port",
+                      type="int",
+                      default=443,
+                      help="Port of the ZAPI server of the array")
+    parser.add_option("--status",
+                      action="store_true",
+                      default=False,
+                      help="Show the backup jobs instead of running them")
+    parser.add_option("--serial",
+                      type="string",
+                      default="",
+                      help="Show the backup jobs of this lun only")
+    parser.add_option("--limit",
+                      type="int",
+                      default=20,
+                      help="Number of backup jobs to show")
+    return parser
+
+
+if __name__ == '__main__':
+    options, argsleft = get_option_parser().parse_args()
+
+    if options.status:
+        print_status(options.work_dir, options.serial, options.limit)
+        sys.exit(0)
+
+    backup_scheduler.configure(options.backup_workers, options.array_limit,
+                               options.host_limit)
+    vadp_batch.configure(options.vadp_batch_window)
+    vadp_client.configure(options.vadp_engine, options.work_dir,
+                          options.vadp_discovery_timeout)
+    metrics.configure(options.work_dir, options.metrics)
+
+    # Handoff scripts are imported from the work dir
+    sys.path.insert(0, options.work_dir)
+    module = importlib.import_module(options.script)
+    if hasattr(module, 'configure_array'):
+        module.configure_array(options.array_transport, options.array_port)
+    BackupWorker(module, options.work_dir).drain()
@@ -0,0 +1,118 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Encryption of the passwords stored in the credentials db.
+# On Windows the passwords are encrypted with DPAPI for the local machine,
+# so that any account running the handoff scripts on this machine can
+# decrypt them, but a copy of the db cannot be read on another machine.
+# Elsewhere the passwords are stored as they are.
+###############################################################################
+import base64
+
+try:
+    import ctypes
+    from ctypes import wintypes
+    _crypt32 = ctypes.windll.crypt32
+    _kernel32 = ctypes.windll.kernel32
+except (ImportError, AttributeError):
+    _crypt32 = None
+
+# Prefix of the encrypted values, values without it are plain text
+DPAPI_PREFIX = 'dpapi:'
+
+CRYPTPROTECT_UI_FORBIDDEN = 0x1
+CRYPTPROTECT_LOCAL_MACHINE = 0x4
+
+
+def is_available():
+    '''
+    Returns True if passwords can be encrypted on this machine
+    '''
+    return _crypt32 is not None
+
+
+if _crypt32 is not None:
+    class DATA_BLOB(ctypes.Structure):
+        _fields_ = [('cbData', wintypes.DWORD),
+                    ('pbData', ctypes.POINTER(ctypes.c_char))]
+
+    def _to_blob(data):
+        buf = ctypes.create_string_buffer(data, len(data))
+        blob = DATA_BLOB(len(data), ctypes.cast(buf, ctypes.POINTER(ctypes.c_char)))
+        # The buffer must outlive the blob
+        return blob, buf
+
+    def _from_blob(blob):
+        try:
+            return ctypes.string_at(blob.pbData, blob.cbData)
+        finally:
+            _kernel32.LocalFree(blob.pbData)
+
+    def _dpapi(func, data):
+        in_blob, buf = _to_blob(data)
+        out_blob = DATA_BLOB()
+        flags = CRYPTPROTECT_UI_FORBIDDEN | CRYPTPROTECT_LOCAL_MACHINE
+        if func == 'protect':
+            ok = _crypt32.CryptProtectData(ctypes.byref(in_blob), None, None,
+                                           None, None, flags,
+                                           ctypes.byref(out_blob))
+        else:
+            ok = _crypt32.CryptUnprotectData(ctypes.byref(in_blob), None, None,
+                                             None, None, flags,
+                                             ctypes.byref(out_blob))
+        if not ok:
+            raise ValueError('DPAPI %s failed: %s' %
+                             (func, ctypes.FormatError()))
+        return _from_blob(out_blob)
+
+
+def protect(value):
+    '''
+    Returns the value to store for a password, encrypted if possible
+    '''
+    if _crypt32 is None or not value:
+        return value
+    data = _dpapi('protect', value.encode('utf-8'))
+    return DPAPI_PREFIX + base64.b64encode(data).decode('ascii')
+
+
+def unprotect(value):
+    '''
+    Returns the password of a stored value
+
+    Raises ValueError if the value is encrypted and cannot
+    be decrypted on this machine
+    '''
+    if not value or not value.startswith(DPAPI_PREFIX):
+        return value
+    if _crypt32 is None:
+        raise ValueError('Password was encrypted with DPAPI, '
+                         'it can only be read on Windows')
+    data = base64.b64decode(value[len(DPAPI_PREFIX):].encode('ascii'))
+    return _dpapi('unprotect', data).decode('utf-8')
+
+
+def is_protected(value):
+    return bool(value) and value.startswith(DPAPI_PREFIX)
@@ -22,17 +22,169 @@
 #
 ###############################################################################
 
+###############################################################################
+# Credentials database management.
+# Run without arguments for the interactive menu. The options manage the
+# database from automation, credentials are imported from and exported to
+# CSV (host,user,password columns) or JSON (list of objects with the host,
+# user and password keys) files.
+#
+# Ex.
+# cred_mgmt.py --import creds.csv --dry-run
+# cred_mgmt.py --import creds.json --replace
+# cred_mgmt.py --export creds.csv
+###############################################################################
+
 # Script DB is used to store/load the cloned lun
 # information and the credentials
 import script_db
 import sys
+import os
+import csv
+import json
+import optparse
+import sqlite3
+
+# Passwords are encrypted at rest when possible
+import cred_crypt
 
 DB_NAME = 'cred_db'
 
-if __name__ == '__main__':
-    # Create DB
-    db = script_db.CredDB('cred_db')
+FIELDS = ('host', 'user', 'password')
+
+
+def get_format(path, fmt):
+    '''
+    Returns the format of a credentials file, csv or json
+
+    path : the file path
+    fmt : the format given on the command line, if any
+    '''
+    if fmt:
+        return fmt
+    if os.path.splitext(path)[1].lower() == '.json':
+        return 'json'
+    return 'csv'
+
+
+def read_entries(path, fmt):
+    '''
+    Returns the (host, user, password) entries of a credentials file
+
+    path : the file path, - for stdin
+    fmt : csv or json
+    '''
+    f = sys.stdin if path == '-' else open(path, newline='')
+    try:
+        if fmt == 'json':
+            records = json.load(f)
+        else:
+            records = list(csv.DictReader(f))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    entries = []
+    hosts = set()
+    for num, record in enumerate(records, 1):
+        try:
+            values = [record[field] for field in FIELDS]
+        except (KeyError, TypeError):
+            raise ValueError('Entry %d: host, user and password are required'
+                             % num)
+        if not all(value is None or isinstance(value, str)
+                   for value in values):
+            raise ValueError('Entry %d: host, user and password must be'
+                             ' strings' % num)
+        host, user, pwd = [(value or '').strip() for value in values]
+        if not host:
+            raise ValueError('Entry %d: empty host' % num)
+        if host in hosts:
+            raise ValueError('Entry %d: duplicate host %s' % (num, host))
+        hosts.add(host)
+        entries.append((host, user, pwd))
+    return entries
+
+
+def write_entries(path, fmt, entries):
+    '''
+    Writes credentials to a file, the passwords are NOT encrypted
+
+    path : the file path, - for stdout
+    fmt : csv or json
+    entries : list of (host, user, password)
+    '''
+    f = sys.stdout if path == '-' else open(path, 'w', newline='')
+    try:
+        records = [dict(zip(FIELDS, entry)) for entry in entries]
+        if fmt == 'json':
+            json.dump(records, f, indent=2, sort_keys=True)
+            f.write('\n')
+        else:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
 
+def diff_entries(current, entries, replace):
+    '''
+    Returns the changes an import makes, list of (change, host, detail)
+    with change one of + (added), ~ (modified) and - (removed)
+
+    current : the (host, user, password) in the database
+    entries : the (host, user, password) imported
+    replace : the hosts that are not imported are removed
+    '''
+    existing = dict((host, (user, pwd)) for host, user, pwd in current)
+    changes = []
+    for host, user, pwd in entries:
+        if host not in existing:
+            changes.append(('+', host, 'user %s' % user))
+            continue
+        old_user, old_pwd = existing.pop(host)
+        fields = []
+        if user != old_user:
+            fields.append('user %s -> %s' % (old_user, user))
+        if pwd != old_pwd:
+            fields.append('password')
+        if fields:
+            changes.append(('~', host, ', '.join(fields)))
+    if replace:
+        for host in sorted(existing):
+            changes.append(('-', host, ''))
+    return changes
+
+
+def import_entries(db, path, fmt, replace, dry_run):
+    '''
+    Imports a credentials file, prints the changes
+
+    Returns the number of changes
+    '''
+    entries = read_entries(path, fmt)
+    changes = diff_entries(db.get_all_enc_info(), entries, replace)
+    for change, host, detail in changes:
+        print ('%s %s %s' % (change, host, detail))
+
+    if dry_run:
+        print ('%d changes, dry run: nothing written' % len(changes))
+    elif changes:
+        # Unchanged hosts are written again, this keeps the
+        # import one transaction with a fixed set of statements
+        db.insert_many_enc_info(entries, replace)
+        print ('%d changes written' % len(changes))
+    else:
+        print ('No changes')
+    return len(changes)
+
+
+def run_menu(db):
+    '''
+    Interactive credentials management
+    '''
     done = False
     while not done:
         # Get the operation type
@@ -40,7 +192,8 @@ if __name__ == '__main__':
                         '2 - Add/Modify Host\n'\
                         '3 - Delete Host\n'\
                         '4 - Show all passwords\n'\
-                        '5 - Exit\nEnter Operation: ').strip()
+                        '5 - Encrypt stored passwords\n'\
+                        '6 - Exit\nEnter Operation: ').strip()
         op = 0
         try:
             op = int(op_str)
@@ -70,10 +223,110 @@ if __name__ == '__main__':
                 print('\nHost: %s User: %s Password: %s' % (host, user, pwd))
 
         elif op == 5:
+            # Encrypts the passwords stored before encryption was available
+            if not cred_crypt.is_available():
+                print ('Password encryption is not available on this machine')
+            else:
+                print ('%d passwords encrypted' % db.protect_all())
+
+        elif op == 6:
             # Exits the program
             print ('Good Bye!')
             sys.exit(0)
         else:
             print ('Invalid operation, retry\n')
-        
 
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option("--db",
+                      type="string",
+                      default=DB_NAME,
+                      help="Path of the credentials database")
+    parser.add_option("--setup",
+                      action="store_true",
+                      default=False,
+                      help="Setup a new database, existing entries are lost")
+    parser.add_option("--import",
+                      dest="import_file",
+                      type="string",
+                      default="",
+                      help="Add/modify the hosts of a CSV or JSON file,"
+                           " - for stdin")
+    parser.add_option("--export",
+                      dest="export_file",
+                      type="string",
+                      default="",
+                      help="Write all the hosts to a CSV or JSON file,"
+                           " - for stdout. Passwords are NOT encrypted")
+    parser.add_option("--format",
+                      type="choice",
+                      choices=['csv', 'json'],
+                      default=None,
+                      help="csv or json, by default from the file extension")
+    parser.add_option("--replace",
+                      action="store_true",
+                      default=False,
+                      help="Delete the hosts that are not in the imported file")
+    parser.add_option("--dry-run",
+                      action="store_true",
+                      default=False,
+                      help="Show the changes of the import without writing them")
+    parser.add_option("--delete",
+                      type="string",
+                      action="append",
+                      default=[],
+                      help="Delete a host, can be repeated")
+    parser.add_option("--encrypt",
+                      action="store_true",
+                      default=False,
+                      help="Encrypt the passwords stored in plain text")
+    return parser
+
+
+def main(argv):
+    options, argsleft = get_option_parser().parse_args(argv)
+
+    if not (options.setup or options.import_file or options.export_file or
+            options.delete or options.encrypt):
+        run_menu(script_db.CredDB(options.db))
+        return 0
+
+    # sqlite would create an empty db without the tables
+    if not options.setup and not os.path.exists(options.db):
+        sys.stderr.write('Credentials db %s does not exist, create it with'
+                         ' --setup\n' % options.db)
+        return 1
+
+    db = script_db.CredDB(options.db)
+
+    try:
+        if options.setup and not options.dry_run:
+            db.setup()
+        if options.import_file:
+            import_entries(db, options.import_file,
+                           get_format(options.import_file, options.format),
+                           options.replace, options.dry_run)
+        for host in options.delete:
+            print ('- %s' % host)
+            if not options.dry_run:
+                db.delete_enc_info(host)
+        if options.encrypt and not options.dry_run:
+            print ('%d passwords encrypted' % db.protect_all())
+        if options.export_file:
+            write_entries(options.export_file,
+                          get_format(options.export_file, options.format),
+                          db.get_all_enc_info())
+    except (OSError, ValueError, csv.Error, sqlite3.Error) as e:
+        sys.stderr.write('%s\n' % str(e))
+        return 1
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
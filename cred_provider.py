@@ -0,0 +1,163 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+
+###############################################################################
+# Credentials provider.
+# The credentials db is read and its passwords decrypted once per process,
+# the handoff daemon and the backup worker threads share the same in-memory
+# map. The map is loaded again when cred_mgmt changes the db file.
+# The provider can be used instead of script_db.CredDB for lookups.
+###############################################################################
+import os
+import sys
+import sqlite3
+import threading
+import time
+
+# Timeout of the credentials db
+import script_db
+
+# Passwords are encrypted at rest when possible
+import cred_crypt
+
+# Seconds between checks of the credentials db file for changes
+CHECK_INTERVAL = 1.0
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+class CredentialProvider(object):
+    '''
+    Read-only in-memory view of a credentials db.
+
+    path : path of the credentials db
+    '''
+
+    def __init__(self, path):
+        self.path_ = path
+        self.lock_ = threading.Lock()
+        self.creds_ = None
+        self.stamp_ = None
+        self.checked_ = 0
+
+    def __repr__(self):
+        # Never show the passwords
+        return '<CredentialProvider %s>' % self.path_
+
+    def file_stamp(self):
+        try:
+            st = os.stat(self.path_)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def load(self):
+        '''
+        Reads all the credentials, returns a host -> (user, password) map
+        '''
+        creds = {}
+        # sqlite would create an empty db in its place
+        if not os.path.exists(self.path_):
+            script_log("Credentials db %s does not exist, add the credentials"
+                       " with cred_mgmt.py\n" % self.path_)
+            return creds
+
+        conn = sqlite3.connect(self.path_, timeout=script_db.BUSY_TIMEOUT)
+        try:
+            rows = conn.execute("SELECT host, user, pass FROM pwd").fetchall()
+        except sqlite3.OperationalError as e:
+            # The db was not set up yet
+            script_log("Failed to read credentials db %s: %s\n" %
+                       (self.path_, str(e)))
+            rows = []
+        finally:
+            conn.close()
+
+        for host, user, value in rows:
+            try:
+                creds[host] = (user, cred_crypt.unprotect(value))
+            except ValueError as e:
+                script_log("Failed to decrypt the password of %s: %s\n" %
+                           (host, str(e)))
+        return creds
+
+    def refresh(self):
+        '''
+        Loads the credentials if the db file changed since the last load,
+        the file is checked at most once every CHECK_INTERVAL seconds
+        '''
+        with self.lock_:
+            now = time.time()
+            if self.creds_ is not None and now - self.checked_ < CHECK_INTERVAL:
+                return self.creds_
+            self.checked_ = now
+            stamp = self.file_stamp()
+            if self.creds_ is None or stamp != self.stamp_:
+                self.creds_ = self.load()
+                self.stamp_ = stamp
+            return self.creds_
+
+    def get_enc_info(self, hostname):
+        '''
+        Returns the (user, password) of the host, ('', '') if unknown
+        '''
+        return self.refresh().get(hostname, ('', ''))
+
+    def get_all_enc_info(self):
+        '''
+        Returns the (host, user, password) of all the hosts
+        '''
+        return [(host, user, pwd)
+                for host, (user, pwd) in sorted(self.refresh().items())]
+
+    def close(self):
+        # The credentials stay loaded for the other users of the provider
+        pass
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(path):
+    '''
+    Returns the credentials provider shared by the process for a db
+
+    path : path of the credentials db
+    '''
+    key = os.path.abspath(path)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = CredentialProvider(path)
+            _providers[key] = provider
+    return provider
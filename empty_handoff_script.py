@@ -42,6 +42,9 @@ import random
 # information and the credentials
 import script_db
 
+# Credentials are decrypted once and shared by the whole process
+import cred_provider
+
 # For setting up PATH
 import os
 
@@ -334,36 +337,71 @@ def get_option_parser():
     return parser
 
 
-if __name__ == '__main__':
-    options, argsleft = get_option_parser().parse_args()
+def connect_array(cdb, storage_array):
+    '''
+    Returns a connection to the storage array
 
-    # Set the working dir prefix
-    set_script_path(options.work_dir)
+    cdb : credentials db
+    storage_array : storage array hostname/ip address
 
-    # Credentials db must be initialized using the cred_mgmt.py file
-    cdb = script_db.CredDB(options.work_dir + r'\cred_db')
-	
-    # Initialize the script database
-    sdb = script_db.ScriptDB(options.work_dir + r'\script_db')
-    sdb.setup()
+    Nothing to connect to for the no-op script, the array
+    name is used as the connection.
+    '''
+    return storage_array
+
+
+def run_operation(options, cdb, sdb, conn):
+    '''
+    Runs the operation requested by Granite Core
 
-    # Connect to server
-    conn = options.storage_array
+    options : parsed script options
+    cdb : credentials db
+    sdb : script db
+    conn : storage array connection
 
+    Like the operations themselves, exits the process with
+    the status code expected by Granite Core.
+    '''
     if options.operation == 'HELLO':
         check_lun(conn, options.serial)
     elif options.operation == 'CREATE_SNAP':   
         create_snap(cdb, sdb, conn, options.serial, options.snap_name, 
                     options.access_group, options.proxy_host,
-					options.category, options.protect_category)
+                    options.category, options.protect_category)
     elif options.operation == 'REMOVE_SNAP':
         remove_snap(cdb, sdb, conn, options.serial,
-		            options.snap_name, options.proxy_host)
+                    options.snap_name, options.proxy_host)
     else:
         print ('Invalid operation: %s' % str(options.operation))
-        cdb.close()
-        sdb.close()
         sys.exit(errno.EINVAL)
 
-    sdb.close()
-    cdb.close()
+
+def main(argv=None):
+    '''
+    Runs the handoff script for the given command line
+
+    argv : script arguments, defaults to sys.argv[1:]
+    '''
+    options, argsleft = get_option_parser().parse_args(argv)
+
+    # Set the working dir prefix
+    set_script_path(options.work_dir)
+
+    # Credentials db must be initialized using the cred_mgmt.py file
+    cdb = cred_provider.get_provider(options.work_dir + r'\cred_db')
+	
+    # Initialize the script database
+    sdb = script_db.ScriptDB(options.work_dir + r'\script_db')
+    sdb.setup()
+
+    try:
+        # Connect to server
+        conn = connect_array(cdb, options.storage_array)
+        run_operation(options, cdb, sdb, conn)
+    finally:
+        sdb.close()
+        cdb.close()
+
+
+if __name__ == '__main__':
+    main()
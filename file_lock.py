@@ -0,0 +1,109 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Advisory file locks shared by the handoff processes.
+# The lock is held on the first byte of the lock file and is released by
+# the OS if the process holding it dies.
+###############################################################################
+import os
+import time
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+
+class FileLock(object):
+    '''
+    Exclusive lock between processes, backed by a lock file
+    '''
+
+    def __init__(self, path):
+        self.path_ = path
+        self.fd_ = None
+
+    def try_lock(self, fd):
+        '''
+        Returns True if the lock was taken
+        '''
+        try:
+            if msvcrt:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def acquire(self, blocking=True, timeout=None):
+        '''
+        Takes the lock
+
+        blocking : wait for the lock if it is held by someone else
+        timeout : maximum seconds to wait, None waits forever
+
+        returns True if the lock was taken
+        '''
+        fd = os.open(self.path_, os.O_RDWR | os.O_CREAT)
+        deadline = timeout is not None and time.time() + timeout or None
+        delay = 0.01
+        while not self.try_lock(fd):
+            if not blocking or (deadline and time.time() >= deadline):
+                os.close(fd)
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        self.fd_ = fd
+        return True
+
+    def fileno(self):
+        '''
+        Returns the descriptor of the lock file while the lock is held,
+        the holder may keep a small state in the file
+        '''
+        return self.fd_
+
+    def release(self):
+        if self.fd_ is None:
+            return
+        try:
+            if msvcrt:
+                os.lseek(self.fd_, 0, os.SEEK_SET)
+                msvcrt.locking(self.fd_, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.fd_, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd_)
+            self.fd_ = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
@@ -0,0 +1,479 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# asyncio handoff service.
+# Serves the same requests as handoff_daemon.py, handoff_client.py talks to
+# either of them. HELLO, CREATE_SNAP and REMOVE_SNAP run as coroutines of a
+# single event loop: their lun lookups and snapshot calls go through
+# async_zapi, so waiting on the storage arrays does not hold a thread per
+# request. The engine builds and checks these calls with the steps of the
+# handoff script, the other steps are the handoff script code run on the
+# worker threads of the service (see handoff_daemon.HandoffService): the
+# clones of protected snapshots and their VADP mounts and un-mounts, which
+# are coalesced by vadp_batch, the lun index lookups, which may list all
+# the luns of an array, and the other operations. Script db calls run on
+# a single db thread.
+#
+# Requires Python 3.5 or newer (async/await).
+###############################################################################
+import sys
+import json
+import shlex
+import time
+import errno
+import asyncio
+import importlib
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Persistent ZAPI connections
+import zapi_pool
+
+# Non-blocking ZAPI calls
+import async_zapi
+
+# Local serial <-> path index of the luns on the storage array
+import lun_index
+
+# Timing of the operation steps
+import metrics
+
+# Worker threads, databases and array connections of the service
+import handoff_daemon
+
+# Operations run by the event loop, the others run on a worker thread
+ASYNC_OPERATIONS = ('HELLO', 'CREATE_SNAP', 'REMOVE_SNAP')
+
+# Seconds between two attempts to take a lun lock
+LOCK_POLL_INTERVAL = 0.1
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+class OperationExit(Exception):
+    '''
+    Ends an operation with the exit status expected by Granite Core,
+    the coroutine version of sys.exit in the handoff scripts
+    '''
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class Request(object):
+    '''
+    Output and metrics tags of one operation run by the engine
+    '''
+
+    def __init__(self, operation, array, serial):
+        self.array_ = array
+        self.tags_ = {'operation' : operation, 'serial' : serial}
+        self.out_ = []
+        self.err_ = []
+
+    def output(self, msg):
+        '''
+        Same as print in the handoff scripts
+        '''
+        self.out_.append(msg + '\n')
+
+    def log(self, msg):
+        '''
+        Same as script_log in the handoff scripts
+        '''
+        self.err_.append(msg)
+
+    def result(self, status):
+        return status, ''.join(self.out_), ''.join(self.err_)
+
+
+class AsyncHandoffEngine(object):
+    '''
+    Runs the handoff operations of a module on an event loop.
+
+    service : the handoff_daemon.HandoffService of the module, it runs
+              the operations and steps that are not coroutines
+
+    The module must provide what the service needs, plus the steps the
+    engine shares with it: lun_lock_file, group_snap_requests,
+    snap_request, snap_exists, snap_error, protect_snap and
+    remove_snap_clones (see netapp_c_mode_handoff_script.py). Other
+    modules are run by the service.
+    '''
+
+    def __init__(self, service):
+        self.service_ = service
+        self.module_ = service.module_
+        self.db_executor_ = ThreadPoolExecutor(max_workers=1)
+        self.servers_ = {}
+
+    async def in_thread(self, executor, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, fn, *args)
+
+    async def db(self, work_dir, fn, *args):
+        '''
+        Calls fn(cdb, sdb, *args) on the db thread and returns its result
+
+        work_dir : directory in which the databases reside
+        '''
+        def call():
+            cdb, sdb = self.service_.get_dbs(work_dir)
+            return fn(cdb, sdb, *args)
+        return await self.in_thread(self.db_executor_, call)
+
+    async def call(self, req, fn, *args):
+        '''
+        Runs a step of the handoff script on a worker thread and returns
+        its result. What the step writes is added to the request output.
+
+        Raises OperationExit if the step exits or fails.
+        '''
+        result = []
+        tags = dict(req.tags_, array=req.array_)
+
+        def step():
+            with metrics.context(**tags):
+                result.append(fn(*args))
+
+        status, out, err = await self.in_thread(self.service_.executor_,
+                                                self.service_.call, step)
+        req.out_.append(out)
+        req.err_.append(err)
+        if not result:
+            raise OperationExit(status)
+        return result[0]
+
+    async def connect(self, options):
+        '''
+        Returns the (connection, async server) of the storage array
+        of the operation, both share the settings of the module's
+        connect_array
+        '''
+        conn = await self.db(options.work_dir, lambda cdb, sdb:
+                             self.service_.get_conn(cdb, options))
+        server = self.servers_.get(conn)
+        if server is None:
+            server = async_zapi.AsyncZapiServer(conn)
+            self.servers_[conn] = server
+        return conn, server
+
+    async def acquire(self, lock, timeout):
+        '''
+        Takes a FileLock without blocking the event loop
+
+        returns False if the lock could not be taken in time
+        '''
+        deadline = time.time() + timeout
+        while not lock.acquire(blocking=False):
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        return True
+
+    async def run(self, argv):
+        '''
+        Runs one Granite Core operation
+
+        argv : the handoff script arguments
+
+        Returns a tuple of (exit status, stdout, stderr)
+        '''
+        try:
+            options, argsleft = self.module_.get_option_parser().parse_args(argv)
+        except SystemExit:
+            options = None
+        if (options is None or options.operation not in ASYNC_OPERATIONS or
+            not hasattr(self.module_, 'remove_snap_clones')):
+            return await self.in_thread(self.service_.executor_,
+                                        self.service_.run, argv)
+
+        error = self.service_.check_options(options)
+        if error:
+            return errno.EACCES, '', error + '\n'
+
+        req = Request(options.operation, options.storage_array, options.serial)
+        with metrics.span('operation', array=options.storage_array,
+                          **req.tags_) as record:
+            try:
+                conn, server = await self.connect(options)
+                if options.operation == 'HELLO':
+                    status = await self.check_lun(req, conn, server,
+                                                  options.serial)
+                elif options.operation == 'CREATE_SNAP':
+                    status = await self.create_snap(req, options, conn, server)
+                else:
+                    status = await self.remove_snap(req, options, conn, server)
+            except OperationExit as e:
+                status = e.status
+            except Exception:
+                req.log(traceback.format_exc())
+                status = 1
+            if status:
+                record['status'] = 'error'
+
+        # The service does not exit, write the spans of the operation
+        asyncio.get_event_loop().run_in_executor(self.db_executor_,
+                                                 metrics.flush)
+        return req.result(status)
+
+    async def volume_path(self, req, conn, server, serial):
+        '''
+        Gets the path of the lun, same as get_volume_path
+
+        returns an empty string if the lun was not found
+        '''
+        index = self.module_.get_lun_index(conn)
+        if lun_index.TTL > 0:
+            # A lookup may list all the luns of the array, or wait for
+            # another thread listing them
+            lun_path = await self.in_thread(self.service_.executor_,
+                                            index.path_for_serial, serial)
+            if lun_path:
+                return lun_path
+
+        lun_path_request = getattr(self.module_, 'lun_path_request', None)
+        if lun_path_request is None:
+            # lun-list-info cannot look up a single lun
+            return await self.call(req, self.module_.get_volume_path,
+                                   conn, serial)
+
+        xo = await server.invoke_elem(lun_path_request(serial), **req.tags_)
+        if (xo.results_status() == "failed") :
+            req.output("Error:\n")
+            req.output(xo.sprintf())
+            return ""
+        if (not xo.child_get("attributes-list") and
+            xo.child_get_string("next-tag")):
+            # The first page came back empty, follow the next ones
+            return await self.call(req, self.module_.get_volume_path,
+                                   conn, serial)
+
+        lun_path = self.module_.parse_lun_path(xo)
+        index.add(serial, lun_path)
+        return lun_path
+
+    async def check_lun(self, req, conn, server, serial):
+        '''
+        Checks for the presence of lun, same as check_lun
+
+        returns the exit status
+        '''
+        lun_path = await self.volume_path(req, conn, server, serial)
+        if len(lun_path) == 0:
+            req.output("Lun %s not found" % (serial))
+            return 1
+
+        req.output("OK")
+        return 0
+
+    async def snap_operation(self, req, conn, server, op, serial, snap_name):
+        '''
+        Performs a snapshot operation, same as snap_operation
+
+        returns the error message, empty if the operation succeeded
+        '''
+        with metrics.span('snap_operation', array=req.array_,
+                          **req.tags_) as record, \
+             metrics.span('batch_snap_operation', array=req.array_,
+                          **req.tags_) as batch_record:
+            lun_path = await self.volume_path(req, conn, server, serial)
+            error = await self.snap_volume(req, conn, server, op, serial,
+                                           snap_name, lun_path)
+            if error:
+                record['status'] = batch_record['status'] = 'error'
+        return error
+
+    async def snap_volume(self, req, conn, server, op, serial, snap_name,
+                          lun_path):
+        '''
+        Performs a snapshot operation on the volume of the lun
+
+        returns the error message, empty if the operation succeeded
+        '''
+        errors, volume_snaps = self.module_.group_snap_requests(
+            {serial : lun_path}, [(serial, snap_name)])
+        if errors:
+            return errors[serial]
+
+        volume, snap_name = list(volume_snaps)[0]
+        xo = await server.invoke_elem(
+            self.module_.snap_request(op, volume, snap_name), **req.tags_)
+        if (xo.results_status() != "failed" or
+            self.module_.snap_exists(xo)):
+            return ''
+        # The error invalidates the lun index, which writes its generation
+        return await self.in_thread(self.service_.executor_,
+                                    self.module_.snap_error, conn, xo)
+
+    async def create_snap(self, req, options, conn, server):
+        '''
+        Creates a snapshot, same as create_snap
+
+        returns the exit status
+
+        The proxy backup of a protected snapshot is queued or run by
+        the handoff script, on a worker thread.
+        '''
+        serial = options.serial
+        snap_name = options.snap_name
+        error = await self.snap_operation(req, conn, server,
+                                          "snapshot-create", serial, snap_name)
+        if error:
+            req.output(error)
+            return 1
+        req.output(snap_name)
+
+        if options.category != options.protect_category:
+            return 0
+
+        await self.call(req, self.protect, options, conn)
+        return 0
+
+    def protect(self, options, conn):
+        '''
+        Runs or queues the proxy backup of the snapshot, on a worker thread
+        '''
+        cdb, sdb = self.service_.get_dbs(options.work_dir)
+        self.module_.protect_snap(cdb, sdb, conn, options.serial,
+                                  options.snap_name, options.access_group,
+                                  options.proxy_host, options.async_backup)
+
+    def remove_clones(self, options, conn):
+        '''
+        Destroys the clones of the snapshot, on a worker thread
+        '''
+        cdb, sdb = self.service_.get_dbs(options.work_dir)
+        self.module_.remove_snap_clones(cdb, sdb, conn, options.serial,
+                                        options.snap_name, options.proxy_host)
+
+    async def remove_snap(self, req, options, conn, server):
+        '''
+        Removes a snapshot, same as remove_snap
+
+        returns the exit status
+        '''
+        work_dir = options.work_dir
+        serial = options.serial
+        snap_name = options.snap_name
+
+        # Do not back up a snapshot that is going away
+        await self.db(work_dir, lambda cdb, sdb:
+                      sdb.cancel_backup_jobs(serial, snap_name))
+
+        # Wait for a proxy backup of the lun running in another process
+        lock = self.module_.lun_lock_file(serial)
+        if not await self.acquire(lock, self.module_.LUN_LOCK_TIMEOUT):
+            req.log("Timed out waiting for another operation on lun %s" %
+                    serial)
+            return errno.EBUSY
+        try:
+            await self.call(req, self.remove_clones, options, conn)
+
+            error = await self.snap_operation(req, conn, server,
+                                              "snapshot-delete", serial,
+                                              snap_name)
+        finally:
+            lock.release()
+
+        if error:
+            req.output(error)
+            return 1
+        return 0
+
+
+async def handle_request(engine, reader, writer):
+    '''
+    Reads one request line, runs it and writes back one response line
+    '''
+    peer = str(writer.get_extra_info('peername'))
+    try:
+        line = await reader.readline()
+        argv = engine.service_.parse_request(line)
+    except (ValueError, asyncio.LimitOverrunError):
+        script_log("Invalid request from %s\n" % peer)
+        writer.close()
+        return
+    except handoff_daemon.RequestDenied as e:
+        script_log("Request from %s denied: %s\n" % (peer, str(e)))
+        resp = handoff_daemon.denied_response(e)
+    else:
+        status, out, err = await engine.run(argv)
+        resp = {'status' : status, 'stdout' : out, 'stderr' : err}
+    try:
+        writer.write(json.dumps(resp).encode('utf-8') + b'\n')
+        await writer.drain()
+    except OSError:
+        # The client went away
+        pass
+    writer.close()
+
+
+def serve(engine, address, port):
+    '''
+    Serves the requests until interrupted
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    server = loop.run_until_complete(asyncio.start_server(
+        lambda reader, writer: handle_request(engine, reader, writer),
+        address, port, limit=handoff_daemon.MAX_REQUEST_SIZE))
+    script_log("Serving %s on %s:%d\n" % (engine.module_.__name__,
+                                          address, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    async_zapi.close_pools()
+    loop.close()
+
+
+if __name__ == '__main__':
+    # Same arguments as the threaded service
+    options, argsleft = handoff_daemon.get_option_parser().parse_args()
+
+    # Handoff scripts are imported from the work dir
+    sys.path.insert(0, options.work_dir)
+    module = importlib.import_module(options.script)
+
+    # Both the threaded and the async pools use these settings
+    zapi_pool.configure(options.zapi_pool_size, options.zapi_idle_timeout)
+
+    service = handoff_daemon.HandoffService(module, options.workers,
+                                            options.work_dir,
+                                            shlex.split(options.script_args))
+    serve(AsyncHandoffEngine(service), options.address, options.port)
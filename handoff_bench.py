@@ -0,0 +1,399 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Benchmark of the Netapp handoff scripts.
+# Replays bursts of Granite Core operations (HELLO, CREATE_SNAP,
+# REMOVE_SNAP) against the handoff scripts and a simulated array (see
+# zapi_simulator.py), and reports the throughput and the p50/p99 latency
+# of each operation, to measure the performance changes of the scripts.
+#
+# Each operation runs the handoff script in a new process like Granite
+# Core does, or is sent to a running handoff_daemon.py with --daemon-port.
+# Arguments after -- are added to every handoff script command line:
+# handoff_bench.py --requests 200 --concurrency 16 -- --lun-index-ttl 0
+###############################################################################
+import concurrent.futures
+import http.client
+import json
+import optparse
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+# The simulated array
+import zapi_simulator
+
+# Credentials of the simulated array
+import script_db
+
+# Forwards the operations to the handoff service
+import handoff_client
+
+SCRIPTS = 'netapp_c_mode_handoff_script,netapp_handoff_script'
+OPERATIONS = 'HELLO,CREATE_SNAP,REMOVE_SNAP'
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Snapshots taken by the benchmark are not protected, so
+# that no proxy backup is run
+BENCH_CATEGORY = 'bench'
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+def percentile(values, pct):
+    '''
+    Returns the nearest rank percentile of the values
+
+    values : sorted list of numbers
+    pct : percentile, 0 to 100
+    '''
+    if not values:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def get_sim_stats(options, simulator):
+    '''
+    Returns and resets the per call statistics of the simulated array
+
+    options : parsed options
+    simulator : in process ZapiSimulator, None if the array is remote
+    '''
+    if simulator is not None:
+        return simulator.stats.get(reset=True)
+
+    if options.array_transport == 'HTTPS':
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_NONE
+        conn = http.client.HTTPSConnection(options.array_address,
+                                           options.array_port,
+                                           context=context)
+    else:
+        conn = http.client.HTTPConnection(options.array_address,
+                                          options.array_port)
+    try:
+        conn.request('GET', '/stats?reset')
+        return json.loads(conn.getresponse().read().decode('utf-8'))['calls']
+    except (http.client.HTTPException, OSError, ValueError) as e:
+        # Not a simulator, the ZAPI calls are not counted
+        script_log("Cannot read the array statistics: %s\n" % str(e))
+        return {}
+    finally:
+        conn.close()
+
+
+def get_script_args(options, operation, serial, snap_name, extra_args):
+    '''
+    Returns the handoff script arguments of one operation
+
+    options : parsed options
+    operation : Granite Core operation
+    serial : lun serial
+    snap_name : snapshot name
+    extra_args : arguments added to every command line
+    '''
+    args = ['--work-dir', options.work_dir,
+            '--storage-array', options.array_address,
+            '--array-transport', options.array_transport,
+            '--array-port', str(options.array_port),
+            '--operation', operation,
+            '--serial', serial]
+    if operation != 'HELLO':
+        args += ['--snap-name', snap_name,
+                 '--access-group', options.access_group,
+                 '--proxy-host', options.proxy_host,
+                 '--category', BENCH_CATEGORY,
+                 '--issue-time', str(int(time.time()))]
+    return args + extra_args
+
+
+def run_script(options, script, args):
+    '''
+    Runs one operation of the handoff script
+
+    options : parsed options
+    script : handoff script module name
+    args : handoff script arguments
+
+    Returns a tuple of (seconds, exit status, stderr)
+    '''
+    start = time.time()
+    if options.daemon_port:
+        try:
+            status, out, err = handoff_client.forward(options.daemon_port, args)
+        except (handoff_client.ServiceUnavailable, OSError, ValueError,
+                KeyError) as e:
+            status, err = -1, str(e)
+    else:
+        cmd = [sys.executable, os.path.join(options.script_dir, script + '.py')]
+        proc = subprocess.Popen(cmd + args,
+                                stdin = subprocess.DEVNULL,
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+        out, err = proc.communicate()
+        status = proc.returncode
+        err = err.decode('utf-8', 'replace')
+    return time.time() - start, status, err
+
+
+def run_burst(options, script, operation, serials, snap_names, extra_args):
+    '''
+    Runs a burst of operations, options.concurrency at a time
+
+    options : parsed options
+    script : handoff script module name
+    operation : Granite Core operation
+    serials : lun serial of each operation
+    snap_names : snapshot name of each operation
+    extra_args : arguments added to every command line
+
+    Returns a tuple of (wall seconds, operation seconds, errors)
+    '''
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(options.concurrency) as pool:
+        futures = [pool.submit(run_script, options, script,
+                               get_script_args(options, operation, serial,
+                                               snap_name, extra_args))
+                   for serial, snap_name in zip(serials, snap_names)]
+        results = [f.result() for f in futures]
+    wall = time.time() - start
+
+    errors = 0
+    for seconds, status, err in results:
+        if status != 0:
+            errors += 1
+            if options.verbose:
+                script_log("%s %s exited with %d:\n%s\n" %
+                           (script, operation, status, err))
+    return wall, [seconds for seconds, status, err in results], errors
+
+
+def run_bench(options, simulator, extra_args):
+    '''
+    Runs the bursts of every operation against every script
+
+    options : parsed options
+    simulator : in process ZapiSimulator, None if the array is remote
+    extra_args : arguments added to every command line
+
+    Returns a list of result dicts, one per script and operation
+    '''
+    lun_count = options.volumes * options.luns_per_volume
+    serials = [zapi_simulator.lun_serial(i % lun_count + 1)
+               for i in range(options.requests)]
+    run_id = int(time.time())
+    results = []
+    for index, script in enumerate(options.scripts.split(',')):
+        stats = dict((op, {'wall' : 0.0, 'seconds' : [], 'errors' : 0,
+                           'zapi_calls' : 0})
+                     for op in options.operations.split(','))
+        get_sim_stats(options, simulator)
+        for burst in range(options.bursts):
+            # REMOVE_SNAP removes the snapshots of CREATE_SNAP
+            snap_names = ['bench_%d_%d_%d_%d' % (run_id, index, burst, i)
+                          for i in range(options.requests)]
+            for op in options.operations.split(','):
+                wall, seconds, errors = run_burst(options, script, op, serials,
+                                                  snap_names, extra_args)
+                calls = get_sim_stats(options, simulator)
+                op_stats = stats[op]
+                op_stats['wall'] += wall
+                op_stats['seconds'] += seconds
+                op_stats['errors'] += errors
+                op_stats['zapi_calls'] += sum(c['calls'] for c in calls.values())
+
+        for op in options.operations.split(','):
+            op_stats = stats[op]
+            seconds = sorted(op_stats['seconds'])
+            results.append({
+                'script' : script,
+                'operation' : op,
+                'requests' : len(seconds),
+                'errors' : op_stats['errors'],
+                'throughput' : op_stats['wall'] and
+                               len(seconds) / op_stats['wall'] or 0.0,
+                'p50' : percentile(seconds, 50),
+                'p99' : percentile(seconds, 99),
+                'zapi_per_op' : seconds and
+                                op_stats['zapi_calls'] / float(len(seconds))
+                                or 0.0})
+    return results
+
+
+def format_results(results):
+    '''
+    Returns the results as a text table
+
+    results : result dicts of run_bench
+    '''
+    lines = ['%-32s %-12s %8s %6s %8s %8s %8s %8s' %
+             ('script', 'operation', 'requests', 'errors', 'ops/s',
+              'p50(s)', 'p99(s)', 'zapi/op')]
+    for r in results:
+        lines.append('%-32s %-12s %8d %6d %8.2f %8.3f %8.3f %8.1f' %
+                     (r['script'], r['operation'], r['requests'], r['errors'],
+                      r['throughput'], r['p50'], r['p99'], r['zapi_per_op']))
+    return '\n'.join(lines) + '\n'
+
+
+def setup_work_dir(options):
+    '''
+    Creates the databases of the work dir and stores the
+    credentials of the simulated array
+
+    options : parsed options
+    '''
+    if not options.work_dir:
+        options.work_dir = tempfile.mkdtemp(prefix='handoff_bench_')
+    cdb = script_db.CredDB(options.work_dir + r'\cred_db')
+    try:
+        cdb.setup()
+        cdb.insert_enc_info(options.array_address, 'bench', 'bench')
+    finally:
+        cdb.close()
+
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser(
+        usage="%prog [options] [-- handoff script arguments]")
+    parser.add_option("--scripts",
+                      type="string",
+                      default=SCRIPTS,
+                      help="Comma separated handoff script modules")
+    parser.add_option("--script-dir",
+                      type="string",
+                      default=SCRIPT_DIR,
+                      help="Directory of the handoff scripts")
+    parser.add_option("--work-dir",
+                      type="string",
+                      default="",
+                      help="Work dir of the handoff scripts, a temporary"
+                           " directory by default")
+    parser.add_option("--operations",
+                      type="string",
+                      default=OPERATIONS,
+                      help="Comma separated operations run in each burst,"
+                           " in order")
+    parser.add_option("--requests",
+                      type="int",
+                      default=50,
+                      help="Operations per burst, each on its own lun while"
+                           " there are enough luns")
+    parser.add_option("--bursts",
+                      type="int",
+                      default=1,
+                      help="Number of bursts of each operation")
+    parser.add_option("--concurrency",
+                      type="int",
+                      default=8,
+                      help="Operations run at a time")
+    parser.add_option("--proxy-host",
+                      type="string",
+                      default="bench-proxy",
+                      help="Proxy host passed to the handoff scripts")
+    parser.add_option("--daemon-port",
+                      type="int",
+                      default=0,
+                      help="Send the operations to the handoff service on this"
+                           " port instead of running the scripts, --scripts"
+                           " and --work-dir must be those of the service")
+    parser.add_option("--array-address",
+                      type="string",
+                      default=zapi_simulator.ADDRESS,
+                      help="Address of the simulated array")
+    parser.add_option("--array-port",
+                      type="int",
+                      default=0,
+                      help="Port of a running zapi_simulator.py, a simulator"
+                           " is started in process by default")
+    parser.add_option("--array-transport",
+                      type="choice",
+                      choices=['HTTP', 'HTTPS'],
+                      default='HTTP',
+                      help="Transport of a running zapi_simulator.py")
+    parser.add_option("--json",
+                      action="store_true",
+                      default=False,
+                      help="Print the results as JSON")
+    parser.add_option("--verbose",
+                      action="store_true",
+                      default=False,
+                      help="Log the output of the failed operations")
+    zapi_simulator.add_simulator_options(parser)
+    return parser
+
+
+if __name__ == '__main__':
+    options, extra_args = get_option_parser().parse_args()
+
+    # The service runs every request with the script it loaded
+    # and only serves its own work dir
+    if options.daemon_port and (len(options.scripts.split(',')) != 1 or
+                                not options.work_dir):
+        script_log("Error: --daemon-port requires the --scripts and"
+                   " --work-dir of the handoff service\n")
+        sys.exit(1)
+
+    simulator = None
+    if not options.array_port:
+        try:
+            simulator = zapi_simulator.create_simulator(options,
+                                                        options.array_address)
+        except (ValueError, OSError) as e:
+            script_log("Error: %s\n" % str(e))
+            sys.exit(1)
+        simulator.start()
+        options.array_port = simulator.port()
+        options.array_transport = simulator.transport
+
+    setup_work_dir(options)
+    script_log("Running %d %s operations per burst on %d luns, work dir %s\n" %
+               (options.requests, options.operations,
+                options.volumes * options.luns_per_volume, options.work_dir))
+
+    results = run_bench(options, simulator, extra_args)
+    if options.json:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    else:
+        sys.stdout.write(format_results(results))
+
+    if simulator is not None:
+        simulator.shutdown()
+        simulator.server_close()
+    sys.exit(any(r['errors'] for r in results) and 1 or 0)
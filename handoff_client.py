@@ -0,0 +1,186 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Handoff client script.
+# Granite Core runs this script in place of the handoff script. It forwards
+# the command line to the handoff_daemon.py service and reproduces the
+# output and exit code of the operation.
+# If the service is not running, the handoff script is run in this process.
+# Once the operation was sent to the service, it is never run again here:
+# a lost or invalid reply is reported as an error.
+###############################################################################
+import sys
+import json
+import errno
+import socket
+import importlib
+
+WORK_DIR = r'C:\rvbd_handoff_scripts'
+DAEMON_ADDRESS = '127.0.0.1'
+DAEMON_PORT = 9456
+DEFAULT_SCRIPT = 'netapp_c_mode_handoff_script'
+
+# Seconds to wait for the service to accept the connection
+CONNECT_TIMEOUT = 5
+
+# Seconds to wait for the reply, see --daemon-timeout
+REPLY_TIMEOUT = 3600
+
+# File in WORK_DIR holding the token of the running service, only
+# clients that can read it are served
+TOKEN_FILE = r'\handoff_daemon.token'
+
+# Client options, these are removed before forwarding the command line
+CLIENT_OPTIONS = ('--daemon-port', '--daemon-script', '--daemon-timeout')
+
+
+class ServiceUnavailable(Exception):
+    '''
+    The handoff service could not be reached, the operation was not sent
+    '''
+    pass
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+def split_args(argv):
+    '''
+    Separates the client options from the handoff script arguments
+
+    argv : command line arguments
+
+    returns a tuple of (client options dict, handoff script arguments)
+    '''
+    client_opts = {}
+    script_args = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        name, sep, value = arg.partition('=')
+        if name in CLIENT_OPTIONS:
+            if not sep:
+                i += 1
+                value = argv[i] if i < len(argv) else ''
+            client_opts[name] = value
+        else:
+            script_args.append(arg)
+        i += 1
+    return client_opts, script_args
+
+
+def get_work_dir(script_args):
+    '''
+    Returns the --work-dir of the handoff script arguments
+    '''
+    work_dir = WORK_DIR
+    for i, arg in enumerate(script_args):
+        name, sep, value = arg.partition('=')
+        if name == '--work-dir':
+            if not sep:
+                value = script_args[i + 1] if i + 1 < len(script_args) else ''
+            work_dir = value
+    return work_dir
+
+
+def read_token(work_dir):
+    '''
+    Returns the token of the service running in work_dir
+
+    Raises IOError/OSError if it cannot be read.
+    '''
+    with open(work_dir + TOKEN_FILE) as f:
+        return f.read().strip()
+
+
+def forward(port, script_args, timeout=REPLY_TIMEOUT):
+    '''
+    Sends the operation to the handoff service and waits for it
+
+    port : local port of the handoff service
+    script_args : the handoff script arguments
+    timeout : seconds to wait for the reply
+
+    returns a tuple of (exit status, stdout, stderr)
+    Raises ServiceUnavailable if the service is not reachable, and
+    socket.error or ValueError if the reply was lost or is invalid.
+    '''
+    try:
+        token = read_token(get_work_dir(script_args))
+    except (IOError, OSError) as e:
+        raise ServiceUnavailable("no service token: %s" % str(e))
+    try:
+        sock = socket.create_connection((DAEMON_ADDRESS, port),
+                                        CONNECT_TIMEOUT)
+    except socket.error as e:
+        raise ServiceUnavailable(str(e))
+    try:
+        sock.settimeout(timeout)
+        req = json.dumps({'argv' : script_args,
+                          'token' : token}).encode('utf-8') + b'\n'
+        sock.sendall(req)
+        resp = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    if not resp:
+        raise socket.error("Handoff service closed the connection")
+
+    data = json.loads(resp.decode('utf-8'))
+    try:
+        return data['status'], data['stdout'], data['stderr']
+    except (KeyError, TypeError):
+        raise ValueError("Invalid reply from the handoff service")
+
+
+if __name__ == '__main__':
+    client_opts, script_args = split_args(sys.argv[1:])
+    port = int(client_opts.get('--daemon-port') or DAEMON_PORT)
+    timeout = float(client_opts.get('--daemon-timeout') or REPLY_TIMEOUT)
+
+    try:
+        status, out, err = forward(port, script_args, timeout)
+    except ServiceUnavailable as e:
+        # Service not available, run the operation ourselves
+        script_log("Handoff service not available (%s), "
+                   "running locally\n" % str(e))
+        module = importlib.import_module(client_opts.get('--daemon-script') or
+                                         DEFAULT_SCRIPT)
+        module.main(script_args)
+        sys.exit(0)
+    except (socket.error, ValueError) as e:
+        # The service may have run the operation, do not run it again
+        script_log("No reply from the handoff service (%s)\n" % str(e))
+        sys.exit(errno.EIO)
+
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    sys.exit(status)
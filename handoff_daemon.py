@@ -0,0 +1,464 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Long running handoff service.
+# Loads a handoff script once and keeps its databases and storage array
+# connections open, so that each Granite Core operation only pays for
+# the work on the array. The handoff_client.py script forwards the
+# Granite Core command line to this service over a local socket.
+# Only clients that can read the token file written by the service in
+# WORK_DIR are served, keep WORK_DIR readable by the service account only.
+###############################################################################
+import os
+import hmac
+import shlex
+import errno
+import binascii
+import optparse
+import sys
+import json
+import socketserver
+import threading
+import importlib
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Script DB is used to store/load the cloned lun
+# information and the credentials
+import script_db
+
+# Credentials are decrypted once and shared by the whole process
+import cred_provider
+
+# Runs the proxy backups queued with --async-backup
+import backup_worker
+
+# Timing of the operation steps
+import metrics
+
+# Clients read the token of the service
+import handoff_client
+
+WORK_DIR =  r'C:\rvbd_handoff_scripts'
+DAEMON_ADDRESS = '127.0.0.1'
+DAEMON_PORT = 9456
+DEFAULT_SCRIPT = 'netapp_c_mode_handoff_script'
+
+# Requests and responses are single lines of JSON, so a
+# request can never be larger than this
+MAX_REQUEST_SIZE = 1024 * 1024
+
+
+def write_token(work_dir):
+    '''
+    Creates a new random token and writes it to the token file
+
+    work_dir : directory in which the token file resides
+
+    returns the token
+    '''
+    token = binascii.hexlify(os.urandom(32)).decode('ascii')
+    path = work_dir + handoff_client.TOKEN_FILE
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+class ThreadOutput(object):
+    '''
+    Stream that replaces sys.stdout/sys.stderr in the service.
+
+    Writes made by a thread that is running an operation are captured
+    in that operation's buffer, all other writes go to the original stream.
+    '''
+
+    def __init__(self, stream):
+        self.stream_ = stream
+        self.local_ = threading.local()
+
+    def capture(self):
+        self.local_.buf = []
+
+    def release(self):
+        buf = getattr(self.local_, 'buf', None) or []
+        self.local_.buf = None
+        return ''.join(buf)
+
+    def write(self, msg):
+        buf = getattr(self.local_, 'buf', None)
+        if buf is None:
+            return self.stream_.write(msg)
+        buf.append(str(msg))
+        return len(msg)
+
+    def flush(self):
+        if getattr(self.local_, 'buf', None) is None:
+            self.stream_.flush()
+
+
+class HandoffService(object):
+    '''
+    Runs handoff operations for the handoff script module.
+
+    module : the handoff script module
+    workers : maximum number of operations run at a time
+    work_dir : the WORK_DIR served, requests for other dirs are refused
+    script_args : handoff script arguments with the tuning options of
+                  the module, e.g. --lun-index-ttl. They are applied once
+                  for the whole process, the same options in the requests
+                  are ignored.
+
+    The module must provide get_option_parser, set_script_path,
+    connect_array and run_operation (see netapp_c_mode_handoff_script.py).
+    Operations run on a fixed pool of worker threads. Each worker keeps
+    its own script db connection since sqlite connections cannot be
+    shared between threads. The credentials are loaded once and shared
+    by all the workers (see cred_provider).
+    Array connections are shared by all the workers.
+
+    Proxy backups queued by the operations are run by a backup worker
+    thread of the service instead of a separate worker process.
+    '''
+
+    def __init__(self, module, workers, work_dir, script_args=()):
+        self.module_ = module
+        self.work_dir_ = work_dir
+        self.configure(list(script_args))
+        self.token_ = write_token(work_dir)
+        self.executor_ = ThreadPoolExecutor(max_workers=workers)
+        self.local_ = threading.local()
+        self.lock_ = threading.Lock()
+        self.conns_ = {}
+        self.setup_done_ = set()
+        self.backup_workers_ = {}
+        self.backup_dirs_ = set()
+        self.backup_event_ = threading.Event()
+        if hasattr(module, 'BACKUP_WORKER_HOOK'):
+            module.BACKUP_WORKER_HOOK = self.wake_backup_worker
+            thread = threading.Thread(target=self.run_backups)
+            thread.daemon = True
+            thread.start()
+        self.stdout_ = ThreadOutput(sys.stdout)
+        self.stderr_ = ThreadOutput(sys.stderr)
+        sys.stdout = self.stdout_
+        sys.stderr = self.stderr_
+
+    def configure(self, script_args):
+        '''
+        Applies the settings of the module shared by all the operations
+        '''
+        options, argsleft = self.module_.get_option_parser().parse_args(
+            script_args + ['--work-dir', self.work_dir_])
+        self.module_.set_script_path(self.work_dir_)
+        if hasattr(self.module_, 'configure_array'):
+            self.module_.configure_array(options.array_transport,
+                                         options.array_port)
+        if hasattr(self.module_, 'configure_operation'):
+            self.module_.configure_operation(options)
+
+    def parse_request(self, line):
+        '''
+        Returns the handoff script arguments of a request line
+
+        Raises ValueError if the request is invalid, and
+        RequestDenied if it does not carry the token of the service.
+        '''
+        data = json.loads(line.decode('utf-8'))
+        try:
+            argv = data['argv']
+            token = data.get('token') or ''
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError("Invalid request")
+        if not isinstance(argv, list) or not isinstance(token, str):
+            raise ValueError("Invalid request")
+        if not hmac.compare_digest(token.encode('utf-8'),
+                                   self.token_.encode('ascii')):
+            raise RequestDenied("Invalid handoff service token")
+        return argv
+
+    def check_options(self, options):
+        '''
+        Returns why the operation is refused, empty if it is not
+        '''
+        if (os.path.normcase(os.path.normpath(options.work_dir)) !=
+            os.path.normcase(os.path.normpath(self.work_dir_))):
+            return "The handoff service only serves %s" % self.work_dir_
+        return ''
+
+    def get_dbs(self, work_dir):
+        '''
+        Returns the (credentials db, script db) for this worker thread
+
+        work_dir : directory in which the databases reside
+        '''
+        dbs = getattr(self.local_, 'dbs', None)
+        if dbs is None:
+            dbs = self.local_.dbs = {}
+
+        if work_dir not in dbs:
+            cdb = cred_provider.get_provider(work_dir + r'\cred_db')
+            sdb = script_db.ScriptDB(work_dir + r'\script_db')
+            with self.lock_:
+                if work_dir not in self.setup_done_:
+                    sdb.setup()
+                    self.setup_done_.add(work_dir)
+            dbs[work_dir] = (cdb, sdb)
+
+        return dbs[work_dir]
+
+    def get_conn(self, cdb, options):
+        '''
+        Returns the connection for the storage array of the operation,
+        connecting to it on first use
+
+        cdb : credentials db
+        options : parsed script options
+
+        The connection is made again when the credentials of the array
+        changed in the credentials db since it was made.
+        '''
+        if not hasattr(self.module_, 'configure_array'):
+            key = (options.storage_array,)
+        else:
+            key = (options.storage_array, options.array_transport,
+                   options.array_port)
+        creds = cdb.get_enc_info(options.storage_array)
+        with self.lock_:
+            conn_creds, conn = self.conns_.get(key, (None, None))
+            if conn is None or conn_creds != creds:
+                conn = self.module_.connect_array(cdb, *key)
+                self.conns_[key] = (creds, conn)
+        return conn
+
+    def wake_backup_worker(self):
+        '''
+        Called by the operations after queueing proxy backups
+        '''
+        with self.lock_:
+            self.backup_dirs_.add(self.module_.WORK_DIR)
+        self.backup_event_.set()
+
+    def run_backups(self):
+        '''
+        Backup worker thread, drains the queue of each WORK_DIR
+        in which backups were queued
+        '''
+        while True:
+            self.backup_event_.wait()
+            self.backup_event_.clear()
+            with self.lock_:
+                work_dirs, self.backup_dirs_ = self.backup_dirs_, set()
+            for work_dir in work_dirs:
+                worker = self.backup_workers_.get(work_dir)
+                if worker is None:
+                    worker = backup_worker.BackupWorker(self.module_, work_dir)
+                    self.backup_workers_[work_dir] = worker
+                try:
+                    worker.drain()
+                except Exception:
+                    traceback.print_exc()
+
+    def run(self, argv):
+        '''
+        Runs one Granite Core operation
+
+        argv : the handoff script arguments
+
+        Returns a tuple of (exit status, stdout, stderr)
+        '''
+        return self.call(self.run_operation, argv)
+
+    def run_operation(self, argv):
+        options, argsleft = self.module_.get_option_parser().parse_args(argv)
+        error = self.check_options(options)
+        if error:
+            script_log(error + '\n')
+            sys.exit(errno.EACCES)
+        cdb, sdb = self.get_dbs(options.work_dir)
+        conn = self.get_conn(cdb, options)
+        self.module_.run_operation(options, cdb, sdb, conn)
+
+    def call(self, fn, *args):
+        '''
+        Calls fn on this thread and captures what it writes
+
+        Returns a tuple of (exit status, stdout, stderr), fn exits
+        with the status expected by Granite Core
+        '''
+        self.stdout_.capture()
+        self.stderr_.capture()
+        status = 0
+        try:
+            fn(*args)
+        except SystemExit as e:
+            # Operations exit with the status expected by Granite Core,
+            # use the same rules as the interpreter to convert it.
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                sys.stderr.write(str(e.code) + '\n')
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            out = self.stdout_.release()
+            err = self.stderr_.release()
+        # The service does not exit, write the spans of the operation
+        metrics.flush()
+        return status, out, err
+
+    def submit(self, argv):
+        '''
+        Runs the operation on a worker thread and waits for it
+
+        argv : the handoff script arguments
+        '''
+        return self.executor_.submit(self.run, argv).result()
+
+
+class RequestDenied(Exception):
+    '''
+    The request is not authorized
+    '''
+    pass
+
+
+def denied_response(e):
+    '''
+    Returns the response to a request that is not authorized
+    '''
+    return {'status' : errno.EACCES, 'stdout' : '', 'stderr' : str(e) + '\n'}
+
+
+class HandoffRequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Reads one request line, runs it and writes back one response line
+    '''
+
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+        try:
+            argv = self.server.service.parse_request(line)
+        except ValueError:
+            script_log("Invalid request from %s\n" % str(self.client_address))
+            return
+        except RequestDenied as e:
+            script_log("Request from %s denied: %s\n" %
+                       (str(self.client_address), str(e)))
+            self.wfile.write(json.dumps(denied_response(e)).encode('utf-8') +
+                             b'\n')
+            return
+
+        status, out, err = self.server.service.submit(argv)
+        resp = {'status' : status, 'stdout' : out, 'stderr' : err}
+        self.wfile.write(json.dumps(resp).encode('utf-8') + b'\n')
+
+
+class HandoffServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        socketserver.TCPServer.__init__(self, address, HandoffRequestHandler)
+        self.service = service
+
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option("--script",
+                      type="string",
+                      default=DEFAULT_SCRIPT,
+                      help="Handoff script module to serve")
+    parser.add_option("--work-dir",
+                      type="string",
+                      default=WORK_DIR,
+                      help="Directory path to the handoff scripts")
+    parser.add_option("--address",
+                      type="string",
+                      default=DAEMON_ADDRESS,
+                      help="Local address to listen on")
+    parser.add_option("--port",
+                      type="int",
+                      default=DAEMON_PORT,
+                      help="Local port to listen on")
+    parser.add_option("--zapi-pool-size",
+                      type="int",
+                      default=4,
+                      help="Maximum connections per storage array")
+    parser.add_option("--zapi-idle-timeout",
+                      type="int",
+                      default=60,
+                      help="Seconds after which idle array connections close")
+    parser.add_option("--workers",
+                      type="int",
+                      default=8,
+                      help="Maximum number of operations run at a time")
+    parser.add_option("--script-args",
+                      type="string",
+                      default="",
+                      help="Tuning options of the handoff script, "
+                           "e.g. \"--lun-index-ttl 600\"")
+    return parser
+
+
+if __name__ == '__main__':
+    options, argsleft = get_option_parser().parse_args()
+
+    # Handoff scripts are imported from the work dir
+    sys.path.insert(0, options.work_dir)
+    module = importlib.import_module(options.script)
+
+    # Scripts talking to Netapp arrays use pooled connections
+    pool = getattr(module, 'zapi_pool', None)
+    if pool is not None:
+        pool.configure(options.zapi_pool_size, options.zapi_idle_timeout)
+
+    service = HandoffService(module, options.workers, options.work_dir,
+                             shlex.split(options.script_args))
+    server = HandoffServer((options.address, options.port), service)
+    script_log("Serving %s on %s:%d\n" % (options.script, options.address,
+                                          options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,295 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Local index of the luns on a storage array.
+# Maps lun serials to lun paths and back, so that repeated lookups
+# do not need a round trip to the array. The index is filled by a single
+# bulk listing of the luns and expires after a configurable time.
+# The listing can be saved to disk so that it is shared between runs of
+# the handoff scripts. A generation number kept next to the saved listing
+# is bumped whenever the scripts destroy luns, which makes every process
+# ignore the listings saved before that.
+###############################################################################
+import os
+import json
+import time
+import threading
+
+# Bumps of the generation are serialized between the handoff processes
+from file_lock import FileLock
+
+# Seconds after which the index is reloaded from the array, see configure()
+TTL = 300
+
+# A lun missing from a listing of the array made less than this many
+# seconds ago is not listed for again, see LunIndex.reload
+RELIST_INTERVAL = 5
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def configure(ttl=None):
+    '''
+    Sets the time to live of the indexes
+
+    ttl : seconds after which an index is reloaded, 0 disables the index
+    '''
+    global TTL
+    if ttl is not None:
+        TTL = ttl
+
+
+def get_index(server, loader, snapshot_path=None):
+    '''
+    Returns the lun index for the storage array, creating it on first use
+
+    server : storage array connection
+    loader : function returning a list of (serial, path) for all the
+             luns on the array, or None if they could not be listed
+    snapshot_path : file in which the listing is shared between runs
+    '''
+    with _indexes_lock:
+        index = _indexes.get(server)
+        if index is None:
+            index = LunIndex(loader, snapshot_path)
+            _indexes[server] = index
+    return index
+
+
+def snapshot_name(storage_array):
+    '''
+    Returns the file name of the saved listing for the storage array
+    '''
+    safe_name = ''.join(c if c.isalnum() or c in '.-' else '_'
+                        for c in storage_array)
+    return 'lun_index_' + safe_name + '.json'
+
+
+def volume_of(path):
+    '''
+    Returns the volume name of a lun path.
+
+    lun path is of the form
+         /vol/some_vol/lun_name
+    which will split to [ '', 'vol', 'some_vol', 'lun_name' ]
+    '''
+    path_parts = path.split('/')
+    if len(path_parts) < 3:
+        return ''
+    return path_parts[2]
+
+
+class LunIndex(object):
+    '''
+    Bidirectional lun serial <-> lun path index for one storage array.
+
+    Lookups return None when the lun is not in the index, callers are
+    expected to fall back to asking the array and add() the answer.
+    '''
+
+    def __init__(self, loader, snapshot_path=None):
+        self.loader_ = loader
+        self.snapshot_path_ = snapshot_path
+        self.from_snapshot_ = False
+        self.lock_ = threading.Lock()
+        self.refresh_lock_ = threading.Lock()
+        self.by_serial_ = {}
+        self.by_path_ = {}
+        self.loaded_at_ = None
+
+    def is_fresh(self):
+        return (self.loaded_at_ is not None and
+                time.time() - self.loaded_at_ < TTL)
+
+    def generation(self):
+        '''
+        Returns the generation of the saved listing
+        '''
+        try:
+            with open(self.snapshot_path_ + '.gen') as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def bump_generation(self):
+        '''
+        Makes the other processes ignore the saved listing, the update
+        is done under a lock so that concurrent bumps are not lost
+        '''
+        if not self.snapshot_path_:
+            return
+        with FileLock(self.snapshot_path_ + '.gen.lock'):
+            write_file(self.snapshot_path_ + '.gen',
+                       str(self.generation() + 1))
+
+    def load_snapshot(self):
+        '''
+        Returns the saved listing if it is recent and still
+        of the current generation, else None
+        '''
+        if not self.snapshot_path_:
+            return None
+        try:
+            with open(self.snapshot_path_) as f:
+                data = json.load(f)
+            if (data['generation'] != self.generation() or
+                time.time() - data['loaded_at'] >= TTL):
+                return None
+            return data['loaded_at'], data['luns']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save_snapshot(self, generation, loaded_at, luns):
+        if not self.snapshot_path_:
+            return
+        data = {'generation' : generation,
+                'loaded_at' : loaded_at,
+                'luns' : luns}
+        try:
+            write_file(self.snapshot_path_, json.dumps(data))
+        except (IOError, OSError):
+            # Only an optimization, the next run lists the luns again
+            pass
+
+    def refresh(self, use_snapshot=True):
+        '''
+        Reloads the index from the saved listing, or from the array
+        if there is no usable saved listing.
+
+        On failure the index is left empty and reloading is
+        attempted again on the next lookup.
+        '''
+        snapshot = use_snapshot and self.load_snapshot() or None
+        if snapshot is not None:
+            loaded_at, luns = snapshot
+        else:
+            # Read the generation before listing, so that luns destroyed
+            # while we list make the saved listing stale
+            generation = self.generation()
+            loaded_at = time.time()
+            luns = self.loader_()
+            if luns is not None:
+                self.save_snapshot(generation, loaded_at, luns)
+
+        with self.lock_:
+            self.by_serial_ = {}
+            self.by_path_ = {}
+            self.loaded_at_ = None
+            if luns is None:
+                return
+            for serial, path in luns:
+                self.by_serial_[serial] = path
+                self.by_path_[path] = serial
+            self.loaded_at_ = loaded_at
+            self.from_snapshot_ = snapshot is not None
+
+    def reload(self):
+        '''
+        Reloads the index from the array unless it was listed from it
+        less than RELIST_INTERVAL seconds ago.
+
+        Used when a lun is not found in the index, it may have been
+        created since the listing.
+
+        returns True if the index holds a recent listing of the array,
+        False if the index is disabled or the luns could not be listed
+        '''
+        if TTL <= 0:
+            return False
+        with self.refresh_lock_:
+            if (self.from_snapshot_ or self.loaded_at_ is None or
+                time.time() - self.loaded_at_ >= RELIST_INTERVAL):
+                self.refresh(use_snapshot=False)
+            return self.loaded_at_ is not None and not self.from_snapshot_
+
+    def ensure_fresh(self):
+        '''
+        Returns False if the index is disabled
+        '''
+        if TTL <= 0:
+            return False
+        # Only one thread reloads, the others wait for its result
+        with self.refresh_lock_:
+            if not self.is_fresh():
+                self.refresh()
+        return True
+
+    def path_for_serial(self, serial):
+        if not self.ensure_fresh():
+            return None
+        with self.lock_:
+            return self.by_serial_.get(serial)
+
+    def serial_for_path(self, path):
+        if not self.ensure_fresh():
+            return None
+        with self.lock_:
+            return self.by_path_.get(path)
+
+    def add(self, serial, path):
+        '''
+        Records a lun created, or looked up, by the scripts
+        '''
+        if TTL <= 0 or not serial or not path:
+            return
+        with self.lock_:
+            old_path = self.by_serial_.pop(serial, None)
+            if old_path is not None:
+                self.by_path_.pop(old_path, None)
+            old_serial = self.by_path_.pop(path, None)
+            if old_serial is not None:
+                self.by_serial_.pop(old_serial, None)
+            self.by_serial_[serial] = path
+            self.by_path_[path] = serial
+
+    def remove_volume(self, volume):
+        '''
+        Drops all the luns of a volume destroyed by the scripts
+        '''
+        with self.lock_:
+            for path in [p for p in self.by_path_ if volume_of(p) == volume]:
+                serial = self.by_path_.pop(path)
+                self.by_serial_.pop(serial, None)
+        self.bump_generation()
+
+    def invalidate(self):
+        '''
+        Forces a reload from the array on the next lookup
+        '''
+        with self.lock_:
+            self.loaded_at_ = None
+        self.bump_generation()
+
+
+def write_file(path, data):
+    '''
+    Replaces the file contents, readers see either the old
+    or the new contents
+    '''
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
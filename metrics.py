@@ -0,0 +1,293 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Timing of the handoff operations.
+# The steps of an operation (ZAPI calls, VADP runs, script db calls, ...)
+# are timed in spans tagged with the array, the lun serial and the Granite
+# operation. The spans are appended as JSON lines to a rolling metrics file
+# in WORK_DIR, shared by the handoff processes.
+#
+# Run this module to export the metrics file as Prometheus text:
+# metrics.py --work-dir C:\rvbd_handoff_scripts > handoff.prom
+###############################################################################
+import atexit
+import contextlib
+import functools
+import inspect
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+
+# Appends and rotations of the metrics file are serialized between processes
+from file_lock import FileLock
+
+# Defaults, see configure()
+ENABLED = True
+METRICS_FILE = ''
+# The metrics file is rotated to METRICS_FILE.1 at this size
+MAX_BYTES = 10 * 1024 * 1024
+# Spans are written once this many are pending, or after FLUSH_INTERVAL
+FLUSH_RECORDS = 100
+FLUSH_INTERVAL = 5.0
+
+# Upper bounds of the Prometheus histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Tags exported as Prometheus labels, the lun serial is left out by default
+LABELS = ('span', 'operation', 'array', 'api', 'script', 'status')
+
+_pending = []
+_flushed = [time.time()]
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+def configure(work_dir=None, enabled=None):
+    '''
+    Sets the metrics parameters
+
+    work_dir : WORK_DIR of the handoff scripts, the metrics file is in it
+    enabled : record the spans
+    '''
+    global ENABLED, METRICS_FILE
+    if work_dir is not None:
+        METRICS_FILE = work_dir + r'\metrics.log'
+    if enabled is not None:
+        ENABLED = enabled
+
+
+def current_tags():
+    '''
+    Returns the tags set by context() on this thread
+    '''
+    return dict(getattr(_local, 'tags', {}))
+
+
+@contextlib.contextmanager
+def context(**tags):
+    '''
+    Adds tags to the spans recorded by this thread in the with block,
+    e.g. the operation being run
+    '''
+    saved = current_tags()
+    new_tags = dict(saved)
+    new_tags.update((k, v) for k, v in tags.items() if v)
+    _local.tags = new_tags
+    try:
+        yield
+    finally:
+        _local.tags = saved
+
+
+@contextlib.contextmanager
+def span(name, **tags):
+    '''
+    Times the with block
+
+    name : the step, e.g. zapi or vadp_setup
+    tags : e.g. array, serial or api, added to the tags of context()
+
+    The span status is error if the block raised an exception, SystemExit
+    included since the handoff steps exit on errors. The block can set
+    another status with the yielded dict, e.g. for ZAPI failures.
+    '''
+    if not ENABLED:
+        yield {}
+        return
+    record = current_tags()
+    record.update((k, v) for k, v in tags.items() if v is not None)
+    record['span'] = name
+    record['status'] = 'ok'
+    start = time.time()
+    try:
+        yield record
+    except SystemExit as e:
+        if e.code:
+            record['status'] = 'error'
+        raise
+    except BaseException:
+        record['status'] = 'error'
+        raise
+    finally:
+        record['start'] = round(start, 3)
+        record['duration'] = round(time.time() - start, 6)
+        add(record)
+
+
+def timed(name, serial_arg=None):
+    '''
+    Decorator timing each call of a function in a span
+
+    name : the step
+    serial_arg : the argument holding the lun serial, if any
+    '''
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            serial = None
+            if serial_arg:
+                serial = signature.bind(*args, **kwargs).arguments.get(serial_arg)
+            with span(name, serial=serial):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(record):
+    with _lock:
+        _pending.append(record)
+        due = (len(_pending) >= FLUSH_RECORDS or
+               time.time() - _flushed[0] >= FLUSH_INTERVAL)
+    if due:
+        flush()
+
+
+def flush():
+    '''
+    Appends the pending spans to the metrics file
+    '''
+    with _lock:
+        records = _pending[:]
+        del _pending[:]
+        _flushed[0] = time.time()
+    if not records or not METRICS_FILE:
+        return
+    data = ''.join(json.dumps(r, sort_keys=True) + '\n' for r in records)
+    try:
+        with FileLock(METRICS_FILE + '.lock'):
+            if (os.path.exists(METRICS_FILE) and
+                os.path.getsize(METRICS_FILE) + len(data) > MAX_BYTES):
+                os.replace(METRICS_FILE, METRICS_FILE + '.1')
+            with open(METRICS_FILE, 'a') as f:
+                f.write(data)
+    except OSError as e:
+        script_log("Failed to write the metrics file %s: %s\n" %
+                   (METRICS_FILE, str(e)))
+
+
+atexit.register(flush)
+
+
+def read_records(path):
+    '''
+    Returns the spans of the metrics file and of its rotated file
+    '''
+    records = []
+    for name in (path + '.1', path):
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Partly written line
+                    pass
+    return records
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def to_prometheus(records, labels=LABELS):
+    '''
+    Returns the spans as a Prometheus histogram, in the text format
+
+    records : the spans
+    labels : the tags exported as labels
+    '''
+    series = {}
+    for record in records:
+        key = tuple(record.get(label, '') for label in labels)
+        counts = series.setdefault(key, [[0] * len(BUCKETS), 0, 0.0])
+        duration = record.get('duration', 0)
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                counts[0][i] += 1
+        counts[1] += 1
+        counts[2] += duration
+
+    name = 'handoff_span_duration_seconds'
+    lines = ['# HELP %s Duration of the handoff operation steps' % name,
+             '# TYPE %s histogram' % name]
+    for key in sorted(series):
+        buckets, count, total = series[key]
+        label_str = ','.join('%s="%s"' % (label, escape_label(value))
+                             for label, value in zip(labels, key) if value)
+        sep = label_str and ',' or ''
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            lines.append('%s_bucket{%s%sle="%s"} %d' %
+                         (name, label_str, sep, bound, bucket_count))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' %
+                     (name, label_str, sep, count))
+        lines.append('%s_sum{%s} %f' % (name, label_str, total))
+        lines.append('%s_count{%s} %d' % (name, label_str, count))
+    return '\n'.join(lines) + '\n'
+
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option("--work-dir",
+                      type="string",
+                      default=r'C:\rvbd_handoff_scripts',
+                      help="Directory path to the handoff scripts")
+    parser.add_option("--by-lun",
+                      action="store_true",
+                      default=False,
+                      help="Export the lun serial as a label")
+    parser.add_option("--since",
+                      type="float",
+                      default=0,
+                      help="Only export the spans of the last SINCE seconds")
+    return parser
+
+
+if __name__ == '__main__':
+    options, argsleft = get_option_parser().parse_args()
+    configure(options.work_dir)
+    records = read_records(METRICS_FILE)
+    if options.since:
+        oldest = time.time() - options.since
+        records = [r for r in records if r.get('start', 0) >= oldest]
+    labels = LABELS + (('serial',) if options.by_lun else ())
+    sys.stdout.write(to_prometheus(records, labels))
@@ -31,11 +31,18 @@ import optparse
 import sys
 import errno
 import subprocess
+import threading
+import time
+import contextlib
+import zlib
 
 # Script DB is used to store/load the cloned lun
 # information and the credentials
 import script_db
 
+# Credentials are decrypted once and shared by the whole process
+import cred_provider
+
 # For setting up PATH
 import os
 
@@ -44,12 +51,64 @@ import os
 sys.path.append(r"C:\netapp\netapp-manageability-sdk-5.0\lib\python\NetApp")
 from NaServer import *
 
+# Pooled keep-alive connections to the storage array
+import zapi_pool
+
+# Dependent ZAPI calls sent in stages, independent ones at the same time
+import zapi_pipeline
+
+# Local serial <-> path index of the luns on the storage array
+import lun_index
+
+# Parallel proxy backups
+import backup_scheduler
+
+# One VADP script run for the luns mounted at the same time
+import vadp_batch
+
+# In-process VADP operations when pyVmomi is installed
+import vadp_client
+
+# Timing of the operation steps
+import metrics
+
+# Per lun locks shared by the handoff processes
+from file_lock import FileLock
+
 # Paths for VADP scripts
 PERL_EXE = r'"C:\Program Files (x86)\VMware\VMware vSphere CLI\Perl\bin\perl.exe" '
 WORK_DIR =  r'C:\rvbd_handoff_scripts'
 VADP_CLEANUP = WORK_DIR + r'\vadp_cleanup.pl'
 VADP_SETUP = WORK_DIR + r'\vadp_setup.pl'
 
+# Module name of this script, used to start the background backup worker
+SCRIPT_NAME = os.path.splitext(os.path.basename(__file__))[0]
+
+# Set by the handoff service to run the queued proxy backups itself
+BACKUP_WORKER_HOOK = None
+
+# Seconds to wait for another handoff process working on the same lun
+LUN_LOCK_TIMEOUT = 600
+
+# Number of lun lock files in WORK_DIR, the luns are spread over them
+LUN_LOCK_STRIPES = 256
+
+# Clone volumes taken offline and destroyed at the same time by
+# collect_retired_clones
+GC_BATCH = 20
+
+# ZAPI errno of operations on a volume that does not exist
+EVOLUMEDOESNOTEXIST = '13040'
+
+# Initiators of the access groups, see get_initiators
+INITIATORS_TTL = 300
+INITIATORS = {}
+INITIATORS_LOCK = threading.Lock()
+
+# How to reach the storage array ZAPI, see configure_array
+ARRAY_TRANSPORT = 'HTTPS'
+ARRAY_PORT = 443
+
 
 def script_log(msg):
     '''
@@ -72,6 +131,40 @@ def set_script_path(prefix):
     VADP_SETUP = WORK_DIR + r'\vadp_setup.pl'
 
 	
+def list_luns(server):
+    '''
+    Lists all the luns on the array
+
+    server : Netapp hostname/ip address
+
+    returns a list of (serial, path), or None on errors
+    '''
+    api = NaElement("lun-list-info")
+
+    # The luns are parsed as they are received, the whole
+    # listing is never held as one tree
+    stream = server.invoke_stream(api, "lun-info")
+    luns = [(lun.get("serial-number"), lun.get("path")) for lun in stream]
+
+    xo = stream.results()
+    if (xo.results_status() == "failed") :
+        script_log("Error:\n")
+        script_log(xo.sprintf())
+        return None
+
+    return luns
+
+
+def get_lun_index(server):
+    '''
+    Returns the lun index of the array
+
+    server : Netapp hostname/ip address
+    '''
+    snapshot_path = WORK_DIR + '\\' + lun_index.snapshot_name(server.array_name())
+    return lun_index.get_index(server, lambda: list_luns(server), snapshot_path)
+
+
 def get_volume_path(server, serial):
     '''
     Gets the volume for the given lun
@@ -81,20 +174,148 @@ def get_volume_path(server, serial):
 
     returns the lun serial
     '''
+    index = get_lun_index(server)
+    lun_path = index.path_for_serial(serial)
+    if lun_path:
+        return lun_path
+
+    # lun-list-info cannot filter on the serial, so finding a lun that is not
+    # in the index means listing all the luns again. Reload the index with
+    # that listing, unless it was listed from the array moments ago.
+    if index.reload():
+        return index.path_for_serial(serial) or ""
+
+    # No index, or the listing failed: search the luns as they are listed
     api = NaElement("lun-list-info")
 
-    xo = server.invoke_elem(api)
+    # Stop reading the listing at the lun
+    stream = server.invoke_stream(api, "lun-info")
+    for lun in stream:
+        if lun.get("serial-number") == serial:
+            return lun.get("path") or ""
+
+    xo = stream.results()
     if (xo.results_status() == "failed") :
         print ("Error:\n")
         print (xo.sprintf())
         return ""
 
+    return ""
+
+
+def get_volume_paths(server, serials):
+    '''
+    Gets the paths of many luns
+
+    server : Netapp hostname/ip address
+    serials : lun short serials
+
+    returns a dict of lun serial to lun path, the path is empty
+    if the lun was not found
+
+    lun-list-info cannot filter on the serial, the first lun that is
+    not in the index reloads it and the others are found in it.
+    '''
+    lun_paths = {}
+    for serial in serials:
+        if serial not in lun_paths:
+            lun_paths[serial] = get_volume_path(server, serial)
+    return lun_paths
+
+
+def get_lun_serial(server, lun_path):
+    '''
+    Gets the lun serial for the given lun_path
+
+    server : Netapp hostname/ip address
+    lun_path : full lun path
+
+    returns the lun serial
+    '''
+    index = get_lun_index(server)
+    serial = index.serial_for_path(lun_path)
+    if serial:
+        return serial
+
+    # Not in the index, ask the array for this lun only
+    xo = server.invoke_elem(lun_serial_request(lun_path))
+    serial = parse_lun_serial(xo, lun_path)
+    index.add(serial, lun_path)
+    return serial
+
+
+def lun_serial_request(lun_path):
+    '''
+    Returns the request looking up the serial of a lun
+
+    lun_path : full lun path
+    '''
+    api = NaElement("lun-list-info")
+    api.child_add_string("path", lun_path)
+    return api
+
+
+def parse_lun_serial(xo, lun_path):
+    '''
+    Returns the lun serial found in the results of lun_serial_request,
+    an empty string if the lun was not found
+
+    xo : results of the request
+    lun_path : full lun path
+    '''
+    if (xo.results_status() == "failed") :
+        script_log("Error:\n")
+        script_log(xo.sprintf())
+        return ""
+
     luns = xo.child_get("luns")
-    for luns in luns.children_get():
-        if luns.child_get_string("serial-number") == serial:
-            return luns.child_get_string("path")
+    serial = ''
+    for lun in luns.children_get():
+        if lun.child_get_string("path") == lun_path:
+             serial = lun.child_get_string("serial-number")
+             break
+    return serial
+
+
+def get_initiators(server, access_group):
+    '''
+    Gets the initiators of an initiator group. The VADP scripts only
+    rescan the proxy host adapters with these names.
+
+    server : Netapp hostname/ip address
+    access_group : initiator group
+
+    returns the initiator names, empty if they could not be listed
+    '''
+    if not access_group:
+        return []
+
+    key = (server.array_name(), access_group)
+    with INITIATORS_LOCK:
+        cached = INITIATORS.get(key)
+    if cached and time.time() - cached[0] < INITIATORS_TTL:
+        return cached[1]
+
+    api = NaElement("igroup-list-info")
+    api.child_add_string("initiator-group-name", access_group)
+
+    xo = server.invoke_elem(api)
+    if (xo.results_status() == "failed") :
+        script_log("Error:\n")
+        script_log(xo.sprintf())
+        return []
+
+    groups = xo.child_get("initiator-groups")
+    initiators = []
+    for group in groups and groups.children_get() or []:
+        names = group.child_get("initiators")
+        for initiator in names and names.children_get() or []:
+            initiators.append(initiator.child_get_string("initiator-name"))
+
+    with INITIATORS_LOCK:
+        INITIATORS[key] = (time.time(), initiators)
+    return initiators
 
-    return ""
 
 def check_lun(server, serial):
     '''
@@ -115,54 +336,179 @@ def check_lun(server, serial):
     sys.exit(0)
 
 
-def snap_operation(server, op, serial, snap_name):
+def lun_lock_path(serial):
     '''
-    Performs a snapshot operation
+    Returns the lock file of the lun
 
-    server : Netapp hostname/ip address
-    op : snapshot-create/snapshot-delete
     serial : lun serial
-    snap_name : the snapshot name
 
-    Exits the process with non-zero error if it fails
-    to create a snap
+    The luns share a fixed set of lock files, so that they do not pile
+    up in WORK_DIR as luns come and go. Luns sharing a lock file are
+    serialized as if they were the same lun.
     '''
+    stripe = zlib.crc32(serial.encode('utf-8')) % LUN_LOCK_STRIPES
+    return WORK_DIR + r'\lun_lock_%03d.lock' % stripe
 
-    # Convert lun serial to lun path
-    lun_path = get_volume_path(server, serial)
-    if len(lun_path) == 0:
-        print ("Lun %s not found" % (serial))
-        sys.exit(1)
 
-    # lun path is of the form
-    #      /vol/some_vol/lun_name
-    # which will split to [ '', 'vol', 'some_vol', 'lun_name' ]
-    path_parts = lun_path.split('/')
-    if len(path_parts) < 3:
-        print ("Could not find volume for path %s" % lun_path)
-        sys.exit(1)
+def lun_lock_file(serial):
+    '''
+    Returns the lock of the lun used by lun_lock, not acquired
 
-    if len(snap_name) == 0:
-        print ("Empty snapshot name")
-        sys.exit(1)
+    serial : lun serial
+    '''
+    return FileLock(lun_lock_path(serial))
 
-    # For Netapp, we take snapshot for the entire volume
-    # on which the lun resides
-    volume = path_parts[2]
+
+@contextlib.contextmanager
+def lun_lock(serial, exit_code):
+    '''
+    Serializes the work on the clone of a lun between the threads and
+    processes of the handoff scripts, work on other luns is not blocked.
+
+    serial : lun serial
+    exit_code : exit code of the process if the lock cannot be taken
+    '''
+    lock = lun_lock_file(serial)
+    if not lock.acquire(timeout=LUN_LOCK_TIMEOUT):
+        script_log("Timed out waiting for another operation on lun %s" %
+                   serial)
+        sys.exit(exit_code)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def group_snap_requests(lun_paths, snap_requests):
+    '''
+    Groups the snapshot requests of many luns by volume
+
+    lun_paths : dict of lun serial to lun path, see get_volume_paths
+    snap_requests : list of (lun serial, snapshot name)
+
+    returns a tuple of (dict of lun serial to error message for the
+    requests that cannot be run, dict of (volume, snapshot name) to
+    the lun serials of the other requests)
+    '''
+    errors = {}
+    volume_snaps = {}
+    for serial, snap_name in snap_requests:
+        lun_path = lun_paths[serial]
+        if len(lun_path) == 0:
+            errors[serial] = "Lun %s not found" % (serial)
+            continue
+
+        # lun path is of the form
+        #      /vol/some_vol/lun_name
+        # which will split to [ '', 'vol', 'some_vol', 'lun_name' ]
+        volume = lun_index.volume_of(lun_path)
+        if not volume:
+            errors[serial] = "Could not find volume for path %s" % lun_path
+            continue
+
+        if len(snap_name) == 0:
+            errors[serial] = "Empty snapshot name"
+            continue
+
+        volume_snaps.setdefault((volume, snap_name), []).append(serial)
+    return errors, volume_snaps
+
+
+def snap_request(op, volume, snap_name):
+    '''
+    Returns the request of a snapshot operation on a volume
+
+    op : snapshot-create/snapshot-delete
+    '''
     api = NaElement(op)
     api.child_add_string("snapshot", snap_name)
     api.child_add_string("volume", volume)
-    xo1 = server.invoke_elem(api)
+    return api
 
-    if (xo1.results_status() == "failed" and\
-        xo1.results_reason().find("copy name already exists") == -1) :
-        print ("Error:\n")
-        print (xo1.sprintf())
-        sys.exit (1)
+
+def snap_exists(xo):
+    '''
+    Returns True if the snapshot operation failed because the snapshot
+    already exists, it is then considered done
+    '''
+    return xo.results_reason().find("copy name already exists") != -1
+
+
+def snap_error(server, xo):
+    '''
+    Returns the error message of a failed snapshot operation
+
+    server : Netapp hostname/ip address
+    xo : results of the operation
+    '''
+    # The lun may have moved since it was indexed
+    get_lun_index(server).invalidate()
+    return "Error:\n\n" + xo.sprintf()
+
+
+@metrics.timed('batch_snap_operation')
+def batch_snap_operation(server, op, snap_requests):
+    '''
+    Performs a snapshot operation for many luns
+
+    server : Netapp hostname/ip address
+    op : snapshot-create/snapshot-delete
+    snap_requests : list of (lun serial, snapshot name)
+
+    For Netapp, we take snapshot for the entire volume on which
+    the lun resides, so the operation is issued once for all the
+    luns on the same volume with the same snapshot name.
+
+    returns a dict of lun serial to error message, the error message
+    is empty if the operation succeeded for the lun
+    '''
+    # Convert lun serials to lun paths
+    lun_paths = get_volume_paths(server, [serial for serial, snap_name
+                                          in snap_requests])
+    results, volume_snaps = group_snap_requests(lun_paths, snap_requests)
+
+    # The operations on different volumes are sent at the same time
+    pipeline = zapi_pipeline.ZapiPipeline(server)
+    calls = {}
+    for volume, snap_name in volume_snaps:
+        calls[(volume, snap_name)] = pipeline.add(
+            snap_request(op, volume, snap_name), allow=snap_exists)
+    pipeline.run()
+
+    for (volume, snap_name), serials in volume_snaps.items():
+        error = ''
+        call = calls[(volume, snap_name)]
+        if call.failed():
+            error = snap_error(server, call.results())
+
+        for serial in serials:
+            results[serial] = error
+
+    return results
+
+
+@metrics.timed('snap_operation', 'serial')
+def snap_operation(server, op, serial, snap_name):
+    '''
+    Performs a snapshot operation
+
+    server : Netapp hostname/ip address
+    op : snapshot-create/snapshot-delete
+    serial : lun serial
+    snap_name : the snapshot name
+
+    Exits the process with non-zero error if it fails
+    to create a snap
+    '''
+    results = batch_snap_operation(server, op, [(serial, snap_name)])
+    if results[serial]:
+        print (results[serial])
+        sys.exit(1)
 
 
 def create_snap(cdb, sdb, server, serial, snap_name, 
-                access_group, proxy_host, category, protect_category):
+                access_group, proxy_host, category, protect_category,
+                async_backup=False):
     '''
     Creates a snapshot
 
@@ -175,6 +521,7 @@ def create_snap(cdb, sdb, server, serial, snap_name,
     proxy_host : the host on which clone lun is mounted
     category : snapshot category
     protect_category : the snapshot category for which proxy backup is run
+    async_backup : queue the proxy backup instead of running it
 
     Prints the snapshot name on the output if successful
     and exits the process.
@@ -191,14 +538,290 @@ def create_snap(cdb, sdb, server, serial, snap_name,
     # Run proxy backup on this snapshot if its category matches
     # protected snapshot category
     if category == protect_category:
+        protect_snap(cdb, sdb, server, serial, snap_name, access_group,
+                     proxy_host, async_backup)
+
+
+def protect_snap(cdb, sdb, server, serial, snap_name, access_group,
+                 proxy_host, async_backup=False):
+    '''
+    Runs the proxy backup of a snapshot of the protected category
+
+    cdb : credentials db
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    serial : lun serial
+    snap_name : the snapshot name
+    access_group : the initiator group to which cloned lun is mapped
+    proxy_host : the host on which clone lun is mounted
+    async_backup : queue the proxy backup instead of running it
+    '''
+    if async_backup:
+        queue_proxy_backup(sdb, server, serial, snap_name,
+                           access_group, proxy_host)
+        start_backup_worker()
+    else:
+        run_proxy_backup(cdb, sdb, server, serial, snap_name,
+                         access_group, proxy_host)
+        start_clone_collection(sdb)
+
+
+def create_snaps(cdb, sdb, server, serials, snap_names,
+                 access_group, proxy_host, category, protect_category,
+                 async_backup=False):
+    '''
+    Creates snapshots of many luns
+
+    cdb : credentials db
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    serials : lun serials
+    snap_names : the snapshot names, one for all the luns or one per lun
+    access_group : the initiator group to which cloned luns are mapped
+    proxy_host : the host on which clone luns are mounted
+    category : snapshot category
+    protect_category : the snapshot category for which proxy backup is run
+    async_backup : queue the proxy backups instead of running them
+
+    Prints one line per lun, with the snapshot name if successful
+    or the error otherwise, then exits the process with non-zero
+    error code if any snapshot failed.
+    '''
+    if len(snap_names) == 1:
+        snap_names = snap_names * len(serials)
+    if len(snap_names) != len(serials):
+        print ("Got %d snapshot names for %d luns" %
+               (len(snap_names), len(serials)))
+        sys.exit(errno.EINVAL)
+
+    snap_requests = list(zip(serials, snap_names))
+    results = batch_snap_operation(server, "snapshot-create", snap_requests)
+
+    failed = False
+    for serial, snap_name in snap_requests:
+        if results[serial]:
+            failed = True
+            print ("%s FAILED %s" % (serial, results[serial].replace('\n', ' ')))
+        else:
+            print ("%s %s" % (serial, snap_name))
+
+    if category == protect_category and async_backup:
+        for serial, snap_name in snap_requests:
+            if not results[serial]:
+                queue_proxy_backup(sdb, server, serial, snap_name,
+                                   access_group, proxy_host)
+        start_backup_worker()
+    elif category == protect_category:
+        # Proxy backup errors are logged and do not fail the snapshots
+        scheduler = backup_scheduler.BackupScheduler()
+        for serial, snap_name in snap_requests:
+            if not results[serial]:
+                scheduler.submit(serial, run_proxy_backup_job, server,
+                                 serial, snap_name, access_group, proxy_host)
+        scheduler.shutdown()
+        start_clone_collection(sdb)
+
+    sys.exit(failed and 1 or 0)
+
+
+@metrics.timed('run_proxy_backup', 'serial')
+def run_proxy_backup(cdb, sdb, server, serial, snap_name,
+                     access_group, proxy_host):
+    '''
+    Replaces the cloned lun mounted on the proxy host with
+    a clone of the given snapshot
+
+    cdb : credentials db
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    serial : lun serial
+    snap_name : the snapshot name
+    access_group : the initiator group to which cloned lun is mapped
+    proxy_host : the host on which clone lun is mounted
+
+    returns True if the cloned lun was mounted on the proxy host
+
+    The array and proxy host steps hold a slot of the array and
+    of the proxy host, see backup_scheduler. The whole backup holds
+    the lock of the lun.
+
+    The replaced clone is only retired, it is destroyed later by
+    collect_retired_clones.
+
+    If the recorded clone of the lun is already a clone of the snapshot
+    for the access group (e.g. a retried CREATE_SNAP), it is kept and
+    only mounted if it is not mounted on the proxy host yet.
+    '''
+    with lun_lock(serial, 0):
+        clone_serial = find_reusable_clone(sdb, server, serial, snap_name,
+                                           access_group)
+        if clone_serial:
+            mounted_on, mounted = sdb.get_clone_mount(serial)
+            if mounted and mounted_on == proxy_host:
+                script_log("Clone %s of %s is already mounted on %s" %
+                           (clone_serial, snap_name, proxy_host))
+                return True
+            script_log("Reusing clone %s of %s" % (clone_serial, snap_name))
+            # A failed mount on the same host is simply retried
+            if mounted_on != proxy_host:
+                unmount_proxy_backup(cdb, sdb, serial, proxy_host,
+                                     get_initiators(server, access_group))
+            return mount_clone(cdb, sdb, server, serial, clone_serial,
+                               snap_name, access_group, proxy_host)
+
         # Un-mount the previously mounted cloned lun from proxy host
-        unmount_proxy_backup(cdb, sdb, serial, proxy_host)
-        # Delete the cloned snapshot
-        delete_cloned_lun(cdb, sdb, server, serial)
-        # Create a cloned snapshot lun form the snapshot
-        cloned_lun_serial = create_snap_clone(cdb, sdb, server, serial, snap_name, access_group)
+        clone_serial, clone_snap, clone_group = sdb.get_clone_info(serial)
+        unmount_proxy_backup(cdb, sdb, serial, proxy_host,
+                             get_initiators(server, clone_group))
+        # The replaced clone is destroyed in the background
+        retire_cloned_lun(sdb, server, serial)
+        with backup_scheduler.array_slot(server.array_name()):
+            # Create a cloned snapshot lun form the snapshot
+            cloned_lun_serial = create_snap_clone(cdb, sdb, server, serial,
+                                                  snap_name, access_group)
         # Mount the snapshot on the proxy host
-        mount_proxy_backup(cdb, sdb, cloned_lun_serial, snap_name, access_group, proxy_host)        
+        return mount_clone(cdb, sdb, server, serial, cloned_lun_serial,
+                           snap_name, access_group, proxy_host)
+
+
+def find_reusable_clone(sdb, server, serial, snap_name, access_group):
+    '''
+    Returns the serial of the recorded clone of the lun if it is a clone
+    of the snapshot mapped to the access group and is still on the array,
+    an empty string otherwise
+
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    serial : lun serial
+    snap_name : the snapshot name
+    access_group : the initiator group to which cloned lun is mapped
+
+    A snapshot cannot be deleted while a volume clone uses it, so
+    a clone of a snapshot with this name is a clone of this snapshot.
+    '''
+    clone_serial, clone_snap, clone_group = sdb.get_clone_info(serial)
+    if not clone_serial or clone_snap != snap_name or \
+       clone_group != access_group:
+        return ''
+    if not get_volume_path(server, clone_serial):
+        script_log("Clone %s is not on the array anymore" % clone_serial)
+        return ''
+    return clone_serial
+
+
+def mount_clone(cdb, sdb, server, serial, clone_serial, snap_name,
+                access_group, proxy_host):
+    '''
+    Mounts the clone of the lun on the proxy host and records it
+
+    cdb : credentials db
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    serial : lun serial
+    clone_serial : the lun serial of the cloned snapshot lun
+    snap_name : the snapshot name
+    access_group : the initiator group to which cloned lun is mapped
+    proxy_host : the host on which clone lun is mounted
+
+    returns True if the cloned lun was mounted
+    '''
+    # Recorded first, a failed mount is cleaned up on this host
+    sdb.set_clone_mount(serial, clone_serial, proxy_host, False)
+    mounted = mount_proxy_backup(cdb, sdb, clone_serial, snap_name,
+                                 access_group, proxy_host,
+                                 get_initiators(server, access_group))
+    if mounted:
+        sdb.set_clone_mount(serial, clone_serial, proxy_host, True)
+    return mounted
+
+
+def run_proxy_backup_job(server, serial, snap_name, access_group, proxy_host):
+    '''
+    Runs a proxy backup on a backup_scheduler thread.
+
+    sqlite connections cannot be shared between threads, the job
+    uses its own script db connection. Credentials come from the
+    provider shared by the process.
+    '''
+    cdb = cred_provider.get_provider(WORK_DIR + r'\cred_db')
+    sdb = script_db.ScriptDB(WORK_DIR + r'\script_db')
+    try:
+        return run_proxy_backup(cdb, sdb, server, serial, snap_name,
+                                access_group, proxy_host)
+    finally:
+        sdb.close()
+        cdb.close()
+
+
+def queue_proxy_backup(sdb, server, serial, snap_name,
+                       access_group, proxy_host):
+    '''
+    Queues the proxy backup of a snapshot for the backup worker
+
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    serial : lun serial
+    snap_name : the snapshot name
+    access_group : the initiator group to which cloned lun is mapped
+    proxy_host : the host on which clone lun is mounted
+    '''
+    job_id = sdb.insert_backup_job(serial, snap_name, access_group,
+                                   proxy_host, server.array_name())
+    script_log("Queued proxy backup job %d for %s" % (job_id, snap_name))
+
+
+def start_backup_worker():
+    '''
+    Starts the backup worker in the background.
+
+    The worker is detached from this process, so that Granite Core
+    gets its answer without waiting for the proxy backups. Starting
+    a worker while one is running is harmless, it exits right away.
+    '''
+    if BACKUP_WORKER_HOOK:
+        BACKUP_WORKER_HOOK()
+        return
+
+    cmd = [sys.executable, WORK_DIR + r'\backup_worker.py',
+           '--work-dir', WORK_DIR, '--script', SCRIPT_NAME,
+           '--backup-workers', str(backup_scheduler.WORKERS),
+           '--array-limit', str(backup_scheduler.ARRAY_LIMIT),
+           '--host-limit', str(backup_scheduler.HOST_LIMIT),
+           '--vadp-batch-window', str(vadp_batch.BACKUP_WINDOW),
+           '--vadp-engine', vadp_client.ENGINE,
+           '--vadp-discovery-timeout', str(vadp_client.DISCOVERY_DEADLINE),
+           '--array-transport', ARRAY_TRANSPORT,
+           '--array-port', str(ARRAY_PORT)]
+    if not metrics.ENABLED:
+        cmd.append('--no-metrics')
+    kwargs = {}
+    if os.name == 'nt':
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        kwargs['creationflags'] = 0x00000008 | 0x00000200
+    else:
+        kwargs['start_new_session'] = True
+
+    log = open(WORK_DIR + r'\backup_worker.log', 'a')
+    try:
+        subprocess.Popen(cmd,
+                         stdin = subprocess.DEVNULL,
+                         stdout = log,
+                         stderr = log,
+                         **kwargs)
+    except OSError as e:
+        script_log("Failed to start the backup worker: " + str(e))
+    log.close()
+
+
+def start_clone_collection(sdb):
+    '''
+    Starts the backup worker if retired clones are waiting to be
+    destroyed, the worker destroys them after the queued backups
+
+    sdb : script db
+    '''
+    if sdb.count_retired_clones():
+        start_backup_worker()
 
 
 def remove_snap(cdb, sdb, server, serial, snap_name, proxy_host):
@@ -219,20 +842,48 @@ def remove_snap(cdb, sdb, server, serial, snap_name, proxy_host):
     the cloned snapshot lun and then remove the snapshot.
     '''
 
+    # Do not back up a snapshot that is going away
+    sdb.cancel_backup_jobs(serial, snap_name)
+
+    # Wait for a proxy backup of the lun running in another process
+    with lun_lock(serial, errno.EBUSY):
+        remove_snap_clones(cdb, sdb, server, serial, snap_name, proxy_host)
+
+        # Remove the snapshot from the storage array
+        snap_operation(server, "snapshot-delete", serial, snap_name)
+    sys.exit(0)
+
+
+def remove_snap_clones(cdb, sdb, server, serial, snap_name, proxy_host):
+    '''
+    Destroys the clones of a snapshot that is being removed, they
+    would keep it busy
+
+    cdb : credentials db
+    sdb : script db
+    server : Netapp hostname/ip address
+    serial : lun serial
+    snap_name : the snapshot name
+    proxy_host : proxy host
+
+    The caller holds the lock of the lun.
+    '''
     clone_serial, protected_snap, group = sdb.get_clone_info(serial)
- 
+
     # Check if we are removing a protected snapshot
     if protected_snap == snap_name:
         # Deleting a protected snap. Un-mount the clone from the proxy host
-        unmount_proxy_backup(cdb, sdb, serial, proxy_host)
+        unmount_proxy_backup(cdb, sdb, serial, proxy_host,
+                             get_initiators(server, group))
         # Delete the snapshot cloned lun
         delete_cloned_lun(cdb, sdb, server, serial)
- 
-    # Remove the snapshot from the storage array
-    snap_operation(server, "snapshot-delete", serial, snap_name)
-    sys.exit(0)
+
+    # Retired clones of the snapshot would keep it busy
+    collect_retired_clones(sdb, server, snap_name=snap_name,
+                           locked_lun=serial)
 
 
+@metrics.timed('create_snap_clone', 'serial')
 def create_snap_clone(cdb, sdb, server, serial, snap_name, access_group):
     '''
     Creates a lun out of a snapshot
@@ -270,67 +921,67 @@ def create_snap_clone(cdb, sdb, server, serial, snap_name, access_group):
     volume = path_parts[2]
     # Clone volume name is the name we want to give to the newly cloned volume
     clone_volume_name = (volume + "_" + snap_name).replace('-', '_')
+
+    # A retired clone of the same snapshot still holds the name
+    collect_retired_clones(sdb, server, clone_volume=clone_volume_name,
+                           locked_lun=serial)
+
+    # Record the clone before creating it, if we fail before the end
+    # the next run finds the clone volume and destroys it
+    sdb.begin_clone(serial, snap_name, access_group, clone_volume_name)
+
+    # The clone volume has the same luns as the original volume
+    # Old volume : /vol/old_volume_name/lun_name
+    # New volume : /vol/new_volume_name/lun_name
+    cloned_lun_path = "/vol/" + clone_volume_name + "/" + path_parts[3]
+    pipeline = zapi_pipeline.ZapiPipeline(server)
+
     api = NaElement("volume-clone-create")
     api.child_add_string("parent-snapshot", snap_name)
     api.child_add_string("parent-volume", volume)
     api.child_add_string("space-reserve","none")
     api.child_add_string("volume", clone_volume_name)
-    xo = server.invoke_elem(api)
-    if (xo.results_status() == "failed") :
-        script_log("Error:\n")
-        script_log(xo.sprintf())
-        sys.exit (0)
+    clone_call = pipeline.add(api)
 
-    # Clone created successfully. Now expose this lun
-    # to the access_group. access_group is the initiator group
-    # to which your Proxy ESXi must be mapped.
-    # Old volume : /vol/old_volume_name/lun_name
-    # New volume : /vol/new_volume_name/lun_name
-    cloned_lun_path = "/vol/" + clone_volume_name + "/" + path_parts[3]
+    # Once the clone is created, expose this lun to the access_group.
+    # access_group is the initiator group to which your Proxy ESXi
+    # must be mapped. The map, online and serial lookup of the lun do
+    # not depend on each other, they are sent at the same time.
+    pipeline.then()
     api = NaElement("lun-map")
     api.child_add_string("initiator-group", access_group)
     api.child_add_string("path", cloned_lun_path)
+    pipeline.add(api)
 
-    xo = server.invoke_elem(api)
-    if (xo.results_status() == "failed") :
-        script_log("Error:\n")
-        script_log(xo.sprintf())
-        sys.exit (0)
-    
-    # Finally set the lun online
+    # Set the lun online
     api = NaElement("lun-online")
     api.child_add_string("path", cloned_lun_path)
+    pipeline.add(api)
 
-    xo = server.invoke_elem(api)
-    if (xo.results_status() == "failed") :
-        script_log("Error:\n")
-        script_log(xo.sprintf())
-        sys.exit (0)
+    # Get the cloned lun serial, it is left empty if the lookup fails
+    serial_call = pipeline.add(lun_serial_request(cloned_lun_path),
+                               allow=zapi_pipeline.any_error)
 
-    # Get the cloned lun serial
-    api = NaElement("lun-list-info")
-    api.child_add_string("path", cloned_lun_path)
-    xo = server.invoke_elem(api)
-    if (xo.results_status() == "failed") :
-        script_log("Error:\n")
-        script_log(xo.sprintf())
+    if not pipeline.run():
+        pipeline.log_errors(script_log)
+        if clone_call.failed():
+            # No clone was created
+            sdb.delete_clone_info(serial, '')
         sys.exit (0)
 
-    luns = xo.child_get("luns")
-    cloned_lun_serial = ''
-    for lun in luns.children_get():
-        if lun.child_get_string("path") == cloned_lun_path:
-             cloned_lun_serial = lun.child_get_string("serial-number")
-             break
-
+    cloned_lun_serial = parse_lun_serial(serial_call.results(),
+                                         cloned_lun_path)
+    get_lun_index(server).add(cloned_lun_serial, cloned_lun_path)
     script_log("Cloned serial is " + cloned_lun_serial)
     # Store this information in a local database. 
     # This is needed because when you are running cleanup,
     # the script must find out which cloned lun needs to me un-mapped.
-    sdb.insert_clone_info(serial, cloned_lun_serial, snap_name, access_group)
+    sdb.insert_clone_info(serial, cloned_lun_serial, snap_name, access_group,
+                          clone_volume_name)
     return cloned_lun_serial        
 
  
+@metrics.timed('delete_cloned_lun', 'lun_serial')
 def delete_cloned_lun(cdb, sdb, server, lun_serial):
     '''
     For the given serial, finds the last cloned lun
@@ -341,35 +992,50 @@ def delete_cloned_lun(cdb, sdb, server, lun_serial):
     cdb : credentials db
     sdb : script db
     lun_serial : the lun serial for which we find the last cloned lun
+
+    The clone record is only deleted once the clone is gone, if we fail
+    the next run tries again.
     '''
     clone_serial, snap_name, group = sdb.get_clone_info(lun_serial)
+    clone_volume = sdb.get_clone_volume(lun_serial)
     script_log("Deleting cloned lun with serial " + clone_serial)
-    sdb.delete_clone_info(lun_serial)
 
-    if not clone_serial:
-         script_log("No clone serial found, returning")
-         return
-
-    # Get the cloned lun path
-    lun_path = get_volume_path(server, clone_serial)
-    if len(lun_path) == 0:
-        script_log("Lun %s not found" % (clone_serial))
-        return
-
-    # lun path is of the form
-    #      /vol/some_vol/lun_name
-    # which will split to [ '', 'vol', 'some_vol', 'lun_name' ]
-    path_parts = lun_path.split('/')
-    if len(path_parts) < 3:
-        script_log("Could not find volume for path %s" % lun_path)
+    if clone_serial:
+        # Get the cloned lun path
+        lun_path = get_volume_path(server, clone_serial)
+        if len(lun_path) == 0:
+            script_log("Lun %s not found" % (clone_serial))
+            sdb.delete_clone_info(lun_serial, clone_serial)
+            return
+
+        # lun path is of the form
+        #      /vol/some_vol/lun_name
+        # which will split to [ '', 'vol', 'some_vol', 'lun_name' ]
+        path_parts = lun_path.split('/')
+        if len(path_parts) < 3:
+            script_log("Could not find volume for path %s" % lun_path)
+            sdb.delete_clone_info(lun_serial, clone_serial)
+            return
+        volume_name = path_parts[2]
+    elif clone_volume:
+        # The creation of this clone did not complete
+        script_log("Found incomplete clone volume " + clone_volume)
+        volume_name = clone_volume
+    else:
+        script_log("No clone serial found, returning")
+        sdb.delete_clone_info(lun_serial, clone_serial)
         return
-    volume_name = path_parts[2]
  
     # offline the lun    
     api = NaElement("volume-offline")
     api.child_add_string("name", volume_name)
 
     xo = server.invoke_elem(api)
+    if (xo.results_status() == "failed" and
+        xo.results_errno() == EVOLUMEDOESNOTEXIST and not clone_serial):
+        script_log("Clone volume %s was never created" % volume_name)
+        sdb.delete_clone_info(lun_serial, clone_serial)
+        return
     if (xo.results_status() == "failed") :
         script_log("Error:\n")
         script_log(xo.sprintf())
@@ -385,11 +1051,246 @@ def delete_cloned_lun(cdb, sdb, server, lun_serial):
         script_log(xo.sprintf())
         sys.exit(0)		
 
+    get_lun_index(server).remove_volume(volume_name)
+    sdb.delete_clone_info(lun_serial, clone_serial)
     script_log("Cloned lun %s deleted successfully" % clone_serial)
 
 
+def retire_cloned_lun(sdb, server, lun_serial):
+    '''
+    Leaves the lun without a clone, its last clone is destroyed
+    later by collect_retired_clones
+
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    lun_serial : the lun serial for which we retire the last cloned lun
+
+    The clone must be unmounted from the proxy host.
+    '''
+    if sdb.retire_clone(lun_serial, server.array_name()):
+        script_log("Retired the clone of lun %s" % lun_serial)
+
+
+@metrics.timed('collect_retired_clones')
+def collect_retired_clones(sdb, server, snap_name=None, clone_volume=None,
+                           locked_lun=None):
+    '''
+    Destroys the clones retired by retire_cloned_lun, GC_BATCH
+    clone volumes at a time
+
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    snap_name : only the clones of the snapshots with this name
+    clone_volume : only the clones in the volume with this name
+    locked_lun : lun whose lock the caller already holds, the luns
+                 sharing its lock file are not locked again
+
+    The clones of luns locked by another operation are left for
+    a later pass.
+
+    returns the number of retired clones left on the array
+    '''
+    clones = sdb.get_retired_clones(server.array_name(), snap_name,
+                                    clone_volume)
+    left = 0
+    for start in range(0, len(clones), GC_BATCH):
+        locks = []
+        volumes = []
+        try:
+            for clone_id, lun, clone, volume in clones[start:start + GC_BATCH]:
+                if (locked_lun is None or
+                    lun_lock_path(lun) != lun_lock_path(locked_lun)):
+                    lock = lun_lock_file(lun)
+                    if not lock.acquire(blocking=False):
+                        left += 1
+                        continue
+                    locks.append(lock)
+                # Another pass may have destroyed it meanwhile
+                if not sdb.is_retired_clone(clone_id):
+                    continue
+                if not volume:
+                    path_parts = get_volume_path(server, clone).split('/')
+                    volume = len(path_parts) > 2 and path_parts[2] or ''
+                if volume:
+                    volumes.append((clone_id, volume))
+                else:
+                    script_log("Lun %s not found" % clone)
+                    sdb.delete_retired_clone(clone_id)
+            left += destroy_clone_volumes(sdb, server, volumes)
+        finally:
+            for lock in locks:
+                lock.release()
+    return left
+
+
+def destroy_clone_volumes(sdb, server, volumes):
+    '''
+    Takes the clone volumes offline and destroys them, the calls
+    of each step are sent at the same time
+
+    sdb : script db
+    server : Netapp hostname/ip address connection
+    volumes : list of (retired clone id, clone volume name)
+
+    returns the number of clone volumes that were not destroyed
+    '''
+    if not volumes:
+        return 0
+
+    pipeline = zapi_pipeline.ZapiPipeline(server)
+    # A volume left offline by an earlier pass fails to go offline
+    # again, the errors that matter are reported by volume-destroy
+    for clone_id, volume in volumes:
+        api = NaElement("volume-offline")
+        api.child_add_string("name", volume)
+        pipeline.add(api, allow=zapi_pipeline.any_error)
+
+    pipeline.then()
+    calls = []
+    for clone_id, volume in volumes:
+        api = NaElement("volume-destroy")
+        api.child_add_string("name", volume)
+        calls.append(pipeline.add(api, allow=lambda xo:
+                                  xo.results_errno() == EVOLUMEDOESNOTEXIST))
+    pipeline.run()
+    pipeline.log_errors(script_log)
+
+    left = 0
+    for (clone_id, volume), call in zip(volumes, calls):
+        if call.failed():
+            left += 1
+            continue
+        get_lun_index(server).remove_volume(volume)
+        sdb.delete_retired_clone(clone_id)
+        script_log("Clone volume %s destroyed" % volume)
+    return left
+
+
+def get_session_file(proxy_host):
+    '''
+    Returns the file in which the VADP scripts keep their session
+    with the proxy host, so that they do not log in on every run
+    '''
+    safe_name = ''.join(c if c.isalnum() or c in '.-' else '_'
+                        for c in proxy_host)
+    return WORK_DIR + r'\vsphere_session_' + safe_name
+
+
+def run_vadp_script(script, proxy_host, username, password, serials,
+                    initiators):
+    '''
+    Runs a VADP script for the cloned luns
+
+    script : VADP_SETUP or VADP_CLEANUP
+    proxy_host : the ESX proxy host
+    username, password : proxy host credentials
+    serials : the cloned lun serials
+    initiators : the initiators to which the luns are mapped
+
+    returns a dict of serial -> error message, empty on success
+
+    The credentials are passed in the environment variables read by the
+    vSphere SDK, they are only used when the saved session has expired.
+    The script holds a slot of the proxy host while it runs, see
+    backup_scheduler. vadp_setup.pl reports each lun on a
+    "LUN: serial SUCCESS" or "LUN: serial FAILURE - reason" line,
+    luns without such a line get the status of the whole run.
+    '''
+    # Create the command to be run
+    cmd = ('%s "%s" --server %s --session_file "%s" --work_dir "%s"'
+           ' --discovery_timeout %d --luns %s' %\
+           (PERL_EXE, script, proxy_host, get_session_file(proxy_host),
+            vadp_client.LOCK_DIR, vadp_client.DISCOVERY_DEADLINE,
+            ','.join(serials)))
+    if initiators:
+        cmd += ' --initiators %s' % ','.join(initiators)
+    env = dict(os.environ)
+    env['VI_USERNAME'] = username
+    env['VI_PASSWORD'] = password
+
+    script_log("Command is: " + cmd)
+    with backup_scheduler.host_slot(proxy_host), \
+         metrics.span('vadp_script', script=os.path.basename(script),
+                      proxy_host=proxy_host, luns=len(serials)):
+        proc = subprocess.Popen(cmd,
+                                env = env,
+                                stdin = subprocess.PIPE,
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+        out, err = proc.communicate()
+        status = proc.wait()
+
+    return parse_vadp_output(serials, status, out, err)
+
+
+def parse_vadp_output(serials, status, out, err):
+    '''
+    Returns the dict of serial -> error message of a VADP script run
+
+    serials : the cloned lun serials
+    status : exit status of the script
+    out, err : output of the script, as bytes
+    '''
+    out = out.decode('utf-8', 'replace')
+    err = err.decode('utf-8', 'replace').strip()
+    run_error = status and (err or 'exit status %d' % status) or ''
+    results = dict((serial, run_error) for serial in serials)
+    for line in out.splitlines():
+        parts = line.strip().split(None, 3)
+        if len(parts) < 3 or parts[0] != 'LUN:' or parts[1] not in results:
+            continue
+        if parts[2] == 'SUCCESS':
+            results[parts[1]] = ''
+        else:
+            results[parts[1]] = parts[-1].lstrip('- ')
+    return results
+
+
+def run_vadp(script, proxy_host, username, password, serials, initiators):
+    '''
+    Runs the VADP setup or cleanup of the cloned luns
+
+    script : VADP_SETUP or VADP_CLEANUP
+    proxy_host : the ESX proxy host
+    username, password : proxy host credentials
+    serials : the cloned lun serials
+    initiators : the initiators to which the luns are mapped
+
+    returns a dict of serial -> error message, empty on success
+
+    The operations run in process with vadp_client when it is enabled,
+    sharing one vSphere session per proxy host, and with the Perl
+    scripts otherwise (see run_vadp_script).
+    '''
+    if not vadp_client.enabled():
+        return run_vadp_script(script, proxy_host, username, password,
+                               serials, initiators)
+
+    client = vadp_client.get_client(proxy_host, username, password,
+                                    get_session_file(proxy_host) + '.py')
+    try:
+        with backup_scheduler.host_slot(proxy_host), \
+             metrics.span('vadp_client', script=os.path.basename(script),
+                          proxy_host=proxy_host, luns=len(serials)):
+            if script == VADP_SETUP:
+                results = client.setup(serials, initiators)
+            else:
+                results = client.cleanup(serials, initiators)
+    except Exception as e:
+        script_log("VADP operation on %s failed: %s" % (proxy_host, str(e)))
+        return dict((serial, str(e) or 'VADP operation failed')
+                    for serial in serials)
+
+    for serial, result in results.items():
+        script_log("LUN %s datastore: %s VMs: %s %s" %
+                   (serial, result.datastore, ', '.join(result.vms),
+                    result.error))
+    return dict((serial, result.error) for serial, result in results.items())
+
+
+@metrics.timed('mount_proxy_backup', 'cloned_lun_serial')
 def mount_proxy_backup(cdb, sdb, cloned_lun_serial, snap_name,
-                       access_group, proxy_host):
+                       access_group, proxy_host, initiators=()):
     '''
     Mounts the proxy backup on the proxy host
 
@@ -399,30 +1300,32 @@ def mount_proxy_backup(cdb, sdb, cloned_lun_serial, snap_name,
     snap_name : snapshot name
     access_group : initiator group   
     proxy_host : the ESX proxy host
+    initiators : the initiators of the access group
+
+    returns True if the cloned lun was mounted
 
+    Clones mounted on the proxy host at the same time are mounted
+    by a single VADP setup run, see vadp_batch.
     '''
     # Get credentials for the proxy host
     username, password = cdb.get_enc_info(proxy_host)
 
-	# Create the command to be run
-    cmd = ('%s "%s" --server %s --username %s --password %s --luns %s' %\
-           (PERL_EXE, VADP_SETUP, proxy_host, 
-		    username, password, cloned_lun_serial))
-    
-    script_log("Command is: " + cmd)
-    proc = subprocess.Popen(cmd,
-                            stdin = subprocess.PIPE,
-                            stdout = subprocess.PIPE,
-                            stderr = subprocess.PIPE)
-
-    out, err = proc.communicate()
-    if proc.wait() != 0:
-        script_log("Failed to mount the cloned lun: " + str(err))
-    else:
-        script_log("Mounted the cloned lun successfully")
+    error = vadp_batch.submit((VADP_SETUP, proxy_host, username,
+                               tuple(initiators)),
+                              cloned_lun_serial,
+                              lambda serials: run_vadp(VADP_SETUP,
+                                  proxy_host, username, password, serials,
+                                  initiators))
+    if error:
+        script_log("Failed to mount the cloned lun: " + error)
+        return False
+
+    script_log("Mounted the cloned lun successfully")
+    return True
 
 		
-def unmount_proxy_backup(cdb, sdb, lun_serial, proxy_host):
+@metrics.timed('unmount_proxy_backup', 'lun_serial')
+def unmount_proxy_backup(cdb, sdb, lun_serial, proxy_host, initiators=()):
     '''
     Un-mounts the previously mounted clone lun from the proxy host
 
@@ -430,34 +1333,48 @@ def unmount_proxy_backup(cdb, sdb, lun_serial, proxy_host):
     sbd : script db
     lun_serial : the lun serial   
     proxy_host : the ESX proxy host
+    initiators : the initiators of the access group of the clone
 
-    '''
-    # Get the credentials for proxy host
-    username, password = cdb.get_enc_info(proxy_host)
+    The clone is un-mounted from the proxy host it was mounted on if
+    that is recorded, proxy_host is used for older records.
 
+    Clones un-mounted from the proxy host at the same time are
+    un-mounted by a single VADP cleanup run, see vadp_batch.
+    '''
     # Find the cloned lun from the script db for given lun
     clone_serial, snap_name, group = sdb.get_clone_info(lun_serial)
 
     if not clone_serial:
          script_log("No clone serial found, returning")
          return	
+
+    mounted_on, mounted = sdb.get_clone_mount(lun_serial)
+    if mounted_on == '':
+        script_log("Clone %s is not mounted, returning" % clone_serial)
+        return
+    proxy_host = mounted_on or proxy_host
+
+    # Get the credentials for proxy host
+    username, password = cdb.get_enc_info(proxy_host)
 	
-    cmd = ('%s "%s" --server %s --username %s --password %s --luns %s' \
-           % (PERL_EXE, VADP_CLEANUP,
-		      proxy_host, username, password, clone_serial))
-	
-     
-    script_log("Command is: " + cmd)
-    proc = subprocess.Popen(cmd,
-                            stdin = subprocess.PIPE,
-                            stdout = subprocess.PIPE,
-                            stderr = subprocess.PIPE)
-
-    out, err = proc.communicate()
-    if proc.wait() != 0:
-        script_log("Failed to un-mount the cloned lun: " + str(err))
+    error = vadp_batch.submit((VADP_CLEANUP, proxy_host, username,
+                               tuple(initiators)),
+                              clone_serial,
+                              lambda serials: run_vadp(VADP_CLEANUP,
+                                  proxy_host, username, password, serials,
+                                  initiators))
+    if error:
+        script_log("Failed to un-mount the cloned lun: " + error)
     else:
         script_log("Un-mounted the clone lun successfully")
+        sdb.set_clone_mount(lun_serial, clone_serial, '', False)
+
+
+def split_list(value):
+    '''
+    Splits a comma separated option value
+    '''
+    return [v.strip() for v in value.split(',') if v.strip()]
 
 
 def get_option_parser():
@@ -493,6 +1410,58 @@ def get_option_parser():
                       type="string",
                       default=WORK_DIR,
                       help="Directory path to the VADP scripts")
+    parser.add_option("--async-backup",
+                      action="store_true",
+                      default=False,
+                      help="Run proxy backups in the background")
+    parser.add_option("--backup-workers",
+                      type="int",
+                      default=backup_scheduler.WORKERS,
+                      help="Number of proxy backups run in parallel")
+    parser.add_option("--array-limit",
+                      type="int",
+                      default=backup_scheduler.ARRAY_LIMIT,
+                      help="Clones created in parallel on the storage array")
+    parser.add_option("--host-limit",
+                      type="int",
+                      default=backup_scheduler.HOST_LIMIT,
+                      help="Clones mounted in parallel on a proxy host")
+    parser.add_option("--vadp-batch-window",
+                      type="float",
+                      default=vadp_batch.BACKUP_WINDOW,
+                      help="Seconds a mount of the backup worker waits for"
+                           " other clones to mount with it, 0 disables"
+                           " batching")
+    parser.add_option("--no-metrics",
+                      dest="metrics",
+                      action="store_false",
+                      default=True,
+                      help="Do not record the timing of the operation steps")
+    parser.add_option("--vadp-engine",
+                      type="choice",
+                      choices=['auto', 'python', 'perl'],
+                      default=vadp_client.ENGINE,
+                      help="Run the VADP operations in process (python) or"
+                           " with the Perl scripts, auto uses python when"
+                           " pyVmomi is installed")
+    parser.add_option("--vadp-discovery-timeout",
+                      type="int",
+                      default=vadp_client.DISCOVERY_DEADLINE,
+                      help="Seconds allowed for a cloned lun and its"
+                           " datastore to show up on the proxy host")
+    parser.add_option("--array-transport",
+                      type="choice",
+                      choices=['HTTPS', 'HTTP'],
+                      default=ARRAY_TRANSPORT,
+                      help="Transport used for the ZAPI calls to the array")
+    parser.add_option("--array-port",
+                      type="int",
+                      default=ARRAY_PORT,
+                      help="Port of the ZAPI server of the array")
+    parser.add_option("--lun-index-ttl",
+                      type="int",
+                      default=lun_index.TTL,
+                      help="Seconds the local lun index is trusted, 0 disables it")
     parser.add_option("--protect-category",
                       type="string",
                       default="daily",
@@ -505,6 +1474,15 @@ def get_option_parser():
     parser.add_option("--operation",
                       type="string",
                       help="Operation to perform (HELLO/SNAP/REMOVE)")
+    parser.add_option("--serials",
+                      type="string",
+                      default="",
+                      help="Comma separated lun serials for CREATE_SNAP_BATCH")
+    parser.add_option("--snap-names",
+                      type="string",
+                      default="",
+                      help="Comma separated snapshot names for CREATE_SNAP_BATCH,"
+                           " one for all the luns or one per lun")
     parser.add_option("--snap-name",
                       type="string",
                       default="",
@@ -520,42 +1498,117 @@ def get_option_parser():
     return parser
 
 
-if __name__ == '__main__':
-    options, argsleft = get_option_parser().parse_args()
+def configure_array(transport, port):
+    '''
+    Sets how connect_array reaches the storage arrays
+
+    transport : HTTPS or HTTP
+    port : port of the ZAPI server
+    '''
+    global ARRAY_TRANSPORT, ARRAY_PORT
+    ARRAY_TRANSPORT = transport
+    ARRAY_PORT = port
+
+
+def connect_array(cdb, storage_array, transport=None, port=None):
+    '''
+    Returns a connection to the Netapp storage array
+
+    cdb : credentials db
+    storage_array : Netapp hostname/ip address
+    transport, port : how to reach the ZAPI server, the values set
+                      with configure_array if None
+    '''
+    conn = zapi_pool.PooledNaServer(storage_array, 1 , 7)
+    conn.set_server_type("FILER")
+    conn.set_transport_type(transport or ARRAY_TRANSPORT)
+    conn.set_port(port or ARRAY_PORT)
+    conn.set_style("LOGIN")
+    user, pwd = cdb.get_enc_info(storage_array)
+    conn.set_admin_user(user, pwd)
+    return conn
+
+
+def configure_operation(options):
+    '''
+    Applies the tuning options of the process, they are shared by
+    all the operations it runs
+
+    options : parsed script options
+    '''
+    lun_index.configure(options.lun_index_ttl)
+    backup_scheduler.configure(options.backup_workers, options.array_limit,
+                               options.host_limit)
+    vadp_batch.configure(backup_window=options.vadp_batch_window)
+    vadp_client.configure(options.vadp_engine, WORK_DIR,
+                          options.vadp_discovery_timeout)
+    metrics.configure(WORK_DIR, options.metrics)
+
+
+def run_operation(options, cdb, sdb, conn):
+    '''
+    Runs the operation requested by Granite Core
+
+    options : parsed script options
+    cdb : credentials db
+    sdb : script db
+    conn : Netapp hostname/ip address connection
+
+    Like the operations themselves, exits the process with
+    the status code expected by Granite Core.
+    '''
+    with metrics.context(operation=options.operation,
+                         array=options.storage_array), \
+         metrics.span('operation', serial=options.serial):
+        if options.operation == 'HELLO':
+            check_lun(conn, options.serial)
+        elif options.operation == 'CREATE_SNAP':   
+            create_snap(cdb, sdb, conn, options.serial, options.snap_name, 
+                        options.access_group, options.proxy_host,
+                        options.category, options.protect_category,
+                        options.async_backup)
+        elif options.operation == 'CREATE_SNAP_BATCH':
+            create_snaps(cdb, sdb, conn, split_list(options.serials),
+                         split_list(options.snap_names),
+                         options.access_group, options.proxy_host,
+                         options.category, options.protect_category,
+                         options.async_backup)
+        elif options.operation == 'REMOVE_SNAP':
+            remove_snap(cdb, sdb, conn, options.serial,
+                        options.snap_name, options.proxy_host)
+        else:
+            print ('Invalid operation: %s' % str(options.operation))
+            sys.exit(errno.EINVAL)
+
+
+def main(argv=None):
+    '''
+    Runs the handoff script for the given command line
+
+    argv : script arguments, defaults to sys.argv[1:]
+    '''
+    options, argsleft = get_option_parser().parse_args(argv)
 
     # Set the working dir prefix
     set_script_path(options.work_dir)
 
     # Credentials db must be initialized using the cred_mgmt.py file
-    cdb = script_db.CredDB(options.work_dir + r'\cred_db')
+    cdb = cred_provider.get_provider(options.work_dir + r'\cred_db')
 	
     # Initialize the script database
     sdb = script_db.ScriptDB(options.work_dir + r'\script_db')
     sdb.setup()
 
-    # Connect to Netapp server
-    conn = NaServer(options.storage_array, 1 , 7)
-    conn.set_server_type("FILER")
-    conn.set_transport_type("HTTPS")
-    conn.set_port(443)
-    conn.set_style("LOGIN")
-    user, pwd = cdb.get_enc_info(options.storage_array)
-    conn.set_admin_user(user, pwd)
-
-    if options.operation == 'HELLO':
-        check_lun(conn, options.serial)
-    elif options.operation == 'CREATE_SNAP':   
-        create_snap(cdb, sdb, conn, options.serial, options.snap_name, 
-                    options.access_group, options.proxy_host,
-					options.category, options.protect_category)
-    elif options.operation == 'REMOVE_SNAP':
-        remove_snap(cdb, sdb, conn, options.serial,
-		            options.snap_name, options.proxy_host)
-    else:
-        print ('Invalid operation: %s' % str(options.operation))
-        cdb.close()
+    try:
+        # Connect to Netapp server
+        configure_array(options.array_transport, options.array_port)
+        configure_operation(options)
+        conn = connect_array(cdb, options.storage_array)
+        run_operation(options, cdb, sdb, conn)
+    finally:
         sdb.close()
-        sys.exit(errno.EINVAL)
+        cdb.close()
+
 
-    sdb.close()
-    cdb.close()
+if __name__ == '__main__':
+    main()
@@ -22,11 +22,61 @@
 #
 ###############################################################################
 import sqlite3
+import time
+import functools
+import contextlib
+
+# Passwords are encrypted at rest when possible
+import cred_crypt
+
+# Timing of the script db calls
+import metrics
+
+# Proxy backup job states
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_SUPERSEDED = 'superseded'
+
+# Version of the script db schema, kept in the database user_version.
+# Databases created by older scripts have version 0 and are migrated
+# by ScriptDB.setup().
+SCHEMA_VERSION = 4
+
+# Seconds to wait for another process holding the database write lock
+BUSY_TIMEOUT = 30
+# Times a ScriptDB method is run when the database stays locked
+BUSY_RETRIES = 3
+
+
+def retry_busy(method):
+    '''
+    Runs a ScriptDB method again if the database was still locked
+    after the busy timeout. The method's transaction was rolled back,
+    so it is safe to run it again.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        delay = 0.5
+        for attempt in range(BUSY_RETRIES):
+            try:
+                with metrics.span('sqlite', call=method.__name__):
+                    return method(self, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if (attempt == BUSY_RETRIES - 1 or
+                    ('locked' not in message and 'busy' not in message)):
+                    raise
+            time.sleep(delay)
+            delay *= 2
+    return wrapper
+
 
 class CredDB(object):
 
     def __init__(self, path):
-        self.conn_ = sqlite3.connect(path)
+        self.conn_ = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
 
     def setup(self):
         '''
@@ -44,14 +94,43 @@ class CredDB(object):
             c.execute("DROP table %s" % table)
 		
         c.execute('''CREATE TABLE pwd (host text, user text, pass text)''')
+        c.execute('''CREATE INDEX pwd_host ON pwd (host)''')
         self.conn_.commit()
 
     def insert_enc_info(self, hostname, user, pwd):
+        '''
+        Stores the credentials of a host, the password is
+        encrypted when the machine supports it (see cred_crypt)
+        '''
         c = self.conn_.cursor()
         host = (hostname,)
         c.execute("DELETE FROM pwd where host=?", host)
-        c.execute("INSERT INTO pwd VALUES ('%s', '%s', '%s')" % \
-				 (hostname, user, pwd))
+        c.execute("INSERT INTO pwd VALUES (?, ?, ?)",
+                  (hostname, user, cred_crypt.protect(pwd)))
+        self.conn_.commit()
+
+    def insert_many_enc_info(self, entries, replace=False):
+        '''
+        Stores the credentials of many hosts in one transaction
+
+        entries : list of (host, user, password)
+        replace : delete the hosts that are not in entries
+        '''
+        c = self.conn_.cursor()
+        # Databases set up by older scripts have no index on the host
+        c.execute("CREATE INDEX IF NOT EXISTS pwd_host ON pwd (host)")
+        rows = [(host, user, cred_crypt.protect(pwd))
+                for host, user, pwd in entries]
+        try:
+            if replace:
+                c.execute("DELETE FROM pwd")
+            else:
+                c.executemany("DELETE FROM pwd where host=?",
+                              [(row[0],) for row in rows])
+            c.executemany("INSERT INTO pwd VALUES (?, ?, ?)", rows)
+        except:
+            self.conn_.rollback()
+            raise
         self.conn_.commit()
 
     def delete_enc_info(self, hostname):
@@ -60,13 +139,34 @@ class CredDB(object):
         c.execute("DELETE FROM pwd where host=?", host)
         self.conn_.commit()
 
+    def protect_all(self):
+        '''
+        Encrypts the passwords still stored in plain text
+
+        Returns the number of passwords encrypted
+        '''
+        if not cred_crypt.is_available():
+            return 0
+        c = self.conn_.cursor()
+        rows = c.execute("SELECT rowid, pass FROM pwd").fetchall()
+        count = 0
+        for rowid, value in rows:
+            if value and not cred_crypt.is_protected(value):
+                c.execute("UPDATE pwd SET pass=? WHERE rowid=?",
+                          (cred_crypt.protect(value), rowid))
+                count += 1
+        self.conn_.commit()
+        return count
+
     def get_all_enc_info(self):
+        '''
+        Returns the (host, user, password) of all the hosts,
+        the passwords are decrypted
+        '''
         c = self.conn_.cursor()
         details = []
         for row in c.execute("SELECT host, user, pass FROM pwd"):
-            details.append((row[0], row[1], row[2]))
-
-        self.conn_.commit()
+            details.append((row[0], row[1], cred_crypt.unprotect(row[2])))
         return details
 
     def get_enc_info(self, hostname):
@@ -74,54 +174,373 @@ class CredDB(object):
         host = (hostname,)
         c.execute("SELECT user, pass FROM pwd where host=?", host)
         details = c.fetchone()
-        self.conn_.commit()
-        return details or ('', '')
+        if not details:
+            return ('', '')
+        return (details[0], cred_crypt.unprotect(details[1]))
 
     def close(self):
         self.conn_.close()
 		
 		
 class ScriptDB(object):
+    '''
+    Clone and proxy backup job information.
+
+    The database uses write-ahead logging, so readers never block
+    the writer and concurrent handoff processes do not block each
+    other on lookups. Statements run in autocommit mode, methods
+    making more than one change run them in a transaction.
+    '''
 
     def __init__(self, path):
-        self.conn_ = sqlite3.connect(path)
+        self.conn_ = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                     isolation_level=None)
+        # WAL is kept in the database file, synchronous is per connection.
+        # NORMAL only syncs at checkpoints with WAL, a power loss may
+        # lose the last transactions but never corrupts the database.
+        self.conn_.execute('PRAGMA journal_mode=WAL')
+        self.conn_.execute('PRAGMA synchronous=NORMAL')
 
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Runs the statements of the with block in one transaction,
+        taking the write lock up front
+        '''
+        self.conn_.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.conn_
+        except BaseException:
+            # sqlite rolls back by itself on some errors
+            if self.conn_.in_transaction:
+                self.conn_.execute('ROLLBACK')
+            raise
+        self.conn_.execute('COMMIT')
+
+    def schema_version(self):
+        return self.conn_.execute('PRAGMA user_version').fetchone()[0]
+
+    @retry_busy
     def setup(self):
         '''
-        Creates database tables if they do not exist
+        Creates the database tables, or migrates them from an older
+        schema. Only reads the schema version if it is up to date.
         '''
-        c = self.conn_.cursor()
-        table_exists = False
-        for row in c.execute("SELECT name FROM sqlite_master WHERE type='table' "):
-            if row[0] == 'clone_info':
-                table_exists = True
-                break
+        if self.schema_version() == SCHEMA_VERSION:
+            return
 
-        if not table_exists:
-            c.execute('CREATE TABLE clone_info (lun text, clone text, '\
-			          'snap_name text, access_group text)')
-        self.conn_.commit()
+        with self.transaction() as c:
+            # Another process may have migrated while we waited for the lock
+            version = self.schema_version()
+            if version == SCHEMA_VERSION:
+                return
+            if version > SCHEMA_VERSION:
+                raise sqlite3.DatabaseError('Script db schema version %d is '
+                                            'newer than %d' %
+                                            (version, SCHEMA_VERSION))
+            if version < 1:
+                self.migrate_v1(c)
+            if version < 2:
+                self.migrate_v2(c)
+            if version < 3:
+                self.migrate_v3(c)
+            if version < 4:
+                self.migrate_v4(c)
+            c.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
 
-    def insert_clone_info(self, lun, clone, snap_name, group):
-        c = self.conn_.cursor()
-        c.execute("INSERT INTO clone_info VALUES ('%s', '%s', '%s', '%s')" % \
-                  (lun, clone, snap_name, group))
-        self.conn_.commit()
+    def migrate_v1(self, c):
+        '''
+        Creates the version 1 schema, keeping the data of a version 0
+        database. Version 0 clone_info had no key, if a lun has several
+        rows we keep the one the lookups used to return.
+        '''
+        tables = set(row[0] for row in c.execute(
+                         "SELECT name FROM sqlite_master WHERE type='table'"))
+        if 'clone_info' in tables:
+            c.execute('ALTER TABLE clone_info RENAME TO clone_info_v0')
+
+        c.execute('CREATE TABLE clone_info (lun text primary key, '\
+                  'clone text, snap_name text, access_group text)')
+        c.execute('CREATE INDEX IF NOT EXISTS clone_info_clone '\
+                  'ON clone_info (clone)')
+        c.execute('CREATE INDEX IF NOT EXISTS clone_info_snap_name '\
+                  'ON clone_info (snap_name)')
+
+        if 'clone_info' in tables:
+            c.execute('INSERT OR IGNORE INTO clone_info '\
+                      'SELECT lun, clone, snap_name, access_group '\
+                      'FROM clone_info_v0 ORDER BY rowid')
+            c.execute('DROP TABLE clone_info_v0')
+
+        # Queue of proxy backups run in the background
+        c.execute('CREATE TABLE IF NOT EXISTS backup_job ('\
+                  'id integer primary key, lun text, snap_name text, '\
+                  'access_group text, proxy_host text, storage_array text, '\
+                  'state text, error text, created real, updated real)')
+        c.execute('CREATE INDEX IF NOT EXISTS backup_job_state '\
+                  'ON backup_job (state, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS backup_job_lun '\
+                  'ON backup_job (lun, state)')
+
+    def migrate_v2(self, c):
+        '''
+        Records the name of the clone volume, so that a clone whose
+        creation did not complete can still be found and destroyed
+        '''
+        c.execute("ALTER TABLE clone_info ADD COLUMN clone_volume text "\
+                  "DEFAULT ''")
+
+    def migrate_v3(self, c):
+        '''
+        Records where the clone is mounted, so that a clone of the
+        snapshot being protected can be reused. The proxy host of
+        the clones recorded before is not known (NULL).
+        '''
+        c.execute("ALTER TABLE clone_info ADD COLUMN proxy_host text")
+        c.execute("ALTER TABLE clone_info ADD COLUMN mounted integer "\
+                  "DEFAULT 0")
+
+    def migrate_v4(self, c):
+        '''
+        Clones replaced by a newer clone of their lun are moved to
+        clone_gc, the backup worker destroys them in the background
+        '''
+        c.execute('CREATE TABLE IF NOT EXISTS clone_gc ('\
+                  'id integer primary key, lun text, clone text, '\
+                  'snap_name text, clone_volume text, storage_array text, '\
+                  'retired real)')
+        c.execute('CREATE INDEX IF NOT EXISTS clone_gc_array '\
+                  'ON clone_gc (storage_array, snap_name)')
+
+    @retry_busy
+    def begin_clone(self, lun, snap_name, group, clone_volume):
+        '''
+        Records a clone about to be created. The clone serial is
+        empty until insert_clone_info() completes the record.
+        '''
+        self.conn_.execute("INSERT OR REPLACE INTO clone_info "\
+                           "(lun, clone, snap_name, access_group, "\
+                           "clone_volume, proxy_host, mounted) "\
+                           "VALUES (?, '', ?, ?, ?, '', 0)",
+                           (lun, snap_name, group, clone_volume))
 
+    @retry_busy
+    def insert_clone_info(self, lun, clone, snap_name, group, clone_volume=''):
+        self.conn_.execute("INSERT OR REPLACE INTO clone_info "\
+                           "(lun, clone, snap_name, access_group, "\
+                           "clone_volume, proxy_host, mounted) "\
+                           "VALUES (?, ?, ?, ?, ?, '', 0)",
+                           (lun, clone, snap_name, group, clone_volume))
+
+    @retry_busy
     def get_clone_info(self, lun_serial):
-        c = self.conn_.cursor()
-        lun = (lun_serial,)
-        c.execute("SELECT clone, snap_name, access_group "\
-		          "FROM clone_info where lun=?", lun)
-        data = c.fetchone()
-        self.conn_.commit()
+        data = self.conn_.execute("SELECT clone, snap_name, access_group "\
+                                  "FROM clone_info where lun=?",
+                                  (lun_serial,)).fetchone()
         return data or ('', '', '')
 
-    def delete_clone_info(self, lun_serial):
-        c = self.conn_.cursor()
-        lun = (lun_serial,)
-        c.execute("DELETE FROM clone_info where lun=?", lun)
-        self.conn_.commit()
+    @retry_busy
+    def get_clone_volume(self, lun_serial):
+        data = self.conn_.execute("SELECT clone_volume FROM clone_info "\
+                                  "where lun=?", (lun_serial,)).fetchone()
+        return data and data[0] or ''
+
+    @retry_busy
+    def set_clone_mount(self, lun_serial, clone, proxy_host, mounted):
+        '''
+        Records the proxy host on which the clone is being mounted
+        (mounted False) or was mounted (mounted True). An empty
+        proxy host records that the clone is not mounted anywhere.
+        '''
+        self.conn_.execute("UPDATE clone_info SET proxy_host=?, mounted=? "\
+                           "where lun=? and clone=?",
+                           (proxy_host, mounted and 1 or 0, lun_serial, clone))
+
+    @retry_busy
+    def get_clone_mount(self, lun_serial):
+        '''
+        Returns (proxy host, mounted) of the clone of the lun. The
+        proxy host is None if it is not known, empty if the clone
+        is not mounted.
+        '''
+        data = self.conn_.execute("SELECT proxy_host, mounted FROM "\
+                                  "clone_info where lun=?",
+                                  (lun_serial,)).fetchone()
+        if data is None:
+            return ('', False)
+        return (data[0], bool(data[1]))
+
+    @retry_busy
+    def delete_clone_info(self, lun_serial, clone=None):
+        '''
+        Deletes the clone record of the lun
+
+        clone : only delete the record if it is still for this clone serial
+        '''
+        if clone is None:
+            self.conn_.execute("DELETE FROM clone_info where lun=?",
+                               (lun_serial,))
+        else:
+            self.conn_.execute("DELETE FROM clone_info where lun=? and "\
+                               "clone=?", (lun_serial, clone))
+
+    @retry_busy
+    def retire_clone(self, lun_serial, storage_array):
+        '''
+        Moves the clone record of the lun to the clones to destroy,
+        the lun is left without a clone
+
+        returns True if the lun had a clone (complete or not)
+        '''
+        with self.transaction() as c:
+            data = c.execute("SELECT clone, snap_name, clone_volume FROM "\
+                             "clone_info where lun=?",
+                             (lun_serial,)).fetchone()
+            if data is None:
+                return False
+            c.execute("DELETE FROM clone_info where lun=?", (lun_serial,))
+            clone, snap_name, clone_volume = data
+            if not clone and not clone_volume:
+                return False
+            c.execute("INSERT INTO clone_gc (lun, clone, snap_name, "\
+                      "clone_volume, storage_array, retired) "\
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      (lun_serial, clone, snap_name, clone_volume or '',
+                       storage_array, time.time()))
+        return True
+
+    @retry_busy
+    def get_retired_clones(self, storage_array, snap_name=None,
+                           clone_volume=None):
+        '''
+        Returns the clones to destroy on the array, oldest first, as
+        (id, lun, clone, clone_volume)
+
+        snap_name : only the clones of snapshots with this name
+        clone_volume : only the clones in the volume with this name
+        '''
+        query = "SELECT id, lun, clone, clone_volume FROM clone_gc "\
+                "where storage_array=? "
+        args = (storage_array,)
+        if snap_name is not None:
+            query += "and snap_name=? "
+            args += (snap_name,)
+        if clone_volume is not None:
+            query += "and clone_volume=? "
+            args += (clone_volume,)
+        return self.conn_.execute(query + "ORDER BY id", args).fetchall()
+
+    @retry_busy
+    def is_retired_clone(self, clone_id):
+        return self.conn_.execute("SELECT 1 FROM clone_gc where id=?",
+                                  (clone_id,)).fetchone() is not None
+
+    @retry_busy
+    def get_retired_arrays(self):
+        '''
+        Returns the storage arrays that have clones to destroy
+        '''
+        return [row[0] for row in self.conn_.execute(
+                    "SELECT DISTINCT storage_array FROM clone_gc")]
+
+    @retry_busy
+    def delete_retired_clone(self, clone_id):
+        self.conn_.execute("DELETE FROM clone_gc where id=?", (clone_id,))
+
+    @retry_busy
+    def count_retired_clones(self, since=0):
+        '''
+        Returns the number of clones to destroy retired since
+        the given time
+        '''
+        return self.conn_.execute("SELECT count(*) FROM clone_gc "\
+                                  "where retired>=?", (since,)).fetchone()[0]
+
+    @retry_busy
+    def insert_backup_job(self, lun, snap_name, group, proxy_host, array):
+        '''
+        Queues a proxy backup of the snapshot, replacing any backup
+        of the lun still waiting in the queue.
+
+        returns the job id
+        '''
+        now = time.time()
+        with self.transaction() as c:
+            c.execute("UPDATE backup_job SET state=?, updated=? "\
+                      "where lun=? and state=?",
+                      (JOB_SUPERSEDED, now, lun, JOB_QUEUED))
+            cursor = c.execute("INSERT INTO backup_job (lun, snap_name, "\
+                               "access_group, proxy_host, storage_array, "\
+                               "state, error, created, updated) "\
+                               "VALUES (?, ?, ?, ?, ?, ?, '', ?, ?)",
+                               (lun, snap_name, group, proxy_host, array,
+                                JOB_QUEUED, now, now))
+        return cursor.lastrowid
+
+    @retry_busy
+    def claim_backup_job(self):
+        '''
+        Takes the oldest queued job and marks it running
+
+        returns the job as (id, lun, snap_name, access_group, proxy_host,
+        storage_array), or None if the queue is empty
+        '''
+        # The transaction takes the write lock before reading,
+        # so that two workers never claim the same job
+        with self.transaction() as c:
+            job = c.execute("SELECT id, lun, snap_name, access_group, "\
+                            "proxy_host, storage_array FROM backup_job "\
+                            "where state=? ORDER BY id LIMIT 1",
+                            (JOB_QUEUED,)).fetchone()
+            if job:
+                c.execute("UPDATE backup_job SET state=?, updated=? "\
+                          "where id=?", (JOB_RUNNING, time.time(), job[0]))
+        return job
+
+    @retry_busy
+    def finish_backup_job(self, job_id, state, error=''):
+        self.conn_.execute("UPDATE backup_job SET state=?, error=?, "\
+                           "updated=? where id=?",
+                           (state, error, time.time(), job_id))
+
+    @retry_busy
+    def cancel_backup_jobs(self, lun_serial, snap_name):
+        '''
+        Drops the queued backups of the snapshot
+        '''
+        self.conn_.execute("UPDATE backup_job SET state=?, updated=? "\
+                           "where lun=? and state=? and snap_name=?",
+                           (JOB_SUPERSEDED, time.time(), lun_serial,
+                            JOB_QUEUED, snap_name))
+
+    @retry_busy
+    def requeue_backup_jobs(self):
+        '''
+        Queues again the jobs left running by a worker that died
+        '''
+        self.conn_.execute("UPDATE backup_job SET state=?, updated=? "\
+                           "where state=?",
+                           (JOB_QUEUED, time.time(), JOB_RUNNING))
+
+    @retry_busy
+    def get_backup_jobs(self, lun_serial=None, limit=20):
+        '''
+        Returns the most recent jobs, newest first, as (id, lun, snap_name,
+        proxy_host, state, error, created, updated)
+        '''
+        query = "SELECT id, lun, snap_name, proxy_host, state, error, "\
+                "created, updated FROM backup_job "
+        args = ()
+        if lun_serial:
+            query += "where lun=? "
+            args = (lun_serial,)
+        return self.conn_.execute(query + "ORDER BY id DESC LIMIT ?",
+                                  args + (limit,)).fetchall()
+
+    @retry_busy
+    def count_backup_jobs(self, state):
+        return self.conn_.execute("SELECT count(*) FROM backup_job "\
+                                  "where state=?", (state,)).fetchone()[0]
 
     def close(self):
         self.conn_.close()
@@ -0,0 +1,117 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Coalesced VADP script runs.
+# Every run of vadp_setup.pl/vadp_cleanup.pl loads the vSphere SDK and logs
+# in to the proxy host before doing any work. Proxy backups running in
+# parallel submit their cloned lun here instead of running the script
+# themselves: the luns submitted for the same script and proxy host within
+# a short window are handed to a single run of the script.
+# Only the backup worker waits for other luns by default, a proxy backup
+# run while Granite Core waits for the answer is not delayed.
+###############################################################################
+import threading
+
+# Defaults, see configure()
+WINDOW = 0
+MAX_LUNS = 32
+# Window of the backup worker, see backup_worker.py
+BACKUP_WINDOW = 2.0
+
+_batches = {}
+_batches_lock = threading.Lock()
+
+
+def configure(window=None, max_luns=None, backup_window=None):
+    '''
+    Sets the batching parameters
+
+    window : seconds a batch waits for more luns, 0 disables batching
+    max_luns : number of luns after which a batch is run right away
+    backup_window : window passed to the backup worker
+    '''
+    global WINDOW, MAX_LUNS, BACKUP_WINDOW
+    if window is not None:
+        WINDOW = max(0, window)
+    if max_luns is not None:
+        MAX_LUNS = max(1, max_luns)
+    if backup_window is not None:
+        BACKUP_WINDOW = max(0, backup_window)
+
+
+class VadpBatch(object):
+    '''
+    Luns waiting for the same VADP script run
+    '''
+
+    def __init__(self):
+        self.serials_ = []
+        self.full_ = threading.Event()
+        self.done_ = threading.Event()
+        self.results_ = {}
+
+
+def submit(key, serial, runner):
+    '''
+    Runs the VADP script for the lun, together with the other
+    luns submitted with the same key within WINDOW seconds.
+    Blocks until the script has run.
+
+    key : identifies the script run, e.g. (script, proxy host, user)
+    serial : the cloned lun serial
+    runner : function running the script for a list of serials, returns
+             a dict of serial -> error message, empty on success
+
+    returns the error message for the lun, empty on success
+    '''
+    with _batches_lock:
+        batch = _batches.get(key)
+        leader = batch is None
+        if leader:
+            batch = VadpBatch()
+            _batches[key] = batch
+        if serial not in batch.serials_:
+            batch.serials_.append(serial)
+        if len(batch.serials_) >= MAX_LUNS:
+            del _batches[key]
+            batch.full_.set()
+
+    if not leader:
+        batch.done_.wait()
+        return batch.results_.get(serial, 'VADP script did not run')
+
+    # The first lun of the batch runs the script for all of them
+    batch.full_.wait(WINDOW)
+    with _batches_lock:
+        if _batches.get(key) is batch:
+            del _batches[key]
+
+    try:
+        batch.results_ = runner(list(batch.serials_))
+    except Exception as e:
+        batch.results_ = dict((s, str(e)) for s in batch.serials_)
+    finally:
+        batch.done_.set()
+    return batch.results_.get(serial, 'VADP script did not run')
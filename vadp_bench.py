@@ -0,0 +1,246 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Benchmark of the VADP mount and cleanup path.
+# Runs the setup and cleanup of vadp_client.py against a simulated proxy
+# host (see vsphere_simulator.py) for every combination of the lun count,
+# VM count per datastore and hba count, and reports how long they take:
+# vadp_bench.py --luns 1,4,16 --vms 1,10 --hbas 1,4 --scale 0.1
+###############################################################################
+import concurrent.futures
+import io
+import json
+import optparse
+import shutil
+import sys
+import tempfile
+import time
+
+# The client being timed and the simulated host
+import vadp_client
+import vsphere_simulator
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+def split_ints(value):
+    '''
+    Returns the list of integers of a comma separated string
+    '''
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def parse_delays(values):
+    '''
+    Returns the dict of call name to delay
+
+    values : list of NAME=SECONDS strings
+    '''
+    delays = {}
+    for value in values or []:
+        name, sep, seconds = value.partition('=')
+        if not sep or name.strip() not in vsphere_simulator.DELAYS:
+            raise ValueError("Expected NAME=SECONDS with NAME one of %s,"
+                             " got %s" % (', '.join(sorted(
+                                 vsphere_simulator.DELAYS)), value))
+        delays[name.strip()] = float(seconds)
+    return delays
+
+
+def run_clients(host, serials, initiators, clients, operation):
+    '''
+    Runs the setup or cleanup of the luns, split between clients
+    running at the same time like concurrent handoff processes
+
+    host : the SimulatedHost
+    serials : the lun serials
+    initiators : initiators passed to the client
+    clients : number of clients
+    operation : 'setup' or 'cleanup'
+
+    Returns a tuple of (seconds, number of luns that failed)
+    '''
+    shares = [serials[i::clients] for i in range(clients)]
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(clients) as pool:
+        futures = [pool.submit(getattr(vsphere_simulator.SimulatedVadpClient(
+                                           host), operation),
+                               share, initiators)
+                   for share in shares if share]
+        results = {}
+        for f in futures:
+            results.update(f.result())
+    seconds = time.time() - start
+    return seconds, sum(1 for r in results.values() if r.error)
+
+
+def run_case(options, delays, luns, vms, hbas):
+    '''
+    Mounts and cleans up luns on a new simulated host
+
+    options : parsed options
+    delays : call delays replacing the defaults
+    luns : number of cloned luns
+    vms : number of VMs in each datastore
+    hbas : number of hbas of the host
+
+    Returns the result dict of the case
+    '''
+    host = vsphere_simulator.SimulatedHost(hbas, delays, options.scale)
+    serials = ['BENCH%07d' % i for i in range(luns)]
+    for serial in serials:
+        # The proxy access group holds the initiator of the first hba
+        host.map_lun(serial, vms)
+    # Without initiators the client scans all the hbas
+    initiators = options.match_initiators and host.initiators()[:1] or []
+
+    # Rescans are shared through the lock files, start from none
+    lock_dir = tempfile.mkdtemp(prefix='vadp_bench_')
+    vadp_client.configure(lock_dir=lock_dir)
+    try:
+        setup, setup_errors = run_clients(host, serials, initiators,
+                                          options.clients, 'setup')
+        setup_calls = host.stats.get(reset=True)
+        cleanup, cleanup_errors = run_clients(host, serials, initiators,
+                                              options.clients, 'cleanup')
+        cleanup_calls = host.stats.get(reset=True)
+    finally:
+        shutil.rmtree(lock_dir, ignore_errors=True)
+
+    def count(calls, name):
+        return calls.get(name, {}).get('calls', 0)
+
+    return {'luns' : luns, 'vms' : vms, 'hbas' : hbas,
+            'setup' : setup,
+            'setup_per_lun' : setup / luns,
+            'cleanup' : cleanup,
+            'errors' : setup_errors + cleanup_errors,
+            'rescans' : count(setup_calls, 'rescan-hba') +
+                        count(setup_calls, 'rescan-vmfs'),
+            'registers' : count(setup_calls, 'register'),
+            'setup_calls' : setup_calls,
+            'cleanup_calls' : cleanup_calls}
+
+
+def format_results(results):
+    '''
+    Returns the results as a text table
+
+    results : result dicts of run_case
+    '''
+    lines = ['%5s %5s %5s %10s %10s %10s %8s %9s %6s' %
+             ('luns', 'vms', 'hbas', 'setup(s)', 'per lun', 'cleanup(s)',
+              'rescans', 'registers', 'errors')]
+    for r in results:
+        lines.append('%5d %5d %5d %10.2f %10.2f %10.2f %8d %9d %6d' %
+                     (r['luns'], r['vms'], r['hbas'], r['setup'],
+                      r['setup_per_lun'], r['cleanup'], r['rescans'],
+                      r['registers'], r['errors']))
+    return '\n'.join(lines) + '\n'
+
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option("--luns",
+                      type="string",
+                      default="1,4,16",
+                      help="Comma separated numbers of cloned luns")
+    parser.add_option("--vms",
+                      type="string",
+                      default="1,8",
+                      help="Comma separated numbers of VMs per datastore")
+    parser.add_option("--hbas",
+                      type="string",
+                      default="1,4",
+                      help="Comma separated numbers of hbas of the proxy host")
+    parser.add_option("--clients",
+                      type="int",
+                      default=1,
+                      help="Clients mounting the luns at the same time")
+    parser.add_option("--match-initiators",
+                      action="store_true",
+                      default=False,
+                      help="Pass the initiator of the luns so that only its"
+                           " hba is rescanned")
+    parser.add_option("--scale",
+                      type="float",
+                      default=1.0,
+                      help="Factor applied to all the call delays")
+    parser.add_option("--delay",
+                      action="append",
+                      default=[],
+                      metavar="NAME=SECONDS",
+                      help="Delay of a simulated call, can be repeated")
+    parser.add_option("--json",
+                      action="store_true",
+                      default=False,
+                      help="Print the results as JSON, with the calls made")
+    parser.add_option("--verbose",
+                      action="store_true",
+                      default=False,
+                      help="Show the logs of the VADP client")
+    return parser
+
+
+if __name__ == '__main__':
+    options, argsleft = get_option_parser().parse_args()
+    try:
+        delays = parse_delays(options.delay)
+        cases = [(luns, vms, hbas) for luns in split_ints(options.luns)
+                                   for vms in split_ints(options.vms)
+                                   for hbas in split_ints(options.hbas)]
+    except ValueError as e:
+        script_log("Error: %s\n" % str(e))
+        sys.exit(1)
+
+    results = []
+    with vsphere_simulator.install():
+        for luns, vms, hbas in cases:
+            # The client logs every step, keep them out of the report
+            stderr = sys.stderr
+            if not options.verbose:
+                sys.stderr = io.StringIO()
+            try:
+                results.append(run_case(options, delays, luns, vms, hbas))
+            finally:
+                sys.stderr = stderr
+            if not options.json:
+                script_log("Done %d luns, %d VMs, %d hbas\n" % (luns, vms, hbas))
+
+    if options.json:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    else:
+        sys.stdout.write(format_results(results))
+    sys.exit(any(r['errors'] for r in results) and 1 or 0)
@@ -67,6 +67,30 @@ my %opts = (
     default => 0,
     required => 0,
     },
+    'initiators' => {
+    type => "=s",
+    help => "Comma separated initiators to which the luns are mapped, only their hbas are rescanned",
+    default => '',
+    required => 0,
+    },
+    'session_file' => {
+    type => "=s",
+    help => "File in which the ESX session is saved and reused between runs",
+    default => '',
+    required => 0,
+    },
+    'work_dir' => {
+    type => "=s",
+    help => "Directory of the rescan lock files, shared with the handoff scripts",
+    default => '',
+    required => 0,
+    },
+    'discovery_timeout' => {
+    type => "=i",
+    help => "Seconds allowed for a lun and its datastore to show up, 0 for the default (60)",
+    default => 0,
+    required => 0,
+    },
     'extra_logging' => {
     type => "=i",
     help => "Set to > 0 for extra logging information",
@@ -98,6 +122,7 @@ my $fail_if_backup_in_progress = Opts::get_option('fail_if_backup_in_progress');
 my $include_hosts = trim_wspace(Opts::get_option('include_hosts'));
 my $exclude_hosts = trim_wspace(Opts::get_option('exclude_hosts'));
 my $extra_logging = int(trim_wspace(Opts::get_option('extra_logging')));
+my $initiators = trim_wspace(Opts::get_option('initiators'));
 
 my @luns = split('\s*,\s*', $lunlist);
 
@@ -162,7 +187,7 @@ foreach (keys %$lun_ds_hash) {
         $umount_fail = 1;
     } else {
         eval {
-            umount_and_detach($datastore);
+            umount_and_detach($datastore, $initiators);
         };
         if ($@) {
             $log->error("Unmount failure for $_: " . $datastore->name);
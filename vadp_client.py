@@ -0,0 +1,1163 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# In-process VADP client.
+# Does the work of vadp_setup.pl and vadp_cleanup.pl (see vadp_helper.pl
+# and vm_fix.pl) with pyVmomi: attaches and mounts the cloned luns on the
+# proxy host, registers and fixes their VMs, and cleans them up again.
+# One vSphere session per proxy host is shared by the whole process, and
+# saved in a session file for the next processes.
+# pyVmomi is optional, the handoff scripts run the Perl scripts when it is
+# not installed (see enabled()).
+###############################################################################
+import collections
+import http.client
+import os
+import re
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+
+try:
+    from pyVmomi import vim, vmodl
+    from pyVim import connect as vim_connect
+    from pyVim.task import WaitForTask
+except ImportError:
+    vim = None
+
+# Rescans of the same hba are shared with the other handoff processes
+from file_lock import FileLock
+
+# Defaults, see configure()
+ENGINE = 'auto'
+LOCK_DIR = '.'
+
+# Time allowed for a lun or a datastore to show up, in seconds
+DISCOVERY_DEADLINE = 60
+# Bounds of the wait between two discovery attempts, in seconds
+DISCOVERY_MIN_WAIT = 1
+DISCOVERY_MAX_WAIT = 16
+
+# Defaults of the vadp_setup.pl/vadp_cleanup.pl options
+INCLUDE_VMS = '.*'
+EXCLUDE_VMS = ''
+INCLUDE_HOSTS = '.*'
+EXCLUDE_HOSTS = ''
+VM_NAME_PREFIX = 'granite_clone_'
+
+# Snapshot taken by Granite on the VMs of the protected luns
+GRANITE_SNAPSHOT = 'granite_snapshot'
+
+# Result of the setup or cleanup of a lun
+#   error : error message, empty on success
+#   datastore : name of the datastore of the lun
+#   vms : names of the VMs registered on the proxy host (setup) or
+#         unregistered from it (cleanup)
+LunResult = collections.namedtuple('LunResult', 'error datastore vms')
+
+
+class VadpError(Exception):
+    pass
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+def configure(engine=None, lock_dir=None, discovery_deadline=None):
+    '''
+    Sets the VADP client parameters
+
+    engine : auto to use pyVmomi when it is installed, python or perl
+    lock_dir : directory of the rescan lock files, it is passed to the
+               Perl scripts as --work_dir so that they share them
+    discovery_deadline : seconds allowed for a lun and its datastore to
+                         show up, it is passed to the Perl scripts as
+                         --discovery_timeout
+    '''
+    global ENGINE, LOCK_DIR, DISCOVERY_DEADLINE
+    if engine is not None:
+        ENGINE = engine
+    if lock_dir is not None:
+        LOCK_DIR = lock_dir
+    if discovery_deadline is not None:
+        DISCOVERY_DEADLINE = discovery_deadline
+
+
+def is_available():
+    '''
+    Returns True if pyVmomi is installed
+    '''
+    return vim is not None
+
+
+def enabled():
+    '''
+    Returns True if the VADP operations run in process
+    '''
+    return ENGINE == 'python' or (ENGINE == 'auto' and is_available())
+
+
+def ssl_context():
+    # ESX hosts use self-signed certificates
+    return ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+
+
+def apply_filter(name, filters):
+    '''
+    Returns True if the name matches one of the comma
+    separated regular expressions
+    '''
+    for pattern in re.split(r'\s*,\s*', filters.strip()):
+        if pattern and re.search(pattern, name):
+            return True
+    return False
+
+
+def normalize_initiator(name):
+    '''
+    iSCSI names are case insensitive, FC WWNs are written with or without ':'
+    '''
+    name = name.lower()
+    if not re.match(r'(iqn|eui|naa)\.', name):
+        name = name.replace(':', '')
+    return name
+
+
+def hba_initiator(hba):
+    '''
+    Returns the initiator name of an hba, in the form of normalize_initiator
+    '''
+    if isinstance(hba, vim.host.InternetScsiHba):
+        return normalize_initiator(hba.iScsiName)
+    if getattr(hba, 'portWorldWideName', None) is not None:
+        return normalize_initiator('%016x' % (hba.portWorldWideName &
+                                              0xffffffffffffffff))
+    return None
+
+
+def get_hbas_to_be_scanned(storage_device, initiators):
+    '''
+    Returns the iSCSI and FC hbas of the initiators to which the luns
+    are mapped, all of them if no hba matches the initiators
+
+    storage_device : storage device info of the host
+    initiators : iSCSI names or FC port WWNs
+    '''
+    wanted = set(normalize_initiator(i.strip()) for i in initiators
+                 if i.strip())
+    selected = []
+    matching = []
+    for hba in storage_device.hostBusAdapter or []:
+        if not isinstance(hba, (vim.host.InternetScsiHba,
+                                vim.host.FibreChannelHba)):
+            continue
+        selected.append(hba.device)
+        if hba_initiator(hba) in wanted:
+            matching.append(hba.device)
+    if matching:
+        return matching
+    if wanted:
+        script_log("No hba matches the initiators %s, scanning all\n" %
+                   ','.join(initiators))
+    return selected
+
+
+def shared_rescan(storage, host_name, hba, not_before):
+    '''
+    Rescans an hba, or the VMFS volumes if hba is empty, unless a rescan
+    of it started after not_before. Uses the lock files of vadp_helper.pl,
+    concurrent requests of the scripts and of this module share the
+    rescan in flight instead of each running one.
+
+    storage : storage system of the host
+    host_name : name of the host
+    hba : the hba device, empty for the VMFS volumes
+    not_before : time after which the rescan must have started
+    '''
+    what = hba or 'vmfs'
+    file_name = re.sub(r'[^\w.-]', '_', 'rescan_%s_%s.lock' % (host_name, what))
+    lock = FileLock(os.path.join(LOCK_DIR, file_name))
+    lock.acquire()
+    try:
+        # The lock file holds the start time of the last rescan
+        fd = lock.fileno()
+        os.lseek(fd, 0, os.SEEK_SET)
+        last_start = os.read(fd, 64).decode('ascii', 'replace').strip()
+        try:
+            if float(last_start) >= not_before:
+                return
+        except ValueError:
+            pass
+
+        start = time.time()
+        try:
+            if hba:
+                storage.RescanHba(hbaDevice=hba)
+            else:
+                storage.RescanVmfs()
+        except vmodl.MethodFault as e:
+            script_log("Rescan of %s on %s failed: %s\n" %
+                       (what, host_name, e.msg))
+            return
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, ('%f\n' % start).encode('ascii'))
+    finally:
+        lock.release()
+
+
+def ascii_to_dec_str(value):
+    return ''.join(str(ord(c)) for c in value)
+
+
+def hex_to_dec_str(value):
+    try:
+        data = bytes.fromhex(value)
+    except ValueError:
+        return ''
+    return ''.join(str(b) for b in data)
+
+
+def get_scsi_serial(scsi_lun):
+    '''
+    Returns the serial of a scsi lun in the form of ascii_to_dec_str
+    '''
+    # Alternate names are not available if the device is not attached,
+    # the serial is then taken from the naa id. This is vendor specific,
+    # tested with Netapp.
+    if scsi_lun.alternateName is not None:
+        for alt in scsi_lun.alternateName:
+            if alt.namespace == 'SERIALNUM':
+                return ''.join(str(b) for b in alt.data)
+        return ''
+    match = re.match(r'^naa\.........(.*)', scsi_lun.canonicalName, re.I)
+    if match:
+        return hex_to_dec_str(match.group(1).split(',')[0].strip())
+    return ''
+
+
+def serial_match_scsi_luns(storage, serials):
+    '''
+    Returns a dict of serial -> scsi lun of the luns seen by the host
+
+    The lun serial could be in ASCII (netapp) or naa id decimal string
+    form (EMC), several variants are matched.
+    '''
+    variants = {}
+    for serial in serials:
+        variants[serial] = serial
+        variants[ascii_to_dec_str(serial)] = serial
+        variants['naa.' + serial.lower()] = serial
+
+    matches = {}
+    for scsi_lun in storage.storageDeviceInfo.scsiLun or []:
+        serial = get_scsi_serial(scsi_lun)
+        wwn = scsi_lun.canonicalName.lower()
+        key = serial if serial in variants else wwn
+        if key in variants:
+            matches[variants[key]] = scsi_lun
+            if len(matches) == len(serials):
+                break
+    return matches
+
+
+def split_file_path(path):
+    '''
+    Splits a datastore path, [<ds_name>] <vm_dir>/<file name>
+
+    returns (ds_name, vm_dir, file name)
+    '''
+    ds_idx = path.find('] ')
+    fname_idx = path.rfind('/')
+    return (path[1:ds_idx], path[ds_idx + 2:fname_idx],
+            path[fname_idx + 1:])
+
+
+def datastore_lun_serial(info):
+    '''
+    Returns the device name of the lun of a VMFS datastore, None for
+    other datastores. Datastores spanning several luns are not
+    supported, only the first extent is looked at.
+    '''
+    if not isinstance(info, vim.host.VmfsDatastoreInfo):
+        return None
+    extents = info.vmfs.extent
+    if not extents:
+        return None
+    return extents[0].diskName
+
+
+def find_snapshots(tree, name):
+    '''
+    Returns the snapshots of a snapshot tree with the name
+    '''
+    found = []
+    for node in tree or []:
+        if node.name == name:
+            found.append(node)
+        found.extend(find_snapshots(node.childSnapshotList, name))
+    return found
+
+
+class Watch(object):
+    '''
+    Watches properties for changes, using a property collector of our own.
+    Discovery loops wait on a watch instead of sleeping, so that they look
+    again as soon as something changed. If change notifications are not
+    available, waiting on the watch just sleeps.
+
+    si : the service instance
+    obj : the object to watch
+    obj_type : type of the watched objects
+    props : the watched properties
+    view : container view of the watched objects, obj is then the view.
+           The watch destroys the view when it is closed.
+    '''
+
+    def __init__(self, si, obj, obj_type, props, view=None):
+        self.version_ = ''
+        self.collector_ = None
+        self.view_ = view
+        PC = vmodl.query.PropertyCollector
+        try:
+            self.collector_ = si.content.propertyCollector.CreatePropertyCollector()
+            if view is not None:
+                traversal = PC.TraversalSpec(name='view', path='view',
+                                             skip=False,
+                                             type=vim.view.ContainerView)
+                obj_spec = PC.ObjectSpec(obj=obj, skip=True,
+                                         selectSet=[traversal])
+            else:
+                obj_spec = PC.ObjectSpec(obj=obj, skip=False)
+            prop_spec = PC.PropertySpec(type=obj_type, all=False,
+                                        pathSet=props)
+            self.collector_.CreateFilter(PC.FilterSpec(propSet=[prop_spec],
+                                                       objectSet=[obj_spec]),
+                                         partialUpdates=False)
+            # The first update holds the current values, skip it
+            self.sync()
+        except vmodl.MethodFault as e:
+            script_log("Change notifications not available, polling: %s\n" %
+                       e.msg)
+            self.close()
+
+    def sync(self):
+        '''
+        Skips the changes that happened so far, e.g. those caused by our
+        own rescans, so that only later changes end a wait
+        '''
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        while True:
+            update = self.collector_.WaitForUpdatesEx(self.version_, options)
+            if update is None:
+                break
+            self.version_ = update.version
+
+    def wait(self, seconds):
+        '''
+        Waits for a change, for at most seconds
+
+        returns True if something changed
+        '''
+        seconds = int(seconds + 0.5)
+        if seconds <= 0:
+            return False
+        if self.collector_ is None:
+            time.sleep(seconds)
+            return False
+        try:
+            self.sync()
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                          maxWaitSeconds=seconds)
+            update = self.collector_.WaitForUpdatesEx(self.version_, options)
+        except vmodl.MethodFault as e:
+            script_log("Waiting for changes failed, polling: %s\n" % e.msg)
+            self.close()
+            time.sleep(seconds)
+            return False
+        if update is None:
+            return False
+        self.version_ = update.version
+        return True
+
+    def close(self):
+        '''
+        Destroys the collector and view of the watch, the session
+        is shared and they must not be left behind
+        '''
+        for obj in (self.collector_, self.view_):
+            if obj is not None:
+                try:
+                    obj.Destroy()
+                except vmodl.MethodFault:
+                    pass
+        self.collector_ = None
+        self.view_ = None
+
+
+class DiscoveryPace(object):
+    '''
+    Pacing of a discovery loop: exponential backoff bounded by a deadline
+    '''
+
+    def __init__(self):
+        self.deadline_ = time.time() + DISCOVERY_DEADLINE
+        self.delay_ = DISCOVERY_MIN_WAIT
+
+    def wait(self, watch):
+        '''
+        Waits until the watched objects change, for at most the current
+        delay. The delay doubles each time nothing changed.
+
+        returns False if the deadline has passed, True if the caller
+        should look again
+        '''
+        left = self.deadline_ - time.time()
+        if left <= 0:
+            return False
+        if watch.wait(min(self.delay_, left)):
+            self.delay_ = DISCOVERY_MIN_WAIT
+        else:
+            self.delay_ = min(self.delay_ * 2, DISCOVERY_MAX_WAIT)
+        return True
+
+
+class VadpClient(object):
+    '''
+    VADP operations on a proxy host
+
+    host : the ESX proxy host (or its vCenter)
+    username, password : the proxy host credentials
+    session_file : file in which the session is saved for the next
+                   processes, the session is not saved if empty
+    '''
+
+    def __init__(self, host, username, password, session_file=''):
+        self.host_ = host
+        self.username_ = username
+        self.password_ = password
+        self.session_file_ = session_file
+        self.si_ = None
+        self.lock_ = threading.Lock()
+
+    def session_valid(self, si):
+        try:
+            return si.content.sessionManager.currentSession is not None
+        except vim.fault.NotAuthenticated:
+            return False
+
+    def load_session(self):
+        '''
+        Returns the service instance of the saved session, None if
+        there is no saved session or it has expired
+        '''
+        if not self.session_file_ or not os.path.exists(self.session_file_):
+            return None
+        try:
+            with open(self.session_file_) as f:
+                cookie = f.read().strip()
+            stub = vim_connect.SmartStubAdapter(host=self.host_,
+                                                sslContext=ssl_context())
+            stub.cookie = cookie
+            si = vim.ServiceInstance('ServiceInstance', stub)
+            if self.session_valid(si):
+                return si
+        except Exception as e:
+            script_log("Saved session not usable, logging in: %s\n" % str(e))
+        return None
+
+    def save_session(self, si):
+        # Write to a temporary file first, concurrent runs must
+        # not read a partially written session
+        tmp_file = '%s.%d' % (self.session_file_, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(si._stub.cookie)
+            os.replace(tmp_file, self.session_file_)
+        except OSError as e:
+            script_log("Unable to save the session in %s: %s\n" %
+                       (self.session_file_, str(e)))
+
+    def connect(self):
+        '''
+        Returns the service instance, logs in if the session has expired
+        '''
+        if vim is None:
+            raise VadpError('pyVmomi is not installed')
+        with self.lock_:
+            if self.si_ is not None and self.session_valid(self.si_):
+                return self.si_
+            self.si_ = self.load_session()
+            if self.si_ is None:
+                try:
+                    self.si_ = vim_connect.SmartConnect(
+                                   host=self.host_, user=self.username_,
+                                   pwd=self.password_,
+                                   sslContext=ssl_context())
+                except (vmodl.MethodFault, OSError) as e:
+                    raise VadpError('Unable to connect to ESXi/vCenter: %s' %
+                                    getattr(e, 'msg', str(e)))
+                if self.session_file_:
+                    self.save_session(self.si_)
+            return self.si_
+
+    def get_objects(self, obj_type, root=None, props=None):
+        '''
+        Returns the objects of a type under root, the whole inventory
+        if root is None. With props, returns a list of (object, dict of
+        property values), the properties are read in one call.
+        '''
+        content = self.si_.content
+        view = content.viewManager.CreateContainerView(
+                   root or content.rootFolder, [obj_type], True)
+        try:
+            if not props:
+                return list(view.view)
+            PC = vmodl.query.PropertyCollector
+            traversal = PC.TraversalSpec(name='view', path='view', skip=False,
+                                         type=vim.view.ContainerView)
+            spec = PC.FilterSpec(
+                       objectSet=[PC.ObjectSpec(obj=view, skip=True,
+                                                selectSet=[traversal])],
+                       propSet=[PC.PropertySpec(type=obj_type,
+                                                pathSet=props)])
+            return [(oc.obj, dict((p.name, p.val) for p in oc.propSet or []))
+                    for oc in content.propertyCollector.RetrieveContents([spec])]
+        finally:
+            view.Destroy()
+
+    def lookup_datacenter(self, name):
+        for dc, props in self.get_objects(vim.Datacenter, props=['name']):
+            if props.get('name') == name:
+                return dc
+        raise VadpError('Unable to lookup the datacenter %s' % name)
+
+    def get_host_list(self, datacenter, include_hosts, exclude_hosts):
+        hosts = []
+        for host, props in self.get_objects(vim.HostSystem, datacenter,
+                                            ['name']):
+            name = props.get('name', '')
+            if apply_filter(name, exclude_hosts):
+                script_log("Skipping host (exclude_filter): %s\n" % name)
+            elif not apply_filter(name, include_hosts):
+                script_log("Skipping host (include_filter): %s\n" % name)
+            else:
+                hosts.append(host)
+        return hosts
+
+    def get_host(self, datacenter, include_hosts, exclude_hosts):
+        hosts = self.get_host_list(datacenter, include_hosts, exclude_hosts)
+        if not hosts:
+            raise VadpError('Unable to locate ESXi hosts')
+        # Just pick the first host
+        return hosts[0]
+
+    def locate_datastores_for_luns(self, wwns, datacenter):
+        '''
+        Returns a dict of lun device name -> datastore
+        '''
+        found = {}
+        if not wwns:
+            return found
+        for ds, props in self.get_objects(vim.Datastore, datacenter,
+                                          ['name', 'info']):
+            wwn = datastore_lun_serial(props.get('info'))
+            if wwn in wwns:
+                found[wwn] = ds
+                if len(found) == len(wwns):
+                    break
+        return found
+
+    def locate_datastore_for_lun(self, wwn, datacenter):
+        return self.locate_datastores_for_luns([wwn], datacenter).get(wwn)
+
+    def watch_host_devices(self, host):
+        '''
+        Returns a watch of the devices seen by the host
+        '''
+        return Watch(self.si_, host.configManager.storageSystem,
+                     vim.host.StorageSystem, ['storageDeviceInfo'])
+
+    def watch_datastores(self, datacenter):
+        '''
+        Returns a watch of the datastores added, renamed or
+        mounted in the datacenter
+        '''
+        content = self.si_.content
+        view = content.viewManager.CreateContainerView(
+                   datacenter or content.rootFolder, [vim.Datastore], True)
+        return Watch(self.si_, view, vim.Datastore,
+                     ['name', 'summary.accessible'], view)
+
+    def attach_and_mount_lun(self, serial, datacenter, include_hosts,
+                             exclude_hosts, initiators, not_before):
+        '''
+        Attaches the lun to the proxy host and mounts its datastore
+
+        returns the datastore
+        '''
+        host = self.get_host(datacenter, include_hosts, exclude_hosts)
+        script_log("Starting setup operation on the host %s\n" % host.name)
+        storage = host.configManager.storageSystem
+        scan_hbas = get_hbas_to_be_scanned(storage.storageDeviceInfo,
+                                           initiators)
+
+        # Instead of sleeping between the attempts, wait for the host
+        # to see new devices or datastores
+        device_watch = self.watch_host_devices(host)
+        ds_watch = self.watch_datastores(datacenter)
+        try:
+            return self.discover_and_mount_lun(host, storage, scan_hbas,
+                                               serial, datacenter,
+                                               device_watch, ds_watch,
+                                               not_before)
+        finally:
+            device_watch.close()
+            ds_watch.close()
+
+    def discover_and_mount_lun(self, host, storage, scan_hbas, serial,
+                               datacenter, device_watch, ds_watch,
+                               not_before):
+        pace = DiscoveryPace()
+        host_name = host.name
+        ds = None
+        while True:
+            watch = ds_watch
+            for hba in scan_hbas:
+                shared_rescan(storage, host_name, hba, not_before)
+            # Rescans started from now on are needed by the next retry
+            not_before = time.time()
+
+            scsi_lun = serial_match_scsi_luns(storage, [serial]).get(serial)
+            if scsi_lun is None:
+                script_log("Could not locate scsi device for %s\n" % serial)
+                # Retry once the host sees new devices
+                watch = device_watch
+            else:
+                wwn = scsi_lun.canonicalName
+                datastore = self.locate_datastore_for_lun(wwn, datacenter)
+                if datastore is not None and datastore.summary.accessible:
+                    script_log("Datastore for lun %s is already mounted\n" % wwn)
+                    return datastore
+
+                try:
+                    storage.AttachScsiLun(lunUuid=scsi_lun.uuid)
+                    script_log("Successfully attached LUN %s\n" % serial)
+                except vim.fault.InvalidState:
+                    script_log("Device is already attached %s\n" % serial)
+
+                shared_rescan(storage, host_name, '', time.time())
+                # To mount the VMFS volume its VMFS UUID is needed, look
+                # for it in the unresolved vmfs volumes
+                datastore = self.mount_from_unresolved(host, wwn, storage,
+                                                       datacenter)
+                if datastore is not None:
+                    return datastore
+
+                # If ESXi had not seen the lun before then it will not show
+                # up in unresolved volumes. It shows up when it is looked
+                # up and it may need to be mounted.
+                shared_rescan(storage, host_name, '', time.time())
+                ds = self.locate_datastore_for_lun(wwn, datacenter)
+                if ds is not None:
+                    vmfs = ds.info.vmfs
+                    try:
+                        script_log("Mounting VMFS volume: %s\n" % vmfs.name)
+                        storage.MountVmfsVolume(vmfsUuid=vmfs.uuid)
+                    except vim.fault.InvalidState:
+                        script_log("Device is already mounted %s\n" % vmfs.name)
+
+            # Wait before the next retry cycle
+            if not pace.wait(watch):
+                break
+
+        if ds is None:
+            raise VadpError('Unable to mount the datastore')
+        return ds
+
+    def mount_from_unresolved(self, host, wwn, storage, datacenter):
+        '''
+        Force mounts the unresolved VMFS volume of the lun
+
+        returns its datastore, None if the lun has no unresolved volume
+        '''
+        datastore_system = host.configManager.datastoreSystem
+        for vmfs in datastore_system.QueryUnresolvedVmfsVolumes() or []:
+            label = vmfs.vmfsLabel
+            extents = vmfs.extent or []
+            device_paths = [e.devicePath for e in extents
+                            if e.device.diskName == wwn]
+            if not device_paths:
+                continue
+
+            # We may need to take additional actions depending
+            # on the resolve state
+            if not vmfs.resolveStatus.resolvable:
+                reason = 'Unknown error'
+                if vmfs.resolveStatus.incompleteExtents:
+                    reason = 'extents are missing'
+                elif vmfs.resolveStatus.multipleCopies:
+                    reason = 'duplicate extents found'
+                elif len(extents) > 1:
+                    reason = 'extra extents found'
+                script_log("Volume %s unresolvable: %s\n" % (label, reason))
+                # Detach all devices other than the one being mounted
+                for extent in extents:
+                    disk_name = extent.device.diskName
+                    if disk_name == wwn:
+                        continue
+                    try:
+                        self.lookup_and_detach_device(disk_name, storage)
+                    except vmodl.MethodFault:
+                        script_log("Detaching device %s failed\n" % disk_name)
+
+            script_log("Force mounting unresolved: %s\n" % label)
+            spec = vim.host.UnresolvedVmfsResolutionSpec(
+                       extentDevicePath=device_paths[-1:],
+                       uuidResolution='forceMount')
+            for attempt in range(2):
+                try:
+                    storage.ResolveMultipleUnresolvedVmfsVolumes(
+                        resolutionSpec=[spec])
+                except vmodl.MethodFault as e:
+                    script_log("Resolve unresolved volumes failed: %s: %s\n" %
+                               (label, e.msg))
+                    continue
+                datastore = self.locate_datastore_for_lun(wwn, datacenter)
+                if datastore is not None:
+                    return datastore
+                script_log("Unable to lookup datastore after resolving "
+                           "volume %s\n" % label)
+            break
+        return None
+
+    def lookup_and_detach_device(self, wwn, storage):
+        wwn = wwn.lower()
+        if 'naa.' not in wwn:
+            wwn = 'naa.' + wwn
+        for scsi_lun in storage.storageDeviceInfo.scsiLun or []:
+            if scsi_lun.canonicalName == wwn:
+                self.detach_device(storage, scsi_lun)
+                break
+
+    def detach_device(self, storage, scsi_lun):
+        wwn = scsi_lun.canonicalName
+        try:
+            storage.DetachScsiLun(lunUuid=scsi_lun.uuid)
+            script_log("Successfully detached LUN %s\n" % wwn)
+        except vim.fault.InvalidState:
+            script_log("Device is already detached %s\n" % wwn)
+        # Now remove the device from ESXi
+        try:
+            storage.DeleteScsiLunState(lunCanonicalName=wwn)
+        except vmodl.MethodFault as e:
+            script_log("Unable to delete lunstate %s: %s\n" % (wwn, e.msg))
+
+    def get_vmx_paths(self, ds):
+        task = ds.browser.SearchDatastoreSubFolders_Task(
+                   datastorePath='[%s]' % ds.summary.name)
+        WaitForTask(task, si=self.si_)
+        paths = []
+        for result in task.info.result or []:
+            for f in result.file or []:
+                if os.path.splitext(f.path)[1] == '.vmx':
+                    paths.append(result.folderPath + '/' + f.path)
+        return paths
+
+    def register_vm(self, vmx_path, datacenter=None,
+                    include_hosts=INCLUDE_HOSTS, exclude_hosts=EXCLUDE_HOSTS):
+        '''
+        Registers a VM on the proxy host
+
+        returns the VM, None if it was already registered
+        '''
+        if datacenter is None:
+            datacenter = self.get_objects(vim.Datacenter)[0]
+        host = self.get_host(datacenter, include_hosts, exclude_hosts)
+        # The root resource pool of the host
+        pool = host.parent.resourcePool
+        try:
+            task = datacenter.vmFolder.RegisterVM_Task(path=vmx_path,
+                                                       asTemplate=False,
+                                                       pool=pool)
+            WaitForTask(task, si=self.si_)
+        except vim.fault.AlreadyExists:
+            script_log("VM %s already registered\n" % vmx_path)
+            return None
+        return task.info.result
+
+    def rename_vm(self, vm, prefix):
+        if not prefix:
+            return
+        spec = vim.vm.ConfigSpec(name=prefix + vm.name)
+        WaitForTask(vm.ReconfigVM_Task(spec=spec), si=self.si_)
+
+    def prepare_vms_for_backup(self, ds, datacenter, include_hosts,
+                               exclude_hosts, include_vms, exclude_vms,
+                               vm_name_prefix):
+        '''
+        Registers the VMs of the datastore on the proxy host
+
+        returns the names of the registered VMs
+        '''
+        registered = []
+        for vmx_path in self.get_vmx_paths(ds):
+            try:
+                vm = self.register_vm(vmx_path, datacenter, include_hosts,
+                                      exclude_hosts)
+            except vmodl.MethodFault as e:
+                script_log("Error while registering VM: %s: %s\n" %
+                           (vmx_path, e.msg))
+                continue
+            if vm is None:
+                continue
+
+            vm_name = vm.name
+            if (apply_filter(vm_name, exclude_vms) or
+                not apply_filter(vm_name, include_vms)):
+                script_log("Skipping VM: %s\n" % vm_name)
+                try:
+                    vm.UnregisterVM()
+                except vmodl.MethodFault as e:
+                    script_log("Error while unregistering VM %s: %s\n" %
+                               (vm_name, e.msg))
+                continue
+
+            try:
+                self.rename_vm(vm, vm_name_prefix)
+            except vmodl.MethodFault as e:
+                script_log("Error while renaming VM %s: %s\n" %
+                           (vm_name, e.msg))
+            try:
+                self.fix_vm(ds, vm, datacenter)
+            except (vmodl.MethodFault, VadpError, OSError) as e:
+                script_log("Error while fixing the snapshot for VM %s: %s\n" %
+                           (vm_name, getattr(e, 'msg', str(e))))
+            registered.append(vm.name)
+        return registered
+
+    def datastore_file(self, method, ds_name, path, dc_name, body=None):
+        '''
+        Gets or puts a datastore file through the host's file service
+        '''
+        query = urllib.parse.urlencode({'dcPath': dc_name or 'ha-datacenter',
+                                        'dsName': ds_name})
+        url = '/folder/%s?%s' % (urllib.parse.quote(path), query)
+        headers = {'Cookie': self.si_._stub.cookie.split(';')[0]}
+        if body is not None:
+            headers['Content-Type'] = 'application/octet-stream'
+        conn = http.client.HTTPSConnection(self.host_, context=ssl_context())
+        try:
+            conn.request(method, url, body, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        finally:
+            conn.close()
+        if resp.status not in (200, 201):
+            raise VadpError('%s of %s unsuccessful: response status code %d' %
+                            (method, path, resp.status))
+        return data
+
+    def fix_vm(self, ds, vm, datacenter, no_overwrite=False):
+        '''
+        Points the disks of the vmx file of the VM to the disks
+        of its latest snapshot, see vm_fix.pl
+        '''
+        dc_name = datacenter.name if datacenter is not None else None
+        layout = vm.layoutEx
+        file_names = dict((f.key, f.name) for f in layout.file or [])
+
+        def top_file(disk):
+            return split_file_path(file_names[disk.chain[-1].fileKey[0]])[2]
+
+        disk_ids = dict((top_file(disk), disk.key)
+                        for disk in layout.disk or [])
+        if not layout.snapshot:
+            script_log("No snapshots for VM: %s, nothing more to be done\n" %
+                       vm.name)
+            return
+        disk_snaps = dict((disk.key, top_file(disk))
+                          for disk in layout.snapshot[-1].disk or [])
+
+        vmx_paths = [name for name in file_names.values()
+                     if name.endswith('.vmx')]
+        if not vmx_paths:
+            raise VadpError('Unable to locate the vmx file')
+        ds_name, vm_dir, vmx_file = split_file_path(vmx_paths[0])
+        remote_path = vm_dir + '/' + vmx_file
+
+        vmx = self.datastore_file('GET', ds.name, remote_path, dc_name)
+        lines = ['#Updated by Riverbed Granite at: %s' %
+                 time.strftime('%Y-%m-%d %H:%M:%S')]
+        locate_str = '.fileName = "'
+        for line in vmx.decode('utf-8', 'surrogateescape').splitlines():
+            idx = line.find(locate_str)
+            if 'scsi0:' in line and idx != -1:
+                idx += len(locate_str)
+                file_path = line[idx:-1]
+                dir_path, sep, fname = file_path.rpartition('/')
+                snap = disk_snaps.get(disk_ids.get(fname))
+                if snap:
+                    line = '%s%s%s%s"' % (line[:idx], dir_path, sep, snap)
+            lines.append(line)
+        fixed = ('\n'.join(lines) + '\n').encode('utf-8', 'surrogateescape')
+
+        # Do not overwrite the vmx file if explicitly requested
+        dest_path = remote_path + ('.fixed' if no_overwrite else '')
+        self.datastore_file('PUT', ds.name, remote_path + '.orig', dc_name, vmx)
+        self.datastore_file('PUT', ds.name, dest_path, dc_name, fixed)
+
+    def get_wwn_names(self, serials, datacenter, include_hosts, exclude_hosts):
+        '''
+        Returns a dict of serial -> lun device name of the luns
+        seen by the hosts
+        '''
+        found = {}
+        if not serials:
+            return found
+        hosts = self.get_host_list(datacenter, include_hosts, exclude_hosts)
+        if not hosts:
+            raise VadpError('Unable to locate ESXi hosts')
+        for host in hosts:
+            storage = host.configManager.storageSystem
+            for serial, scsi_lun in serial_match_scsi_luns(storage,
+                                                           serials).items():
+                found[serial] = scsi_lun.canonicalName
+        return found
+
+    def dump_changeid_info(self, vm):
+        snapshot = vm.snapshot
+        if snapshot is None or snapshot.currentSnapshot is None:
+            return
+        for device in snapshot.currentSnapshot.config.hardware.device:
+            if isinstance(device, vim.vm.device.VirtualDisk):
+                script_log("VM: %s Disk: %d, ChangeId: %s\n" %
+                           (vm.name, device.key,
+                            getattr(device.backing, 'changeId', None)))
+
+    def check_if_vm_in_use(self, vm):
+        '''
+        Returns True if the VM has snapshots other than the
+        Granite snapshot, i.e. a backup is in progress
+        '''
+        if vm.snapshot is None:
+            return False
+        for snapshot in find_snapshots(vm.snapshot.rootSnapshotList,
+                                       GRANITE_SNAPSHOT):
+            if snapshot.childSnapshotList:
+                script_log("VM %s has other non-granite snapshots\n" % vm.name)
+                return True
+        return False
+
+    def unregister_vms(self, ds, fail_if_in_use):
+        '''
+        Unregisters the VMs of the datastore
+
+        returns (names of the VMs unregistered, vmx paths of the VMs
+                 with their vmx file on other datastores)
+        '''
+        ds_name = ds.name
+        unregistered = []
+        other_ds_vms = []
+        for vm in ds.vm or []:
+            vm_name = vm.name
+            vmx_path = vm.config.files.vmPathName
+            if split_file_path(vmx_path)[0] != ds_name:
+                other_ds_vms.append(vmx_path)
+            self.dump_changeid_info(vm)
+            if fail_if_in_use and self.check_if_vm_in_use(vm):
+                raise VadpError('VM %s is in use' % vm_name)
+            try:
+                vm.UnregisterVM()
+                unregistered.append(vm_name)
+            except vmodl.MethodFault as e:
+                script_log("Error while unregistering VM %s: %s\n" %
+                           (vm_name, e.msg))
+        return unregistered, other_ds_vms
+
+    def umount_and_detach(self, ds, initiators):
+        ds_name = ds.name
+        info = ds.info
+        hosts = ds.host or []
+        if not hosts:
+            script_log("No hosts are attached to the datastore: %s\n" % ds_name)
+            return
+        if len(hosts) > 1:
+            raise VadpError('More than one hosts are attached to the '
+                            'datastore %s: %d' % (ds_name, len(hosts)))
+        host = hosts[0].key
+        storage = host.configManager.storageSystem
+        try:
+            storage.UnmountVmfsVolume(vmfsUuid=info.vmfs.uuid)
+            script_log("Successfully unmounted VMFS datastore %s\n" % ds_name)
+        except vim.fault.InvalidState:
+            script_log("Device is already unmounted %s\n" % ds_name)
+
+        self.lookup_and_detach_device(info.vmfs.extent[0].diskName, storage)
+        detached = time.time()
+
+        # Scan the hbas to clear the vmfs volume from vcenter/esxi's view
+        host_name = host.name
+        for hba in get_hbas_to_be_scanned(storage.storageDeviceInfo,
+                                          initiators):
+            shared_rescan(storage, host_name, hba, detached)
+
+    def setup(self, serials, initiators=(), datacenter='',
+              include_hosts=INCLUDE_HOSTS, exclude_hosts=EXCLUDE_HOSTS,
+              include_vms=INCLUDE_VMS, exclude_vms=EXCLUDE_VMS,
+              vm_name_prefix=VM_NAME_PREFIX):
+        '''
+        Mounts the cloned luns on the proxy host and registers their VMs,
+        does the work of vadp_setup.pl
+
+        serials : the cloned lun serials
+        initiators : the initiators to which the luns are mapped, only
+                     their hbas are rescanned
+
+        returns a dict of serial -> LunResult
+        '''
+        # The luns were mapped before we started, any rescan
+        # started since sees them
+        not_before = time.time()
+        self.connect()
+        dc = datacenter and self.lookup_datacenter(datacenter) or None
+        results = {}
+        for serial in serials:
+            try:
+                ds = self.attach_and_mount_lun(serial, dc, include_hosts,
+                                               exclude_hosts, initiators,
+                                               not_before)
+            except (vmodl.MethodFault, VadpError) as e:
+                script_log("Error while mounting the lun %s: %s\n" %
+                           (serial, getattr(e, 'msg', str(e))))
+                results[serial] = LunResult('Error while mounting the lun %s' %
+                                            serial, '', [])
+                continue
+
+            ds_name = ds.name
+            script_log("Mounted %s on %s, preparing VMs for backup\n" %
+                       (serial, ds_name))
+            try:
+                vms = self.prepare_vms_for_backup(ds, dc, include_hosts,
+                                                  exclude_hosts, include_vms,
+                                                  exclude_vms, vm_name_prefix)
+            except (vmodl.MethodFault, VadpError) as e:
+                script_log("Error while preparing VMs in the lun %s: %s\n" %
+                           (serial, getattr(e, 'msg', str(e))))
+                results[serial] = LunResult('Error while preparing VMs in '
+                                            'the lun %s' % serial, ds_name, [])
+                continue
+            results[serial] = LunResult('', ds_name, vms)
+        return results
+
+    def cleanup(self, serials, initiators=(), datacenter='',
+                include_hosts=INCLUDE_HOSTS, exclude_hosts=EXCLUDE_HOSTS,
+                fail_if_backup_in_progress=False):
+        '''
+        Unregisters the VMs of the cloned luns and un-mounts them from
+        the proxy host, does the work of vadp_cleanup.pl
+
+        serials : the cloned lun serials
+        initiators : the initiators to which the luns are mapped, only
+                     their hbas are rescanned
+        fail_if_backup_in_progress : do not clean up a lun whose VMs
+                                     are being backed up
+
+        returns a dict of serial -> LunResult, luns that are not
+        mounted on the proxy host are cleaned up already
+        '''
+        self.connect()
+        dc = datacenter and self.lookup_datacenter(datacenter) or None
+        results = dict((serial, LunResult('', '', [])) for serial in serials)
+
+        serial_wwns = self.get_wwn_names(serials, dc, include_hosts,
+                                         exclude_hosts)
+        wwn_serials = dict((wwn, serial) for serial, wwn in serial_wwns.items())
+        lun_datastores = self.locate_datastores_for_luns(list(wwn_serials), dc)
+        if not lun_datastores:
+            script_log("Unable to locate any datastores\n")
+
+        for wwn, ds in lun_datastores.items():
+            serial = wwn_serials[wwn]
+            ds_name = ds.name
+            try:
+                vms, other_ds_vms = self.unregister_vms(
+                                        ds, fail_if_backup_in_progress)
+            except (vmodl.MethodFault, VadpError) as e:
+                script_log("Failed to unregister the VMs of %s: %s\n" %
+                           (ds_name, getattr(e, 'msg', str(e))))
+                results[serial] = LunResult('Failed to unregister the VMs, '
+                                            'backup possibly in progress?',
+                                            ds_name, [])
+                continue
+
+            error = ''
+            try:
+                self.umount_and_detach(ds, initiators)
+            except (vmodl.MethodFault, VadpError) as e:
+                script_log("Unmount failure for %s: %s: %s\n" %
+                           (serial, ds_name, getattr(e, 'msg', str(e))))
+                error = 'Unmount of datastore %s failed' % ds_name
+
+            # Re-register VMs from other datastores after the unmount
+            for vmx_path in other_ds_vms:
+                script_log("Re-registering VM %s\n" % vmx_path)
+                try:
+                    self.register_vm(vmx_path)
+                except vmodl.MethodFault as e:
+                    script_log("Error while registering VM: %s: %s\n" %
+                               (vmx_path, e.msg))
+            results[serial] = LunResult(error, ds_name, vms)
+        return results
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host, username, password, session_file=''):
+    '''
+    Returns the client of a proxy host shared by the process
+
+    host : the ESX proxy host
+    username, password : the proxy host credentials
+    session_file : file in which the session is saved for the next
+                   processes, see VadpClient
+    '''
+    key = (host, username)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None or client.password_ != password:
+            client = VadpClient(host, username, password, session_file)
+            _clients[key] = client
+    return client
@@ -25,14 +25,18 @@
 use strict;
 use warnings;
 use File::Basename qw(dirname);
+use File::Spec;
 use Cwd qw(abs_path);
+use Fcntl qw(:flock);
+use Time::HiRes qw(time);
 use lib dirname(abs_path(__FILE__));
 require "vm_common.pl";
 require "vm_fix.pl";
 
 sub attach_and_mount_lun {
     my $log = LogHandle->new("attach_and_mount");
-    my ($lun_serial, $datacenter, $include_hosts, $exclude_hosts) = @_;
+    my ($lun_serial, $datacenter, $include_hosts, $exclude_hosts,
+        $initiators) = @_;
 
     #Just pick the first host
     my $host = get_host($datacenter, $include_hosts, $exclude_hosts);
@@ -40,31 +44,49 @@ sub attach_and_mount_lun {
     my $storage = Vim::get_view(mo_ref => $host->configManager->storageSystem);
     my $datastore;
 
-    my $scan_hbas = get_hbas_to_be_scanned($storage->storageDeviceInfo);
-    
-    my $MAX_RETRIES = 2;
+    my $scan_hbas = get_hbas_to_be_scanned($storage->storageDeviceInfo,
+                                           $initiators);
+
+    #Instead of sleeping between the attempts, wait for the host to see
+    #new devices or datastores, see discovery_wait
+    my $device_watch = watch_host_devices($host);
+    my $ds_watch = watch_datastores($datacenter);
     my $ds;
-    my $count = 0;
-    for ($count = 0; $count <= $MAX_RETRIES; $count++) {
+    eval {
+        $ds = discover_and_mount_lun($host, $storage, $scan_hbas, $lun_serial,
+                                     $datacenter, $device_watch, $ds_watch,
+                                     $log);
+    };
+    my $err = $@;
+    watch_close($device_watch);
+    watch_close($ds_watch);
+    die $err if $err;
+    return $ds;
+}
+
+sub discover_and_mount_lun {
+    my ($host, $storage, $scan_hbas, $lun_serial, $datacenter,
+        $device_watch, $ds_watch, $log) = @_;
+    my $pace = discovery_pace();
+    my $host_name = $host->name;
+    #The lun was mapped before we started, any rescan started since sees it
+    my $not_before = $^T;
+    my $watch;
+    my $ds;
+    while (1) {
+        $watch = $ds_watch;
         foreach (@$scan_hbas) {
-            my $hba = $_;
-            $log->debug("Scanning hba $hba");
-            eval {
-                $storage->RescanHba(hbaDevice => $hba);
-            };
-            if ($@) {
-                $log->warn("Scan HBA failed for $hba: ". $@);
-            }
-            #XXX: More appropriate actions depending on the type of error
+            shared_rescan($storage, $host_name, $_, $not_before, $log);
         }
+        #Rescans started from now on are needed by the next retry
+        $not_before = time();
         $storage = Vim::get_view(mo_ref => $host->configManager->storageSystem);
         #Walk through the scsi luns and the locate the lun that is of interest.
         my $scsi_device = serial_match_scsi_lun($storage, $lun_serial, $log);
         if (! defined($scsi_device)) {
             $log->info("Could not locate scsi device for $lun_serial");
-            #Retry
-            #Sleep before the next retry cycle
-            sleep(2);
+            #Retry once the host sees new devices
+            $watch = $device_watch;
             next;
         }
         my $wwn_serial = $scsi_device->canonicalName;
@@ -92,13 +114,7 @@ sub attach_and_mount_lun {
             }
         }
         #Rescan for VMFS volumes
-        eval {
-            $storage->RescanVmfs();
-        };
-        if ($@) {
-            $log->warn("Rescan VMFS volumes failed " . $@);
-            #proceed forward.
-        }
+        shared_rescan($storage, $host_name, '', time(), $log);
         #Inorder to mount the VMFS volume we need to determine the VMFS UUID 
         #Get a list of unresolved vmfs volumes and check if any of them matches the device.
         $datastore = mount_from_unresolved($host, $wwn_serial, $storage, $datacenter);
@@ -109,13 +125,7 @@ sub attach_and_mount_lun {
         #unresolved volumes.  It will show up when it is looked up and it may
         #need to be mounted
         $log->debug("Trying to mount the volume by looking up datastore");
-        eval {
-            $storage->RescanVmfs();
-        };
-        if ($@) {
-            $log->warn("Rescan vmfs volumes failed: " . $@);
-            #proceed
-        }
+        shared_rescan($storage, $host_name, '', time(), $log);
         $ds = locate_datastore_for_lun($wwn_serial, $datacenter);
         if (defined ($ds)) {
             my $vmfs_name = $ds->info->vmfs->name;
@@ -137,12 +147,14 @@ sub attach_and_mount_lun {
                 }
             }
         }
-        #Sleep before the next retry cycle
-        sleep(2);
+    } continue {
+        #Wait before the next retry cycle
+        last if !discovery_wait($pace, $watch);
     }
     if (! defined($ds)) {
         die "Unable to mount the datastore";
     }
+    return $ds;
 }
 
 sub mount_from_unresolved {
@@ -569,7 +581,7 @@ sub detach_device {
 }
 
 sub umount_and_detach {
-    my $ds = shift;
+    my ($ds, $initiators) = @_;
     my $ds_name = $ds->name;
     my $disk_name = $ds->info->vmfs->extent->[0]->diskName;
     my $log = LogHandle->new("umount_and_detach");
@@ -608,18 +620,13 @@ sub umount_and_detach {
         $log->info("Successfully unmounted VMFS datastore $ds_name");
     }
     lookup_and_detach_device($disk_name, $storageSys);
+    my $detached = time();
 
     #Scan the hbas to clear the vmfs volume from vcenter/esxi's view
-    my $scan_hbas = get_hbas_to_be_scanned($storageSys->storageDeviceInfo);
+    my $scan_hbas = get_hbas_to_be_scanned($storageSys->storageDeviceInfo,
+                                           $initiators);
     foreach (@$scan_hbas) {
-        my $hba = $_;
-        $log->debug("Scanning hba $hba");
-        eval {
-            $storageSys->RescanHba(hbaDevice => $hba);
-        };
-        if ($@) {
-            $log->warn("Scan HBA failed for $hba: ". $@);
-        }
+        shared_rescan($storageSys, $hostView->{'name'}, $_, $detached, $log);
     }
 }
 
@@ -659,11 +666,20 @@ sub get_wwn_names {
     return \%serial_wwn_hash;
 }
 
+#Selects the iSCSI and FC hbas to rescan.
+#Input: storage device info of the host, optional comma separated
+#       initiators (iSCSI names or FC port WWNs) to which the luns are mapped
+#Return: the hbas of the initiators if any matches, all of them otherwise
 sub get_hbas_to_be_scanned {
-    my $storage_device = shift;
+    my ($storage_device, $initiators) = @_;
     my $all_hbas = $storage_device->hostBusAdapter;
-    my $selected_hbas;
+    my $selected_hbas = [];
+    my $matching_hbas = [];
     my $log = LogHandle->new("select_hbas");
+    my %wanted = ();
+    foreach (split('\s*,\s*', defined($initiators) ? $initiators : '')) {
+        $wanted{normalize_initiator($_)} = 1 if $_ ne '';
+    }
     foreach (@$all_hbas) {
         my $hba = $_;
         my $hba_type = ref($hba);
@@ -671,11 +687,96 @@ sub get_hbas_to_be_scanned {
             my $hba_name = $hba->device;
             $log->diag("Selecting $hba_name of type $hba_type");
             push(@$selected_hbas, $hba_name);
+            my $initiator = hba_initiator($hba);
+            if (defined($initiator) && $wanted{$initiator}) {
+                $log->diag("$hba_name is the initiator $initiator");
+                push(@$matching_hbas, $hba_name);
+            }
         }
     }
+    if (scalar(@$matching_hbas) > 0) {
+        return $matching_hbas;
+    }
+    if (scalar(keys %wanted) > 0) {
+        $log->info("No hba matches the initiators $initiators, scanning all");
+    }
     return $selected_hbas;
 }
 
+#Returns the initiator name of an hba, in the form of normalize_initiator
+sub hba_initiator {
+    my $hba = shift;
+    if (ref($hba) eq "HostInternetScsiHba") {
+        return normalize_initiator($hba->iScsiName);
+    }
+    if (defined($hba->portWorldWideName)) {
+        return normalize_initiator(sprintf("%016x", $hba->portWorldWideName));
+    }
+    return;
+}
+
+#iSCSI names are case insensitive, FC WWNs are written with or without ':'
+sub normalize_initiator {
+    my $name = lc(shift);
+    $name =~ s/://g if $name !~ /^(iqn|eui|naa)\./;
+    return $name;
+}
+
+#Directory of the rescan lock files, the work dir of the handoff scripts
+#when it is given so that they share the rescans with this script
+sub get_lock_dir {
+    my $work_dir;
+    eval {
+        $work_dir = Opts::get_option('work_dir');
+    };
+    return defined($work_dir) && $work_dir ne "" ? $work_dir :
+        dirname(abs_path(__FILE__));
+}
+
+#Rescans an hba, or the VMFS volumes if $hba is empty, unless a rescan
+#of it started after $not_before. Runs for the same host and hba are
+#serialized on a lock file, so concurrent requests share the rescan in
+#flight instead of each running one.
+sub shared_rescan {
+    my ($storage, $host_name, $hba, $not_before, $log) = @_;
+    my $what = $hba ne '' ? $hba : 'vmfs';
+    (my $file_name = "rescan_${host_name}_$what.lock") =~ s/[^\w.-]/_/g;
+    my $lock_path = File::Spec->catfile(get_lock_dir(), $file_name);
+    my $fh;
+    if (open($fh, '+>>', $lock_path) && flock($fh, LOCK_EX)) {
+        #The lock file holds the start time of the last rescan
+        seek($fh, 0, 0);
+        my $last_start = <$fh>;
+        if (defined($last_start) && $last_start =~ /^[\d.]+$/ &&
+            $last_start >= $not_before) {
+            $log->debug("Rescan of $what on $host_name already done");
+            close($fh);
+            return;
+        }
+    } else {
+        $log->warn("Unable to lock $lock_path: $!");
+        undef $fh;
+    }
+
+    my $start = time();
+    $log->debug("Scanning $what on $host_name");
+    eval {
+        if ($hba ne '') {
+            $storage->RescanHba(hbaDevice => $hba);
+        } else {
+            $storage->RescanVmfs();
+        }
+    };
+    if ($@) {
+        $log->warn("Rescan of $what failed: " . $@);
+        #XXX: More appropriate actions depending on the type of error
+    } elsif (defined($fh)) {
+        truncate($fh, 0);
+        print $fh "$start\n";
+    }
+    close($fh) if defined($fh);
+}
+
 sub get_host_list {
     my ($datacenter, $include_filter, $exclude_filter) = @_;
     my $host_list;
@@ -79,6 +79,30 @@ my %opts = (
         default => 'granite_clone_',
         required => 0,
     },
+    'initiators' => {
+    type => "=s",
+    help => "Comma separated initiators to which the luns are mapped, only their hbas are rescanned",
+    default => '',
+    required => 0,
+    },
+    'session_file' => {
+    type => "=s",
+    help => "File in which the ESX session is saved and reused between runs",
+    default => '',
+    required => 0,
+    },
+    'work_dir' => {
+    type => "=s",
+    help => "Directory of the rescan lock files, shared with the handoff scripts",
+    default => '',
+    required => 0,
+    },
+    'discovery_timeout' => {
+    type => "=i",
+    help => "Seconds allowed for a lun and its datastore to show up, 0 for the default (60)",
+    default => 0,
+    required => 0,
+    },
     'extra_logging' => {
     type => "=i",
     help => "Set to > 0 for extra logging information",
@@ -111,6 +135,7 @@ my $include_hosts = trim_wspace(Opts::get_option('include_hosts'));
 my $exclude_hosts = trim_wspace(Opts::get_option('exclude_hosts'));
 my $vm_name_prefix = trim_wspace(Opts::get_option('vm_name_prefix'));
 my $extra_logging = int(trim_wspace(Opts::get_option('extra_logging')));
+my $initiators = trim_wspace(Opts::get_option('initiators'));
 
 my @luns = split('\s*,\s*', $lunlist);
 
@@ -121,7 +146,6 @@ my $log = LogHandle->new("vadp_setup");
 #Connect to the ESX server.
 esxi_connect($log);
 
-sleep(30);
 #Lookup datacenter
 my $dc_view;
 if ($datacenter ne "") {
@@ -141,12 +165,14 @@ foreach (@luns) {
     my $lun = $_;
     my $ds;
     eval {
-        $ds = attach_and_mount_lun($lun, $dc_view, $include_hosts, $exclude_hosts);
+        $ds = attach_and_mount_lun($lun, $dc_view, $include_hosts, $exclude_hosts,
+                                   $initiators);
     };
     if ($@) {
         $fail_msg = "Error while mounting the lun $_";
         $log->error("$fail_msg : $@");
         $lun_mount_err = 1;
+        print "LUN: $lun FAILURE - $fail_msg\n";
     } else {
         eval {
             $log->info("Mounted successfully, preparing VMs for backup");
@@ -157,6 +183,10 @@ foreach (@luns) {
             $fail_msg = "Error while preparing VMs in the lun $_";
             $log->error("$fail_msg : $@");
             $prepare_vm_err = 1;
+            print "LUN: $lun FAILURE - $fail_msg\n";
+        } else {
+            #Per lun status, the handoff scripts mount many luns per run
+            print "LUN: $lun SUCCESS\n";
         }
     }
 }
@@ -81,73 +81,175 @@ sub locate_datastore_for_lun {
     return $lun_ds_hash->{$lun};
 }
 
-sub locate_unique_datastore_for_lun {
-    my ($lun, $datacenter) = @_;
-    my $log = LogHandle->new("unique_datastores");
-
-    $log->diag("Trying to get data store for $lun");
-    my $retry_count = 0;
-    my $dup_data_store_exits = 0;
-    my $dup_ds_name = '';
-    while ($retry_count++ < 5) {
-        my $datastores;
-        
-        # For error message when we exit
-        $dup_data_store_exits = 0;
-        $dup_ds_name = '';
-
-        if (defined ($datacenter)) {
-            $datastores = Vim::find_entity_views(view_type => 'Datastore', 
-                                                    begin_entity => $datacenter);
+#Time allowed for a lun or a datastore to show up, in seconds, unless
+#the discovery_timeout option is set
+my $DISCOVERY_DEADLINE = 60;
+#Bounds of the wait between two discovery attempts, in seconds
+my $DISCOVERY_MIN_WAIT = 1;
+my $DISCOVERY_MAX_WAIT = 16;
+
+#Watches properties for changes, using a property collector of our own.
+#Discovery loops wait on a watch instead of sleeping, so that they look
+#again as soon as something changed.
+#Input: object to watch, type and properties of the watched objects,
+#       optional traversal from the object to the watched objects
+#Return: watch handle. If change notifications are not available,
+#        waiting on the watch just sleeps.
+sub watch_properties {
+    my ($mo_ref, $type, $props, $traversal) = @_;
+    my $log = LogHandle->new("watch");
+    my %watch = (version => '');
+    eval {
+        my $service_collector = Vim::get_view(
+                    mo_ref => Vim::get_service_content()->propertyCollector);
+        $watch{collector_ref} = $service_collector->CreatePropertyCollector();
+        $watch{collector} = Vim::get_view(mo_ref => $watch{collector_ref});
+        my $obj_spec;
+        if (defined($traversal)) {
+            $obj_spec = ObjectSpec->new(obj => $mo_ref, skip => 1,
+                                        selectSet => [$traversal]);
         } else {
-            $datastores = Vim::find_entity_views(view_type => 'Datastore');
-        }
-        
-        my %ds_names_hash = ();
-        my $dups_found = 0;
-        my $data_store;
-        foreach (@$datastores) {
-            my $ds = $_;
-            my $ds_name = $ds->name;
-            my $lun_serial = datastore_lun_serial($ds);
-            #Some datastores need not be on iscsi luns and such will be ignored.
-            if (defined($lun_serial)) {
-                $log->diag("Found datastore $ds_name with lun $lun_serial");
-                #Check if the lun serial matches any the requested luns
-                if ($lun_serial eq $lun) {
-                    $log->info("Datastore $ds_name for $lun is the one that matches");
-                    $data_store = $ds;
-                }
-            }
-            $ds_names_hash{$ds_name}++;
+            $obj_spec = ObjectSpec->new(obj => $mo_ref, skip => 0);
         }
+        my $prop_spec = PropertySpec->new(type => $type, all => 0,
+                                          pathSet => $props);
+        my $filter_spec = PropertyFilterSpec->new(propSet => [$prop_spec],
+                                                  objectSet => [$obj_spec]);
+        $watch{collector}->CreateFilter(spec => $filter_spec,
+                                        partialUpdates => 0);
+        #The first update holds the current values, skip it
+        watch_sync(\%watch);
+    };
+    if ($@) {
+        $log->debug("Change notifications not available, polling: $@");
+        watch_close(\%watch);
+    }
+    return \%watch;
+}
 
-        # Check if we have duplicates
-        if (!defined($data_store) ||
-            (defined($ds_names_hash{$data_store->name}) && 
-            $ds_names_hash{$data_store->name} > 1)) {
-            if (defined($data_store)) {
-                $dup_data_store_exits = 1;
-                $dup_ds_name = $data_store->name;
-                $log->info("Found datastore on more than one lun, ".
-                           "rescanning and waiting for renaming the datastore");
-	    } else {
-                $log->info("Could not find the datastore for $lun, ".
-                           "rescanning again...");
-	    }
-            sleep(20);
-            next;
-        }
-        my $ds_found_name = $data_store->name;
-        $log->info("Found datastore $ds_found_name successfully for $lun");
-        return $data_store
+#Watches the devices seen by the host
+sub watch_host_devices {
+    my ($host) = @_;
+    return watch_properties($host->configManager->storageSystem,
+                            'HostStorageSystem', ['storageDeviceInfo']);
+}
+
+#Watches the datastores added, renamed or mounted in the datacenter
+sub watch_datastores {
+    my ($datacenter) = @_;
+    my $view;
+    eval {
+        my $root = defined($datacenter) ? $datacenter->{mo_ref} :
+                                          Vim::get_service_content()->rootFolder;
+        my $view_mgr = Vim::get_view(
+                           mo_ref => Vim::get_service_content()->viewManager);
+        $view = $view_mgr->CreateContainerView(container => $root,
+                                               type => ['Datastore'],
+                                               recursive => 1);
+    };
+    if ($@) {
+        my $log = LogHandle->new("watch");
+        $log->debug("Unable to create the datastore view, polling: $@");
+        return {version => ''};
+    }
+    my $traversal = TraversalSpec->new(name => 'view', path => 'view',
+                                       skip => 0, type => 'ContainerView');
+    my $watch = watch_properties($view, 'Datastore',
+                                 ['name', 'summary.accessible'], $traversal);
+    $watch->{view} = $view;
+    return $watch;
+}
+
+#Skips the changes that happened so far, e.g. those caused by our own
+#rescans, so that only later changes end a wait
+sub watch_sync {
+    my ($watch) = @_;
+    while (1) {
+        my $update = $watch->{collector}->WaitForUpdatesEx(
+                         version => $watch->{version},
+                         options => WaitOptions->new(maxWaitSeconds => 0));
+        last if !defined($update);
+        $watch->{version} = $update->version;
+    }
+}
+
+#Waits for a change on the watch, for at most $seconds
+#Return: 1 if something changed, 0 otherwise
+sub watch_wait {
+    my ($watch, $seconds) = @_;
+    $seconds = int($seconds + 0.5);
+    return 0 if $seconds <= 0;
+    if (!defined($watch->{collector})) {
+        sleep($seconds);
+        return 0;
+    }
+    my $update;
+    eval {
+        watch_sync($watch);
+        $update = $watch->{collector}->WaitForUpdatesEx(
+                      version => $watch->{version},
+                      options => WaitOptions->new(maxWaitSeconds => $seconds));
+    };
+    if ($@) {
+        my $log = LogHandle->new("watch");
+        $log->warn("Waiting for changes failed, polling: $@");
+        watch_close($watch);
+        sleep($seconds);
+        return 0;
+    }
+    return 0 if !defined($update);
+    $watch->{version} = $update->version;
+    return 1;
+}
+
+#Destroys the collector and view of the watch. The session is reused by
+#the next runs, they must not be left behind.
+sub watch_close {
+    my ($watch) = @_;
+    if (defined($watch->{collector})) {
+        eval {
+            $watch->{collector}->DestroyPropertyCollector();
+        };
     }
-    if ($dup_data_store_exits == 1) {
-        $log->error("Another datastore exits with the same name $dup_ds_name ".
-                    "as that on the cloned lun $lun");
-        die "Cannot perform data protection because of duplicate data store";
+    if (defined($watch->{view})) {
+        eval {
+            Vim::get_view(mo_ref => $watch->{view})->DestroyView();
+        };
     }
-    return;
+    $watch->{collector} = undef;
+    $watch->{view} = undef;
+}
+
+#Pacing of a discovery loop: exponential backoff bounded by a deadline
+sub discovery_pace {
+    my $timeout;
+    eval {
+        $timeout = Opts::get_option('discovery_timeout');
+    };
+    if (!defined($timeout) || $timeout <= 0) {
+        $timeout = $DISCOVERY_DEADLINE;
+    }
+    return {deadline => time() + $timeout,
+            delay => $DISCOVERY_MIN_WAIT};
+}
+
+#Waits until the watched objects change, for at most the current delay.
+#The delay doubles each time nothing changed.
+#Return: 0 if the deadline has passed, 1 if the caller should look again
+sub discovery_wait {
+    my ($pace, $watch) = @_;
+    my $left = $pace->{deadline} - time();
+    return 0 if $left <= 0;
+    my $delay = $pace->{delay} < $left ? $pace->{delay} : $left;
+    if (watch_wait($watch, $delay)) {
+        $pace->{delay} = $DISCOVERY_MIN_WAIT;
+    } else {
+        $pace->{delay} = $pace->{delay} * 2;
+        if ($pace->{delay} > $DISCOVERY_MAX_WAIT) {
+            $pace->{delay} = $DISCOVERY_MAX_WAIT;
+        }
+    }
+    return 1;
 }
 
 
@@ -406,8 +508,34 @@ sub unregister_vm {
     $log->diag("VM $vm_name successfully unregistered");
 }
 
+#Set when the session is saved for the next runs, it is then left logged in
+my $session_saved = 0;
+
+#Connects to the ESX server.
+#If the session_file option is set, the session saved in it by an earlier
+#run is reused. When there is no saved session, or it has expired, we log
+#in and save the new session for the next runs.
 sub esxi_connect {
     my $log = shift;
+    my $session_file = get_session_file();
+
+    if ($session_file ne "" && -e $session_file) {
+        eval {
+            Vim::load_session(service_url => Opts::get_option('url'),
+                              session_file => $session_file);
+            #Loading the session does not check that it is still valid
+            my $sm = Vim::get_view(
+                         mo_ref => Vim::get_service_content()->sessionManager);
+            die "Session expired\n" unless defined $sm->currentSession;
+        };
+        if (!$@) {
+            $log->debug("Reusing the session saved in $session_file");
+            $session_saved = 1;
+            return;
+        }
+        $log->debug("Saved session not usable, logging in: $@");
+    }
+
     eval  {
         Util::connect();
     };
@@ -415,11 +543,40 @@ sub esxi_connect {
         $log->error("Connection error: $@");
         FAILURE("Unable to connect to ESXi/vCenter");
     }
+
+    if ($session_file ne "") {
+        #Write to a temporary file first, concurrent runs must not
+        #read a partially written session
+        my $tmp_file = "$session_file.$$";
+        eval {
+            Vim::save_session(session_file => $tmp_file);
+            rename($tmp_file, $session_file) or die "rename failed: $!\n";
+            $session_saved = 1;
+        };
+        if ($@) {
+            $log->warn("Unable to save the session in $session_file: $@");
+            unlink($tmp_file);
+        }
+    }
+}
+
+sub get_session_file {
+    my $session_file;
+    eval {
+        $session_file = Opts::get_option('session_file');
+    };
+    return defined($session_file) ? $session_file : "";
+}
+
+sub esxi_disconnect {
+    #A saved session is reused by the next runs, do not log it out
+    return if $session_saved;
+    Util::disconnect();
 }
 
 sub SUCCESS {
     print "STATUS: SUCCESS\n";
-    Util::disconnect();
+    esxi_disconnect();
     exit 0;
 }
 
@@ -427,7 +584,7 @@ sub FAILURE {
     my $log = LogHandle->new("status");
     $log->error(@_);
     print "STATUS: FAILURE - @_\n";
-    Util::disconnect();
+    esxi_disconnect();
     exit 1;
 }
 
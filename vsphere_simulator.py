@@ -0,0 +1,797 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# In process stand-in for a vSphere proxy host.
+# Emulates the part of the vSphere API used by vadp_client.py: hba and
+# VMFS rescans of the HostStorageSystem, unresolved VMFS volumes of the
+# cloned luns, datastore browsing and file access, VM registration,
+# reconfiguration and unregistration, property collectors and container
+# views. Every call waits for a configurable delay, so that the VADP
+# mount and cleanup path can be timed without an ESX host (see
+# vadp_bench.py).
+#
+# The simulator replaces pyVmomi in vadp_client while it is installed:
+# with vsphere_simulator.install(): SimulatedVadpClient(host).setup(...)
+# The Perl scripts talk to the real SOAP endpoint and are not covered.
+###############################################################################
+import contextlib
+import threading
+import time
+
+# The client that is run against the simulated host
+import vadp_client
+
+# Delays of the simulated calls in seconds, see SimulatedHost
+DELAYS = {
+    # Rescan of an hba, plus rescan-per-lun for every lun seen through it
+    'rescan-hba' : 1.0,
+    'rescan-per-lun' : 0.01,
+    'rescan-vmfs' : 0.5,
+    'attach' : 0.2,
+    'detach' : 0.2,
+    'delete-lun-state' : 0.05,
+    'query-unresolved' : 0.1,
+    'resolve' : 0.5,
+    'mount' : 0.3,
+    'unmount' : 0.3,
+    'browse' : 0.2,
+    'register' : 0.3,
+    'reconfigure' : 0.1,
+    'unregister' : 0.1,
+    'file' : 0.05,
+    'retrieve' : 0.01,
+}
+
+DATACENTER = 'ha-datacenter'
+HOST_NAME = 'proxy-esx'
+ISCSI_NAME = 'iqn.1998-01.com.vmware:proxy-esx-%d'
+# Netapp luns are naa.600a0980 followed by the hex of their serial
+NAA_PREFIX = 'naa.600a0980'
+
+
+class Data(object):
+    '''
+    Data object of the simulated API, the attributes are the keywords
+    '''
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % item
+                                     for item in sorted(self.__dict__.items())))
+
+
+class MethodFault(Exception):
+    '''
+    Fault of a simulated call, like vmodl.MethodFault
+    '''
+
+    def __init__(self, msg=''):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+
+class InvalidState(MethodFault):
+    pass
+
+
+class AlreadyExists(MethodFault):
+    pass
+
+
+class NotAuthenticated(MethodFault):
+    pass
+
+
+class NotFound(MethodFault):
+    pass
+
+
+class ManagedObject(object):
+    '''
+    Managed object of the simulated host
+    '''
+
+    def __init__(self, host):
+        self.host_ = host
+
+
+class InternetScsiHba(Data):
+    pass
+
+
+class FibreChannelHba(Data):
+    pass
+
+
+class VmfsDatastoreInfo(Data):
+    pass
+
+
+class VirtualDisk(Data):
+    pass
+
+
+class Task(object):
+    '''
+    Simulated calls run synchronously, their tasks are already done
+    '''
+
+    def __init__(self, result=None, error=None):
+        self.info = Data(state=error and 'error' or 'success',
+                         result=result, error=error)
+
+
+def wait_for_task(task, si=None):
+    '''
+    Replaces pyVim.task.WaitForTask for the simulated tasks
+    '''
+    if task.info.state == 'error':
+        raise task.info.error
+    return task.info.state
+
+
+class ContainerView(ManagedObject):
+
+    def __init__(self, host, objects):
+        ManagedObject.__init__(self, host)
+        self.view = objects
+
+    def Destroy(self):
+        self.view = []
+
+
+class ViewManager(ManagedObject):
+
+    def CreateContainerView(self, container, type, recursive):
+        return ContainerView(self.host_, self.host_.objects(type))
+
+
+class PropertyCollector(ManagedObject):
+    '''
+    Property collector of the simulated host.
+
+    Any change of the host inventory ends a wait for updates, the
+    filters are not looked at.
+    '''
+
+    def __init__(self, host):
+        ManagedObject.__init__(self, host)
+        self.filters_ = []
+
+    def CreatePropertyCollector(self):
+        return PropertyCollector(self.host_)
+
+    def CreateFilter(self, spec, partialUpdates):
+        self.filters_.append(spec)
+        return Data(spec=spec)
+
+    def Destroy(self):
+        self.filters_ = []
+
+    def RetrieveContents(self, specSet):
+        self.host_.pause('retrieve')
+        contents = []
+        for spec in specSet:
+            paths = spec.propSet[0].pathSet or []
+            for obj_spec in spec.objectSet:
+                objects = getattr(obj_spec.obj, 'view', [obj_spec.obj])
+                for obj in objects:
+                    contents.append(Data(obj=obj, propSet=[
+                        Data(name=path, val=get_property(obj, path))
+                        for path in paths]))
+        return contents
+
+    def WaitForUpdatesEx(self, version, options):
+        return self.host_.wait_for_change(version,
+                                          getattr(options, 'maxWaitSeconds', 0))
+
+
+def get_property(obj, path):
+    '''
+    Returns the value of a dotted property path of an object
+    '''
+    for name in path.split('.'):
+        obj = getattr(obj, name, None)
+    return obj
+
+
+def property_spec(**kwargs):
+    return Data(**kwargs)
+
+
+class SessionManager(ManagedObject):
+
+    @property
+    def currentSession(self):
+        return Data(userName=self.host_.user_)
+
+
+class ServiceInstance(object):
+    '''
+    Service instance of the simulated host
+    '''
+
+    def __init__(self, host):
+        self.content = Data(
+            rootFolder=host.root_folder,
+            propertyCollector=PropertyCollector(host),
+            viewManager=ViewManager(host),
+            sessionManager=SessionManager(host))
+        self._stub = Data(cookie='vmware_soap_session="simulated"; Path=/')
+
+
+class HostSystem(ManagedObject):
+
+    def __init__(self, host, name):
+        ManagedObject.__init__(self, host)
+        self.name = name
+        self.configManager = Data(storageSystem=HostStorageSystem(host),
+                                  datastoreSystem=HostDatastoreSystem(host))
+        self.parent = Data(resourcePool=Data(name='Resources'))
+
+
+class HostStorageSystem(ManagedObject):
+    '''
+    Storage system of the simulated host, the luns mapped to the
+    host by the array show up once their hba is rescanned
+    '''
+
+    @property
+    def storageDeviceInfo(self):
+        host = self.host_
+        with host.lock_:
+            return Data(hostBusAdapter=list(host.hbas_),
+                        scsiLun=[lun.scsi_lun() for lun in host.luns_.values()
+                                 if lun.visible])
+
+    def RescanHba(self, hbaDevice):
+        host = self.host_
+        with host.storage_lock_:
+            hba = host.get_hba(hbaDevice)
+            seen = [lun for lun in host.luns_.values() if lun.hba == hba.device]
+            host.pause('rescan-hba', host.delays_['rescan-per-lun'] * len(seen))
+            with host.lock_:
+                for lun in seen:
+                    if lun.mapped and not lun.visible:
+                        lun.visible = True
+                        lun.attached = True
+                    elif not lun.mapped and lun.visible:
+                        lun.visible = False
+                host.changed()
+
+    def RescanVmfs(self):
+        with self.host_.storage_lock_:
+            self.host_.pause('rescan-vmfs')
+
+    def AttachScsiLun(self, lunUuid):
+        host = self.host_
+        with host.storage_lock_:
+            host.pause('attach')
+            lun = host.get_lun(uuid=lunUuid)
+            if lun.attached:
+                raise InvalidState('Device %s is attached' % lun.naa)
+            with host.lock_:
+                lun.attached = True
+                host.changed()
+
+    def DetachScsiLun(self, lunUuid):
+        host = self.host_
+        with host.storage_lock_:
+            host.pause('detach')
+            lun = host.get_lun(uuid=lunUuid)
+            if not lun.attached:
+                raise InvalidState('Device %s is detached' % lun.naa)
+            if lun.datastore is not None and lun.datastore.mounted:
+                raise InvalidState('Device %s has a mounted datastore' %
+                                   lun.naa)
+            with host.lock_:
+                lun.attached = False
+                host.changed()
+
+    def DeleteScsiLunState(self, lunCanonicalName):
+        host = self.host_
+        with host.storage_lock_:
+            host.pause('delete-lun-state')
+            lun = host.get_lun(naa=lunCanonicalName)
+            if lun.attached:
+                raise InvalidState('Device %s is attached' % lun.naa)
+
+    def ResolveMultipleUnresolvedVmfsVolumes(self, resolutionSpec):
+        host = self.host_
+        with host.storage_lock_:
+            host.pause('resolve')
+            for spec in resolutionSpec:
+                for device_path in spec.extentDevicePath:
+                    lun = host.get_lun(naa=device_path.rsplit('/', 1)[-1])
+                    if not lun.attached or lun.datastore is not None:
+                        raise InvalidState('Volume of %s is not unresolved' %
+                                           lun.naa)
+                    host.add_datastore(lun)
+
+    def MountVmfsVolume(self, vmfsUuid):
+        host = self.host_
+        with host.storage_lock_:
+            host.pause('mount')
+            ds = host.get_datastore(vmfsUuid)
+            if ds.mounted:
+                raise InvalidState('Volume %s is mounted' % ds.name)
+            with host.lock_:
+                ds.mounted = True
+                host.changed()
+
+    def UnmountVmfsVolume(self, vmfsUuid):
+        host = self.host_
+        with host.storage_lock_:
+            host.pause('unmount')
+            ds = host.get_datastore(vmfsUuid)
+            if not ds.mounted:
+                raise InvalidState('Volume %s is not mounted' % ds.name)
+            if ds.vms_:
+                raise InvalidState('Volume %s has registered VMs' % ds.name)
+            host.remove_datastore(ds)
+
+
+class HostDatastoreSystem(ManagedObject):
+
+    def QueryUnresolvedVmfsVolumes(self):
+        host = self.host_
+        host.pause('query-unresolved')
+        with host.lock_:
+            luns = [lun for lun in host.luns_.values()
+                    if lun.visible and lun.attached and lun.datastore is None]
+        return [Data(vmfsLabel=lun.label,
+                     extent=[Data(device=Data(diskName=lun.naa),
+                                  devicePath='/vmfs/devices/disks/' + lun.naa)],
+                     resolveStatus=Data(resolvable=True,
+                                        incompleteExtents=False,
+                                        multipleCopies=False))
+                for lun in luns]
+
+
+class HostDatastoreBrowser(ManagedObject):
+
+    def __init__(self, host, ds):
+        ManagedObject.__init__(self, host)
+        self.ds_ = ds
+
+    def SearchDatastoreSubFolders_Task(self, datastorePath, searchSpec=None):
+        self.host_.pause('browse')
+        folders = {}
+        for path in sorted(self.ds_.files):
+            folder, sep, name = path.rpartition('/')
+            folders.setdefault(folder, []).append(Data(path=name))
+        return Task([Data(folderPath='[%s] %s' % (self.ds_.name, folder),
+                          file=files)
+                     for folder, files in sorted(folders.items())])
+
+
+class Datastore(ManagedObject):
+    '''
+    VMFS datastore of a cloned lun, holds the files of its VMs
+    '''
+
+    def __init__(self, host, lun):
+        ManagedObject.__init__(self, host)
+        self.name = lun.label
+        self.lun = lun
+        self.mounted = True
+        self.files = dict(lun.files)
+        self.vms_ = []
+        self.browser = HostDatastoreBrowser(host, self)
+        self.info = VmfsDatastoreInfo(
+            name=self.name,
+            vmfs=Data(name=self.name, uuid='vmfs-' + lun.serial,
+                      extent=[Data(diskName=lun.naa, partition=1)]))
+        self.host = [Data(key=host.host_system, mountInfo=Data(mounted=True))]
+
+    @property
+    def summary(self):
+        return Data(name=self.name, accessible=self.mounted)
+
+    @property
+    def vm(self):
+        # Properties are read by value, like from the real API
+        with self.host_.lock_:
+            return list(self.vms_)
+
+
+class VirtualMachine(ManagedObject):
+    '''
+    VM registered from the vmx file of a datastore
+    '''
+
+    def __init__(self, host, ds, vmx_path, vm):
+        ManagedObject.__init__(self, host)
+        self.ds_ = ds
+        self.name = vm['name']
+        self.config = Data(files=Data(vmPathName=vmx_path))
+        folder = vmx_path.rpartition('/')[0]
+        base, delta, vmx = (folder + '/' + vm['base'],
+                            folder + '/' + vm['delta'], vmx_path)
+        # Runs on the delta disk of the granite snapshot
+        self.layoutEx = Data(
+            file=[Data(key=0, name=vmx), Data(key=1, name=base),
+                  Data(key=2, name=delta)],
+            disk=[Data(key=2000, chain=[Data(fileKey=[1]),
+                                        Data(fileKey=[2])])],
+            snapshot=[Data(key=1, disk=[Data(key=2000,
+                                             chain=[Data(fileKey=[1])])])])
+        disk = VirtualDisk(key=2000, backing=Data(changeId='52 aa 00 01/1'))
+        self.snapshot = Data(
+            rootSnapshotList=[Data(name=vadp_client.GRANITE_SNAPSHOT,
+                                   childSnapshotList=[])],
+            currentSnapshot=Data(config=Data(hardware=Data(device=[disk]))))
+
+    def ReconfigVM_Task(self, spec):
+        self.host_.pause('reconfigure')
+        if getattr(spec, 'name', None):
+            self.name = spec.name
+        return Task()
+
+    def UnregisterVM(self):
+        host = self.host_
+        host.pause('unregister')
+        with host.lock_:
+            if self not in self.ds_.vms_:
+                raise InvalidState('VM %s is not registered' % self.name)
+            self.ds_.vms_.remove(self)
+            host.changed()
+
+
+class Folder(ManagedObject):
+
+    def __init__(self, host, name):
+        ManagedObject.__init__(self, host)
+        self.name = name
+
+    def RegisterVM_Task(self, path, asTemplate=False, pool=None, name=None,
+                        host=None):
+        sim = self.host_
+        sim.pause('register')
+        ds_name = vadp_client.split_file_path(path)[0]
+        vm_dir = path[len(ds_name) + 3:]
+        with sim.lock_:
+            ds = sim.datastores_.get(ds_name)
+            if ds is None or not ds.mounted or vm_dir not in ds.files:
+                return Task(error=NotFound('File %s was not found' % path))
+            if any(vm.config.files.vmPathName == path for vm in ds.vms_):
+                return Task(error=AlreadyExists('VM %s is registered' % path))
+            vm = VirtualMachine(sim, ds, path, ds.lun.vms[vm_dir])
+            ds.vms_.append(vm)
+            sim.changed()
+        return Task(vm)
+
+
+class Datacenter(ManagedObject):
+
+    def __init__(self, host, name):
+        ManagedObject.__init__(self, host)
+        self.name = name
+        self.vmFolder = Folder(host, 'vm')
+
+
+class Lun(object):
+    '''
+    Cloned lun mapped to the simulated host, with the files of its VMs
+    '''
+
+    def __init__(self, serial, hba, vms):
+        self.serial = serial
+        self.hba = hba
+        self.naa = NAA_PREFIX + serial.encode('ascii').hex()
+        self.uuid = 'uuid-' + self.naa
+        self.label = 'granite_' + serial
+        self.mapped = True
+        self.visible = False
+        self.attached = False
+        self.datastore = None
+        self.vms = {}
+        self.files = {}
+        for i in range(vms):
+            name = 'vm_%s_%d' % (serial, i)
+            vmx = '%s/%s.vmx' % (name, name)
+            self.vms[vmx] = {'name' : name, 'base' : name + '.vmdk',
+                             'delta' : name + '-000001.vmdk'}
+            self.files[vmx] = ('displayName = "%s"\n'
+                               'scsi0:0.present = "TRUE"\n'
+                               'scsi0:0.fileName = "%s-000001.vmdk"\n' %
+                               (name, name)).encode('utf-8')
+            self.files['%s/%s.vmdk' % (name, name)] = b''
+            self.files['%s/%s-000001.vmdk' % (name, name)] = b''
+
+    def scsi_lun(self):
+        # Detached devices have no alternate names
+        alt_names = None
+        if self.attached:
+            alt_names = [Data(namespace='SERIALNUM',
+                              data=list(self.serial.encode('ascii')))]
+        return Data(canonicalName=self.naa, uuid=self.uuid,
+                    alternateName=alt_names)
+
+
+class CallStats(object):
+    '''
+    Number of calls and simulated seconds per call
+    '''
+
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.calls_ = {}
+
+    def add(self, name, seconds):
+        with self.lock_:
+            stats = self.calls_.setdefault(name, {'calls' : 0, 'seconds' : 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+
+    def get(self, reset=False):
+        with self.lock_:
+            calls = self.calls_
+            if reset:
+                self.calls_ = {}
+            return dict((name, dict(stats)) for name, stats in calls.items())
+
+
+class SimulatedHost(object):
+    '''
+    Simulated ESX proxy host
+
+    hbas : number of iSCSI hbas of the host
+    delays : dict of call delays in seconds replacing DELAYS entries
+    scale : factor applied to all the delays
+    name : host name
+
+    Storage system calls (rescans, attach, mount, ...) are serialized
+    like on ESX, the other calls run concurrently.
+    '''
+
+    def __init__(self, hbas=1, delays=None, scale=1.0, name=HOST_NAME):
+        self.lock_ = threading.RLock()
+        self.storage_lock_ = threading.Lock()
+        self.change_ = threading.Condition(self.lock_)
+        self.version_ = 0
+        self.user_ = 'root'
+        self.stats = CallStats()
+        self.delays_ = dict(DELAYS)
+        self.delays_.update(delays or {})
+        self.scale_ = scale
+        self.hbas_ = [InternetScsiHba(device='vmhba%d' % (32 + i),
+                                      iScsiName=ISCSI_NAME % i)
+                      for i in range(hbas)]
+        self.luns_ = {}
+        self.datastores_ = {}
+        self.uuids_ = {}
+        self.root_folder = Folder(self, 'Datacenters')
+        self.datacenter = Datacenter(self, DATACENTER)
+        self.host_system = HostSystem(self, name)
+
+    def initiators(self):
+        return [hba.iScsiName for hba in self.hbas_]
+
+    def pause(self, name, extra=0.0):
+        '''
+        Waits for the delay of a call
+
+        name : delay name, see DELAYS
+        extra : seconds added to the delay
+        '''
+        delay = (self.delays_.get(name, 0.0) + extra) * self.scale_
+        if delay > 0:
+            time.sleep(delay)
+        self.stats.add(name, delay)
+
+    def changed(self):
+        '''
+        Ends the waits for updates, called with lock_ held
+        '''
+        self.version_ += 1
+        self.change_.notify_all()
+
+    def wait_for_change(self, version, seconds):
+        '''
+        Returns an update if the inventory changed after version,
+        waits for at most seconds, returns None if nothing changed.
+        The waits are not scaled, they are the client's own pacing.
+        '''
+        with self.lock_:
+            if version:
+                deadline = time.time() + (seconds or 0)
+                while self.version_ <= int(version):
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return None
+                    self.change_.wait(left)
+            return Data(version=str(self.version_))
+
+    def objects(self, types):
+        '''
+        Returns the managed objects of the types
+        '''
+        objects = []
+        with self.lock_:
+            for obj_type in types:
+                if obj_type is Datacenter:
+                    objects.append(self.datacenter)
+                elif obj_type is HostSystem:
+                    objects.append(self.host_system)
+                elif obj_type is Datastore:
+                    objects.extend(self.datastores_.values())
+                elif obj_type is VirtualMachine:
+                    for ds in self.datastores_.values():
+                        objects.extend(ds.vms_)
+        return objects
+
+    def map_lun(self, serial, vms, hba=0):
+        '''
+        Maps a cloned lun to the host, like the handoff scripts do with
+        lun-map. The host sees it after the next rescan of the hba.
+
+        serial : lun serial
+        vms : number of VMs in the datastore of the lun
+        hba : index of the hba of the initiator the lun is mapped to
+        '''
+        with self.lock_:
+            self.luns_[serial] = Lun(serial, self.hbas_[hba].device, vms)
+
+    def unmap_lun(self, serial):
+        '''
+        Unmaps a lun, the host stops seeing it after the next rescan
+        '''
+        with self.lock_:
+            self.luns_[serial].mapped = False
+
+    def get_hba(self, device):
+        for hba in self.hbas_:
+            if hba.device == device:
+                return hba
+        raise NotFound('No hba %s' % device)
+
+    def get_lun(self, uuid=None, naa=None):
+        with self.lock_:
+            for lun in self.luns_.values():
+                if lun.visible and (lun.uuid == uuid or lun.naa == naa):
+                    return lun
+        raise NotFound('No device %s' % (uuid or naa))
+
+    def get_datastore(self, vmfs_uuid):
+        with self.lock_:
+            for ds in self.datastores_.values():
+                if ds.info.vmfs.uuid == vmfs_uuid:
+                    return ds
+        raise NotFound('No VMFS volume %s' % vmfs_uuid)
+
+    def add_datastore(self, lun):
+        with self.lock_:
+            ds = Datastore(self, lun)
+            lun.datastore = ds
+            self.datastores_[ds.name] = ds
+            self.changed()
+            return ds
+
+    def remove_datastore(self, ds):
+        with self.lock_:
+            ds.mounted = False
+            ds.lun.datastore = None
+            del self.datastores_[ds.name]
+            self.changed()
+
+    def datastore_file(self, method, ds_name, path, body=None):
+        '''
+        Gets or puts a file of a datastore, see VadpClient.datastore_file
+        '''
+        self.pause('file')
+        with self.lock_:
+            ds = self.datastores_.get(ds_name)
+            if ds is None or not ds.mounted:
+                raise vadp_client.VadpError('%s of %s unsuccessful: response '
+                                            'status code 404' % (method, path))
+            if method == 'PUT':
+                ds.files[path] = body
+                return b''
+            if path not in ds.files:
+                raise vadp_client.VadpError('%s of %s unsuccessful: response '
+                                            'status code 404' % (method, path))
+            return ds.files[path]
+
+
+# The vim and vmodl names used by vadp_client
+vim = Data(
+    Datacenter=Datacenter,
+    HostSystem=HostSystem,
+    Datastore=Datastore,
+    VirtualMachine=VirtualMachine,
+    ServiceInstance=ServiceInstance,
+    host=Data(InternetScsiHba=InternetScsiHba,
+              FibreChannelHba=FibreChannelHba,
+              VmfsDatastoreInfo=VmfsDatastoreInfo,
+              StorageSystem=HostStorageSystem,
+              UnresolvedVmfsResolutionSpec=property_spec),
+    fault=Data(InvalidState=InvalidState,
+               AlreadyExists=AlreadyExists,
+               NotAuthenticated=NotAuthenticated),
+    view=Data(ContainerView=ContainerView),
+    vm=Data(ConfigSpec=property_spec,
+            device=Data(VirtualDisk=VirtualDisk)))
+
+vmodl = Data(
+    MethodFault=MethodFault,
+    query=Data(PropertyCollector=Data(TraversalSpec=property_spec,
+                                      ObjectSpec=property_spec,
+                                      PropertySpec=property_spec,
+                                      FilterSpec=property_spec,
+                                      WaitOptions=property_spec)))
+
+
+_install_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def install():
+    '''
+    Replaces pyVmomi in vadp_client with the simulated API for the
+    duration of the block. vadp_client cannot talk to a real host
+    while the simulator is installed.
+    '''
+    names = {'vim' : vim, 'vmodl' : vmodl, 'WaitForTask' : wait_for_task}
+    missing = object()
+    with _install_lock:
+        # Without pyVmomi, vadp_client only defines vim
+        saved = dict((name, getattr(vadp_client, name, missing))
+                     for name in names)
+        for name, value in names.items():
+            setattr(vadp_client, name, value)
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is missing:
+                    delattr(vadp_client, name)
+                else:
+                    setattr(vadp_client, name, value)
+
+
+class SimulatedVadpClient(vadp_client.VadpClient):
+    '''
+    VadpClient connected to a simulated host
+
+    host : the SimulatedHost
+    '''
+
+    def __init__(self, host):
+        vadp_client.VadpClient.__init__(self, host.host_system.name,
+                                        host.user_, '')
+        self.sim_ = host
+
+    def connect(self):
+        with self.lock_:
+            if self.si_ is None:
+                self.si_ = ServiceInstance(self.sim_)
+            return self.si_
+
+    def datastore_file(self, method, ds_name, path, dc_name, body=None):
+        return self.sim_.datastore_file(method, ds_name, path, body)
@@ -0,0 +1,161 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Pipelined ZAPI calls.
+# A handoff operation is a short sequence of ZAPI calls, some of which
+# need the result of an earlier one. ZapiPipeline queues the calls in
+# stages: the calls of a stage do not depend on each other and are sent
+# at the same time over pooled connections (see zapi_pool), a stage is
+# only sent once the stage before it completed. The errors of all the
+# calls are collected in one place.
+# ZAPI has no envelope for several calls, each call is still its own
+# request, but a stage costs a single round trip of latency.
+###############################################################################
+
+
+def any_error(results):
+    '''
+    Allows all the errors of a call, for calls whose results
+    are checked by the caller
+    '''
+    return True
+
+
+class ZapiCall(object):
+    '''
+    A call queued in a ZapiPipeline
+
+    api : the request element
+    allow : called with the results of a failed call, returns True
+            if the error is expected and must not fail the pipeline
+    '''
+
+    def __init__(self, api, allow=None):
+        self.api_ = api
+        self.allow_ = allow
+        self.results_ = None
+
+    def results(self):
+        '''
+        Returns the results element, None if the call was not sent
+        '''
+        return self.results_
+
+    def done(self):
+        return self.results_ is not None
+
+    def failed(self):
+        '''
+        Returns True if the call was sent and failed with an error
+        that is not allowed
+        '''
+        if self.results_ is None or \
+           self.results_.results_status() != "failed":
+            return False
+        return not (self.allow_ and self.allow_(self.results_))
+
+
+class ZapiPipeline(object):
+    '''
+    Queue of ZAPI calls sent in stages.
+
+    server : the storage array connection. Servers with invoke_elems
+             (see zapi_pool.PooledNaServer) get the calls of a stage at
+             the same time, other servers get them one after another.
+
+    Calls are added to the current stage, then() starts a new stage.
+    run() sends the stages queued so far and stops after the first stage
+    with a failed call, more calls can then be queued and run, e.g.
+    calls built from the results of the first ones.
+    '''
+
+    def __init__(self, server):
+        self.server_ = server
+        self.stages_ = [[]]
+        self.errors_ = []
+
+    def add(self, api, allow=None):
+        '''
+        Queues a call in the current stage
+
+        api : the request element
+        allow : see ZapiCall
+
+        returns the ZapiCall, its results are set by run()
+        '''
+        call = ZapiCall(api, allow)
+        self.stages_[-1].append(call)
+        return call
+
+    def then(self):
+        '''
+        Starts a new stage, the calls added from now on are only sent
+        once the calls added before have completed
+        '''
+        if self.stages_[-1]:
+            self.stages_.append([])
+
+    def invoke(self, reqs):
+        invoke_elems = getattr(self.server_, 'invoke_elems', None)
+        if invoke_elems is not None:
+            return invoke_elems(reqs)
+        return [self.server_.invoke_elem(req) for req in reqs]
+
+    def run(self):
+        '''
+        Sends the queued stages in order
+
+        returns True if no call failed. The calls of the stages after
+        a failed one are dropped, they are never sent.
+        '''
+        stages, self.stages_ = self.stages_, [[]]
+        if self.errors_:
+            return False
+        for stage in stages:
+            if not stage:
+                continue
+            results = self.invoke([call.api_ for call in stage])
+            for call, xo in zip(stage, results):
+                call.results_ = xo
+                if call.failed():
+                    self.errors_.append(call)
+            if self.errors_:
+                return False
+        return True
+
+    def errors(self):
+        '''
+        Returns the results elements of the failed calls
+        '''
+        return [call.results() for call in self.errors_]
+
+    def log_errors(self, log):
+        '''
+        Writes the failed calls' results with the given log function,
+        the same way the handoff scripts report ZAPI errors
+        '''
+        for xo in self.errors():
+            log("Error:\n")
+            log(xo.sprintf())
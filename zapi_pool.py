@@ -0,0 +1,671 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Pooled ZAPI sessions for Netapp storage arrays.
+# NaServer opens a new HTTP(S) connection for every invoke_elem call.
+# PooledNaServer is a drop-in replacement that sends the ZAPI requests over
+# persistent keep-alive connections shared by all the servers talking to the
+# same storage array.
+###############################################################################
+import sys
+import ssl
+import time
+import base64
+import select
+import socket
+import threading
+import http.client
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Netapp sdk path. This is the path to which you installed the
+# Netapp managebility SDK.
+sys.path.append(r"C:\netapp\netapp-manageability-sdk-5.0\lib\python\NetApp")
+from NaServer import *
+
+# Timing of the ZAPI calls
+import metrics
+
+FILER_URL = '/servlets/netapp.servlets.admin.XMLrequest_filer'
+FILER_DTD = 'file:/etc/netapp_filer.dtd'
+ZAPI_XMLNS = 'http://www.netapp.com/filer/admin'
+
+# Pool defaults, see configure()
+POOL_SIZE = 4
+IDLE_TIMEOUT = 60
+
+# Bytes read at a time from a streamed response, see ZapiStream
+STREAM_CHUNK = 64 * 1024
+
+# Records asked for per page of a *-get-iter call, see ZapiIter
+PAGE_SIZE = 500
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def configure(pool_size=None, idle_timeout=None):
+    '''
+    Sets the defaults used for pools created from now on
+
+    pool_size : maximum number of connections per storage array
+    idle_timeout : seconds after which an unused connection is closed
+    '''
+    global POOL_SIZE, IDLE_TIMEOUT
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if idle_timeout is not None:
+        IDLE_TIMEOUT = idle_timeout
+
+
+def get_pool(host, port, transport, user, pwd):
+    '''
+    Returns the connection pool for the storage array,
+    creating it on first use
+
+    host : Netapp hostname/ip address
+    port : ZAPI port
+    transport : HTTP/HTTPS
+    user, pwd : login credentials
+    '''
+    key = (host, port, transport, user, pwd)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ZapiConnectionPool(host, port, transport, user, pwd,
+                                      POOL_SIZE, IDLE_TIMEOUT)
+            _pools[key] = pool
+    return pool
+
+
+def close_pools():
+    '''
+    Closes all the pooled connections
+    '''
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def _local_name(tag):
+    '''
+    Strips the xml namespace from a tag or attribute name
+    '''
+    return tag.rsplit('}', 1)[-1]
+
+
+def to_na_element(elem):
+    '''
+    Converts an ElementTree element into a NaElement tree
+    '''
+    na_elem = NaElement(_local_name(elem.tag))
+    for name, value in elem.attrib.items():
+        na_elem.attr_set(_local_name(name), value)
+
+    children = list(elem)
+    for child in children:
+        na_elem.child_add(to_na_element(child))
+    if not children and elem.text:
+        na_elem.set_content(elem.text)
+    return na_elem
+
+
+def encode_request(version, req):
+    '''
+    Returns the body of the ZAPI request
+
+    version : ZAPI version, e.g. 1.7
+    req : the request element
+    '''
+    return ("<?xml version='1.0' encoding='utf-8'?>\n"
+            "<!DOCTYPE netapp SYSTEM '%s'>"
+            "<netapp version=\"%s\" xmlns=\"%s\">%s</netapp>" %
+            (FILER_DTD, version, ZAPI_XMLNS,
+             req.toEncodedString())).encode('utf-8')
+
+
+def parse_response(data):
+    '''
+    Returns the results element of a ZAPI response body
+    '''
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        return fail_response(13001, "Invalid response: " + str(e))
+
+    for child in root:
+        if _local_name(child.tag) == 'results':
+            return to_na_element(child)
+    return fail_response(13001, "No results element in response")
+
+
+def get_iter_request(api_name, query=None, item_tag=None, fields=None,
+                     max_records=None, tag=None):
+    '''
+    Returns the request for one page of a *-get-iter call
+
+    api_name : e.g. lun-get-iter
+    query : element selecting the records, e.g. a lun-info with a path
+    item_tag : the records, e.g. lun-info
+    fields : only these fields of the records are returned
+             (desired-attributes), all of them if None
+    max_records : records per page, PAGE_SIZE if None
+    tag : next-tag of the previous page
+    '''
+    api = NaElement(api_name)
+    api.child_add_string("max-records", str(max_records or PAGE_SIZE))
+    if tag:
+        api.child_add_string("tag", tag)
+    if query is not None:
+        q = NaElement("query")
+        q.child_add(query)
+        api.child_add(q)
+    if item_tag and fields:
+        info = NaElement(item_tag)
+        for field in fields:
+            info.child_add(NaElement(field))
+        desired = NaElement("desired-attributes")
+        desired.child_add(info)
+        api.child_add(desired)
+    return api
+
+
+def fail_response(errno, reason):
+    '''
+    Returns a failed ZAPI result, same as NaServer does on errors
+    '''
+    results = NaElement("results")
+    results.attr_set("status", "failed")
+    results.attr_set("reason", reason)
+    results.attr_set("errno", str(errno))
+    return results
+
+
+class StaleConnection(http.client.HTTPException):
+    '''
+    A reused connection failed before the array answered the request
+    '''
+    pass
+
+
+class ZapiConnectionPool(object):
+    '''
+    Pool of keep-alive HTTP(S) connections to one storage array.
+
+    At most max_size connections are open at a time, callers block
+    when all of them are in use. Idle connections are closed after
+    idle_timeout seconds, and are checked before reuse so that a
+    connection closed by the array is not handed out.
+    '''
+
+    def __init__(self, host, port, transport, user, pwd,
+                 max_size, idle_timeout, timeout=None):
+        self.host_ = host
+        self.port_ = port
+        self.transport_ = transport
+        self.timeout_ = timeout
+        self.idle_timeout_ = idle_timeout
+        self.auth_ = base64.b64encode(('%s:%s' % (user, pwd)).encode('utf-8'))
+        self.slots_ = threading.BoundedSemaphore(max_size)
+        self.lock_ = threading.Lock()
+        # Idle connections as (connection, time returned to the pool)
+        self.idle_ = []
+
+    def new_connection(self):
+        if self.transport_.upper() == 'HTTPS':
+            # Filers usually have self-signed certificates,
+            # NaServer does not verify them either
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.verify_mode = ssl.CERT_NONE
+            return http.client.HTTPSConnection(self.host_, self.port_,
+                                               timeout=self.timeout_,
+                                               context=context)
+        return http.client.HTTPConnection(self.host_, self.port_,
+                                          timeout=self.timeout_)
+
+    def is_alive(self, conn):
+        '''
+        Health check for an idle connection.
+
+        An idle keep-alive socket must not be readable, if it is the
+        array has closed it (or sent something we did not ask for).
+        '''
+        if conn.sock is None:
+            return False
+        try:
+            readable, w, x = select.select([conn.sock], [], [], 0)
+        except (socket.error, ValueError):
+            return False
+        return not readable
+
+    def evict_idle(self):
+        '''
+        Closes the connections idle for longer than idle_timeout
+        '''
+        now = time.time()
+        with self.lock_:
+            expired = [c for c, t in self.idle_ if now - t > self.idle_timeout_]
+            self.idle_ = [(c, t) for c, t in self.idle_
+                          if now - t <= self.idle_timeout_]
+        for conn in expired:
+            conn.close()
+
+    def acquire(self, reuse=True):
+        '''
+        Returns a tuple of (connection, reused)
+
+        reuse : False to always open a new connection
+        '''
+        self.slots_.acquire()
+        self.evict_idle()
+        while reuse:
+            with self.lock_:
+                if not self.idle_:
+                    break
+                conn, t = self.idle_.pop()
+            if self.is_alive(conn):
+                return conn, True
+            conn.close()
+        return self.new_connection(), False
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            with self.lock_:
+                self.idle_.append((conn, time.time()))
+        else:
+            conn.close()
+        self.slots_.release()
+
+    def post(self, body):
+        '''
+        Sends a ZAPI request and returns the response body
+
+        body : encoded ZAPI request
+        '''
+        conn, resp, reused = self.open_response(body)
+        try:
+            data = resp.read()
+        except (http.client.HTTPException, socket.error):
+            self.release(conn, False)
+            raise
+        self.release(conn, not resp.will_close)
+        return data
+
+    def send(self, conn, body, headers):
+        '''
+        Sends the request on the connection and returns the response
+        once its headers are read
+
+        Raises StaleConnection if the connection failed before the array
+        answered anything: either the request could not be sent, or the
+        connection was closed without a status line. The array then has
+        not run the request.
+        '''
+        try:
+            conn.request('POST', FILER_URL, body, headers)
+        except socket.timeout:
+            raise
+        except (http.client.HTTPException, socket.error) as e:
+            raise StaleConnection(str(e))
+        try:
+            return conn.getresponse()
+        except http.client.BadStatusLine as e:
+            # RemoteDisconnected, the connection was closed before any
+            # response byte was received
+            if e.line in ('', "''"):
+                raise StaleConnection(str(e) or 'connection closed')
+            raise
+
+    def open_response(self, body):
+        '''
+        Sends a ZAPI request and returns (connection, response, reused)
+        once the response headers are read. The caller reads the body
+        and gives the connection back with release().
+
+        body : encoded ZAPI request
+
+        A request that fails on a reused connection before the array
+        answered (see send) is sent once more on a new connection, the
+        array may have closed the idle connection meanwhile. Requests
+        are never sent again once the array may have run them, after a
+        timeout or once the response started: ZAPI calls like
+        volume-clone-create are not idempotent.
+        '''
+        headers = {'Content-type' : 'text/xml; charset="UTF-8"',
+                   'Authorization' : 'Basic ' + self.auth_.decode('ascii'),
+                   'Connection' : 'keep-alive'}
+        conn, reused = self.acquire()
+        try:
+            try:
+                resp = self.send(conn, body, headers)
+            except StaleConnection:
+                if not reused:
+                    raise
+                self.release(conn, False)
+                conn, reused = self.acquire(reuse=False)
+                resp = self.send(conn, body, headers)
+            if resp.status != 200:
+                resp.read()
+        except (http.client.HTTPException, socket.error):
+            self.release(conn, False)
+            raise
+        if resp.status == 200:
+            return conn, resp, reused
+        self.release(conn, not resp.will_close)
+        if resp.status == 401:
+            raise http.client.HTTPException("Authorization failed")
+        raise http.client.HTTPException("Server returned HTTP %d %s" %
+                                        (resp.status, resp.reason))
+
+    def close(self):
+        with self.lock_:
+            idle, self.idle_ = self.idle_, []
+        for conn, t in idle:
+            conn.close()
+
+
+class _EventTarget(object):
+    '''
+    XMLParser target building the tree and recording the elements
+    started and ended, what XMLPullParser (Python 3.4) does
+    '''
+
+    def __init__(self):
+        self.builder_ = ET.TreeBuilder()
+        self.events_ = []
+
+    def start(self, tag, attrs):
+        elem = self.builder_.start(tag, attrs)
+        self.events_.append(('start', elem))
+        return elem
+
+    def end(self, tag):
+        elem = self.builder_.end(tag)
+        self.events_.append(('end', elem))
+        return elem
+
+    def data(self, data):
+        self.builder_.data(data)
+
+    def close(self):
+        return self.builder_.close()
+
+    def read_events(self):
+        events, self.events_ = self.events_, []
+        return events
+
+
+class ZapiStream(object):
+    '''
+    Results of a ZAPI request parsed while the response is received.
+
+    Iterating yields the leaf fields of each item_tag element as a dict,
+    e.g. {'path' : ..., 'serial-number' : ...} for lun-info, as soon as the
+    element is complete. The items are dropped once yielded, so a large
+    listing is never held as a whole, and a caller looking for one item
+    can stop reading at that item. The rest of the response is then not
+    read and the connection is closed instead of being reused.
+
+    results() returns the results element without the items, e.g. with
+    the status and next-tag. It is failed if the request failed.
+    '''
+
+    def __init__(self, server, req, item_tag):
+        self.server_ = server
+        self.req_ = req
+        self.item_tag_ = item_tag
+        self.results_ = None
+
+    def results(self):
+        if self.results_ is None:
+            return fail_response(13001, "Response was not read")
+        return self.results_
+
+    def __iter__(self):
+        with metrics.span('zapi', api=self.req_.get_name(),
+                          array=self.server_.array_name()) as record:
+            items = self.read_items()
+            try:
+                for item in items:
+                    yield item
+            except GeneratorExit:
+                # The caller found what it was looking for
+                pass
+            finally:
+                items.close()
+            if self.results_.results_status() == 'failed':
+                record['status'] = 'failed'
+
+    def read_items(self):
+        pool = self.server_.pool()
+        try:
+            conn, resp, reused = pool.open_response(
+                self.server_.encode_request(self.req_))
+        except (http.client.HTTPException, socket.error) as e:
+            self.results_ = fail_response(13001, str(e))
+            return
+
+        target = _EventTarget()
+        parser = ET.XMLParser(target=target)
+        # Elements being parsed, from the root down
+        stack = []
+        results = None
+        complete = False
+        self.results_ = fail_response(13001, "No results element in response")
+        try:
+            while True:
+                data = resp.read(STREAM_CHUNK)
+                if data:
+                    parser.feed(data)
+                else:
+                    parser.close()
+                for event, elem in target.read_events():
+                    if event == 'start':
+                        stack.append(elem)
+                        if (results is None and
+                            _local_name(elem.tag) == 'results'):
+                            results = elem
+                            self.results_ = to_na_element(results)
+                        continue
+                    stack.pop()
+                    if (results is None or len(stack) < 2 or
+                        _local_name(elem.tag) != self.item_tag_):
+                        continue
+                    item = dict((_local_name(c.tag), c.text or '')
+                                for c in elem if len(c) == 0)
+                    stack[-1].remove(elem)
+                    yield item
+                if not data:
+                    break
+            complete = True
+            if results is not None:
+                self.results_ = to_na_element(results)
+        except ET.ParseError as e:
+            self.results_ = fail_response(13001, "Invalid response: " + str(e))
+        except (http.client.HTTPException, socket.error) as e:
+            self.results_ = fail_response(13001, str(e))
+        finally:
+            pool.release(conn, complete and not resp.will_close)
+
+
+class ZapiIter(object):
+    '''
+    Records of a *-get-iter call, read page by page.
+
+    Iterating yields the records as ZapiStream does, the next page is
+    asked for with the next-tag of the previous one, until the last page
+    or until the caller stops. results() returns the results element of
+    the last page read, it is failed if a page failed.
+
+    See get_iter_request for the arguments.
+    '''
+
+    def __init__(self, server, api_name, item_tag, query=None, fields=None,
+                 max_records=None):
+        self.server_ = server
+        self.api_name_ = api_name
+        self.item_tag_ = item_tag
+        self.query_ = query
+        self.fields_ = fields
+        self.max_records_ = max_records
+        self.results_ = None
+
+    def results(self):
+        if self.results_ is None:
+            return fail_response(13001, "Response was not read")
+        return self.results_
+
+    def __iter__(self):
+        tag = None
+        while True:
+            api = get_iter_request(self.api_name_, self.query_, self.item_tag_,
+                                   self.fields_, self.max_records_, tag)
+            stream = self.server_.invoke_stream(api, self.item_tag_)
+            items = iter(stream)
+            try:
+                for item in items:
+                    yield item
+            finally:
+                items.close()
+                self.results_ = stream.results()
+
+            if self.results_.results_status() == "failed":
+                return
+            next_tag = self.results_.child_get_string("next-tag")
+            if not next_tag or next_tag == tag:
+                return
+            tag = next_tag
+
+
+class PooledNaServer(NaServer):
+    '''
+    NaServer that sends the requests over pooled connections.
+
+    Configure it exactly like NaServer. Only the LOGIN style
+    with filer requests is supported, which is what the handoff
+    scripts use.
+    '''
+
+    def __init__(self, server, major_version, minor_version):
+        NaServer.__init__(self, server, major_version, minor_version)
+        self.host_ = server
+        self.version_ = '%d.%d' % (major_version, minor_version)
+        self.transport_ = 'HTTP'
+        self.port_ = 80
+        self.user_ = ''
+        self.pwd_ = ''
+
+    def set_transport_type(self, transport_type):
+        NaServer.set_transport_type(self, transport_type)
+        self.transport_ = transport_type
+
+    def set_port(self, port):
+        NaServer.set_port(self, port)
+        self.port_ = int(port)
+
+    def set_admin_user(self, user, password):
+        NaServer.set_admin_user(self, user, password)
+        self.user_ = user
+        self.pwd_ = password
+
+    def array_name(self):
+        return self.host_
+
+    def pool(self):
+        return get_pool(self.host_, self.port_, self.transport_,
+                        self.user_, self.pwd_)
+
+    def connection_info(self):
+        '''
+        Returns (host, port, transport, user, password, ZAPI version)
+        '''
+        return (self.host_, self.port_, self.transport_, self.user_,
+                self.pwd_, self.version_)
+
+    def encode_request(self, req):
+        return encode_request(self.version_, req)
+
+    def invoke_elem(self, req):
+        '''
+        Sends the request and returns the results element,
+        the call is timed in a zapi span (see metrics)
+        '''
+        with metrics.span('zapi', api=req.get_name(),
+                          array=self.array_name()) as record:
+            results = self.post_elem(req)
+            if results.results_status() == 'failed':
+                record['status'] = 'failed'
+            return results
+
+    def invoke_stream(self, req, item_tag):
+        '''
+        Sends the request and returns its results as a ZapiStream,
+        for listings too large to build as one NaElement tree
+
+        item_tag : the listed elements, e.g. lun-info
+        '''
+        return ZapiStream(self, req, item_tag)
+
+    def invoke_iter(self, api_name, item_tag, query=None, fields=None,
+                    max_records=None):
+        '''
+        Returns the records of a *-get-iter call as a ZapiIter, e.g.
+        invoke_iter("lun-get-iter", "lun-info", fields=("path",))
+        '''
+        return ZapiIter(self, api_name, item_tag, query, fields, max_records)
+
+    def invoke_elems(self, reqs):
+        '''
+        Sends independent requests at the same time and returns their
+        results elements, in the order of the requests
+
+        reqs : the requests, none of them may depend on the result
+               of another one
+
+        ZAPI has no envelope for several calls, each request goes over
+        its own pooled connection, so at most the pool size of them are
+        in flight at a time.
+        '''
+        if len(reqs) < 2:
+            return [self.invoke_elem(req) for req in reqs]
+
+        # The zapi spans keep the tags of the calling thread
+        tags = metrics.current_tags()
+
+        def invoke(req):
+            with metrics.context(**tags):
+                return self.invoke_elem(req)
+
+        with ThreadPoolExecutor(max_workers=len(reqs)) as executor:
+            return list(executor.map(invoke, reqs))
+
+    def post_elem(self, req):
+        try:
+            data = self.pool().post(self.encode_request(req))
+        except (http.client.HTTPException, socket.error) as e:
+            return fail_response(13001, str(e))
+        return parse_response(data)
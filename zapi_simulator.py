@@ -0,0 +1,633 @@
+###############################################################################
+#
+# (C) Copyright 2014 Riverbed Technology, Inc
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+###############################################################################
+# Local stand-in for the ZAPI of a Netapp storage array.
+# Serves the ZAPI calls made by the Netapp handoff scripts over HTTP(S)
+# from an in memory inventory of volumes, luns, snapshots and initiator
+# groups, with a configurable latency per call. Used by handoff_bench.py
+# to load test the handoff scripts without a filer.
+#
+# Both the clustered ONTAP (*-get-iter) and the 7-mode (*-list-info)
+# calls are served, so one simulator works for both handoff scripts:
+# zapi_simulator.py --port 8080 --volumes 10 --luns-per-volume 50
+# netapp_c_mode_handoff_script.py --array-transport HTTP --array-port 8080 ...
+###############################################################################
+import http.server
+import json
+import optparse
+import random
+import socketserver
+import ssl
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from xml.sax.saxutils import escape
+
+# Defaults, see get_option_parser()
+ADDRESS = '127.0.0.1'
+PORT = 8080
+VOLUMES = 10
+LUNS_PER_VOLUME = 10
+ACCESS_GROUP = 'granite_proxy'
+INITIATORS = ('iqn.1998-01.com.vmware:granite-proxy',)
+
+# ZAPI errnos returned by the simulator. The handoff scripts only look
+# at EVOLUMEDOESNOTEXIST, the others are plain unix errnos.
+ENOENT = '2'
+EEXIST = '17'
+EBUSY = '16'
+EINVAL = '22'
+EAPINOTFOUND = '13005'
+EVOLUMEDOESNOTEXIST = '13040'
+
+ZAPI_VERSION = '1.7'
+ZAPI_NS = 'http://www.netapp.com/filer/admin'
+
+
+def script_log(msg):
+    '''
+    Local logs are sent to std err
+
+    msg : the log message
+    '''
+    sys.stderr.write(msg)
+
+
+class ZapiError(Exception):
+    '''
+    Failed ZAPI call, returned as a failed results element
+    '''
+
+    def __init__(self, errno, reason):
+        Exception.__init__(self, reason)
+        self.errno = errno
+        self.reason = reason
+
+
+def lun_serial(number):
+    '''
+    Returns the serial of the number-th lun created by the simulator,
+    the luns of the initial inventory are numbered from 1
+
+    number : lun number
+    '''
+    return 'SIM%09d' % number
+
+
+def child_text(elem, name, default=None):
+    '''
+    Returns the text of the named child element
+
+    elem : parent element
+    name : child element name
+    default : value returned if there is no such child
+    '''
+    child = elem.find(name)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+def xml_element(name, value=None, children=()):
+    '''
+    Returns the xml text of an element
+
+    name : element name
+    value : element text
+    children : xml text of the child elements
+    '''
+    if value is not None:
+        return '<%s>%s</%s>' % (name, escape(str(value)), name)
+    return '<%s>%s</%s>' % (name, ''.join(children), name)
+
+
+class Lun(object):
+    '''
+    Lun of the simulated array
+    '''
+
+    def __init__(self, path, serial, online=True):
+        self.path = path
+        self.serial = serial
+        self.online = online
+        self.maps = set()
+
+    def volume(self):
+        return self.path.split('/')[2]
+
+    def to_xml(self, fields=None):
+        '''
+        fields : names of the fields to return (desired-attributes),
+                 all of them if None
+        '''
+        values = (('path', self.path),
+                  ('serial-number', self.serial),
+                  ('volume', self.volume()),
+                  ('online', str(self.online).lower()),
+                  ('mapped', str(bool(self.maps)).lower()))
+        return xml_element('lun-info', children=[
+            xml_element(name, value) for name, value in values
+            if fields is None or name in fields])
+
+
+class Volume(object):
+    '''
+    Volume of the simulated array
+    '''
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.online = True
+        self.snapshots = set()
+        # (parent volume, parent snapshot) of a clone volume
+        self.parent = parent
+
+
+class ArrayState(object):
+    '''
+    Inventory of the simulated array.
+
+    All the calls run under one lock, like a filer serializing
+    the configuration changes of a volume.
+    '''
+
+    def __init__(self, volumes, luns_per_volume, access_group=ACCESS_GROUP,
+                 initiators=INITIATORS):
+        self.lock_ = threading.Lock()
+        self.volumes_ = {}
+        self.luns_ = {}
+        self.serial_count_ = 0
+        self.igroups_ = {access_group : list(initiators)}
+        for v in range(volumes):
+            volume = Volume('vol%d' % v)
+            self.volumes_[volume.name] = volume
+            for l in range(luns_per_volume):
+                self.add_lun('/vol/%s/lun%d' % (volume.name, l))
+
+    def add_lun(self, path, online=True):
+        self.serial_count_ += 1
+        lun = Lun(path, lun_serial(self.serial_count_), online)
+        self.luns_[path] = lun
+        return lun
+
+    def sorted_luns(self):
+        return [self.luns_[path] for path in sorted(self.luns_)]
+
+    def get_volume(self, name):
+        volume = self.volumes_.get(name)
+        if volume is None:
+            raise ZapiError(EVOLUMEDOESNOTEXIST,
+                            "Volume %s does not exist" % name)
+        return volume
+
+    def get_lun(self, path):
+        lun = self.luns_.get(path)
+        if lun is None:
+            raise ZapiError(ENOENT, "LUN %s does not exist" % path)
+        return lun
+
+    def counts(self):
+        with self.lock_:
+            return {'volumes' : len(self.volumes_),
+                    'luns' : len(self.luns_),
+                    'snapshots' : sum(len(v.snapshots)
+                                      for v in self.volumes_.values())}
+
+    def call(self, name, api):
+        '''
+        Runs a ZAPI call
+
+        name : ZAPI name
+        api : request element
+
+        Returns the xml text of the results children.
+        Raises ZapiError if the call fails.
+        '''
+        handler = getattr(self, 'api_' + name.replace('-', '_'), None)
+        if handler is None:
+            raise ZapiError(EAPINOTFOUND, "Unable to find API: " + name)
+        with self.lock_:
+            return handler(api)
+
+    def api_lun_get_iter(self, api):
+        luns = self.sorted_luns()
+        query = api.find('query/lun-info')
+        if query is not None:
+            serial = child_text(query, 'serial-number')
+            path = child_text(query, 'path')
+            luns = [lun for lun in luns
+                    if (serial is None or lun.serial == serial) and
+                       (path is None or lun.path == path)]
+
+        try:
+            start = int(child_text(api, 'tag', 0))
+            max_records = int(child_text(api, 'max-records', 20))
+        except ValueError:
+            raise ZapiError(EINVAL, "Invalid tag or max-records")
+
+        desired = api.find('desired-attributes/lun-info')
+        fields = desired is not None and [c.tag for c in desired] or None
+
+        page = luns[start:start + max_records]
+        out = [xml_element('num-records', len(page))]
+        if page:
+            out.append(xml_element('attributes-list',
+                                   children=[lun.to_xml(fields)
+                                             for lun in page]))
+        if start + max_records < len(luns):
+            out.append(xml_element('next-tag', start + max_records))
+        return out
+
+    def api_lun_list_info(self, api):
+        luns = self.sorted_luns()
+        path = child_text(api, 'path')
+        if path is not None:
+            luns = [self.get_lun(path)]
+        return [xml_element('luns', children=[lun.to_xml() for lun in luns])]
+
+    def get_igroups(self, name):
+        if name is None:
+            return sorted(self.igroups_.items())
+        if name not in self.igroups_:
+            raise ZapiError(ENOENT, "Initiator group %s does not exist" % name)
+        return [(name, self.igroups_[name])]
+
+    def igroups_xml(self, igroups):
+        return [xml_element('initiator-group-info', children=(
+                    xml_element('initiator-group-name', name),
+                    xml_element('initiators', children=[
+                        xml_element('initiator-info', children=(
+                            xml_element('initiator-name', initiator),))
+                        for initiator in initiators])))
+                for name, initiators in igroups]
+
+    def api_igroup_get_iter(self, api):
+        query = api.find('query/initiator-group-info')
+        name = None
+        if query is not None:
+            name = child_text(query, 'initiator-group-name')
+        try:
+            igroups = self.get_igroups(name)
+        except ZapiError:
+            igroups = []
+        out = [xml_element('num-records', len(igroups))]
+        if igroups:
+            out.append(xml_element('attributes-list',
+                                   children=self.igroups_xml(igroups)))
+        return out
+
+    def api_igroup_list_info(self, api):
+        igroups = self.get_igroups(child_text(api, 'initiator-group-name'))
+        return [xml_element('initiator-groups',
+                            children=self.igroups_xml(igroups))]
+
+    def api_snapshot_create(self, api):
+        volume = self.get_volume(child_text(api, 'volume'))
+        snap_name = child_text(api, 'snapshot')
+        if not snap_name:
+            raise ZapiError(EINVAL, "Missing snapshot name")
+        if snap_name in volume.snapshots:
+            # Same reason as the filers, the handoff scripts look for it
+            raise ZapiError(EEXIST, "Snapshot copy name already exists")
+        volume.snapshots.add(snap_name)
+        return []
+
+    def api_snapshot_delete(self, api):
+        volume = self.get_volume(child_text(api, 'volume'))
+        snap_name = child_text(api, 'snapshot')
+        if snap_name not in volume.snapshots:
+            raise ZapiError(ENOENT, "Snapshot copy %s does not exist" %
+                            snap_name)
+        for clone in self.volumes_.values():
+            if clone.parent == (volume.name, snap_name):
+                raise ZapiError(EBUSY, "Snapshot copy %s is busy, used by"
+                                " clone %s" % (snap_name, clone.name))
+        volume.snapshots.remove(snap_name)
+        return []
+
+    def api_volume_clone_create(self, api):
+        parent = self.get_volume(child_text(api, 'parent-volume'))
+        snap_name = child_text(api, 'parent-snapshot')
+        name = child_text(api, 'volume')
+        if snap_name not in parent.snapshots:
+            raise ZapiError(ENOENT, "Snapshot copy %s does not exist" %
+                            snap_name)
+        if not name or name in self.volumes_:
+            raise ZapiError(EEXIST, "Volume %s already exists" % name)
+
+        self.volumes_[name] = Volume(name, (parent.name, snap_name))
+        # The luns of the clone come up offline and unmapped
+        prefix = '/vol/%s/' % parent.name
+        for path in [path for path in self.luns_ if path.startswith(prefix)]:
+            self.add_lun('/vol/%s/%s' % (name, path[len(prefix):]), False)
+        return []
+
+    def api_lun_map(self, api):
+        group = child_text(api, 'initiator-group')
+        lun = self.get_lun(child_text(api, 'path'))
+        self.get_igroups(group)
+        if group in lun.maps:
+            raise ZapiError(EEXIST, "LUN already mapped to this group")
+        lun.maps.add(group)
+        return [xml_element('lun-id-assigned', len(lun.maps) - 1)]
+
+    def api_lun_online(self, api):
+        lun = self.get_lun(child_text(api, 'path'))
+        if lun.online:
+            raise ZapiError(EINVAL, "LUN %s is not currently offline" %
+                            lun.path)
+        lun.online = True
+        return []
+
+    def api_volume_offline(self, api):
+        volume = self.get_volume(child_text(api, 'name'))
+        volume.online = False
+        return []
+
+    def api_volume_destroy(self, api):
+        volume = self.get_volume(child_text(api, 'name'))
+        if volume.online:
+            raise ZapiError(EBUSY, "Volume %s is online" % volume.name)
+        for clone in self.volumes_.values():
+            if clone.parent and clone.parent[0] == volume.name:
+                raise ZapiError(EBUSY, "Volume %s has clones" % volume.name)
+        prefix = '/vol/%s/' % volume.name
+        for path in [path for path in self.luns_ if path.startswith(prefix)]:
+            del self.luns_[path]
+        del self.volumes_[volume.name]
+        return []
+
+
+class CallStats(object):
+    '''
+    Number of calls and seconds spent per ZAPI
+    '''
+
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.calls_ = {}
+
+    def add(self, name, duration, failed):
+        with self.lock_:
+            stats = self.calls_.setdefault(name, {'calls' : 0, 'failed' : 0,
+                                                  'seconds' : 0.0})
+            stats['calls'] += 1
+            stats['failed'] += failed and 1 or 0
+            stats['seconds'] += duration
+
+    def get(self, reset=False):
+        with self.lock_:
+            calls = self.calls_
+            if reset:
+                self.calls_ = {}
+            return dict((name, dict(stats)) for name, stats in calls.items())
+
+
+class ZapiRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves one ZAPI call per POST, keeps the connections alive
+    like the filers so that the handoff connection pools are used.
+
+    GET /stats returns the per call statistics as JSON,
+    GET /stats?reset also clears them.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        start = time.time()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        name = 'unknown'
+        try:
+            root = ET.fromstring(body)
+            api = list(root)[0]
+            # Requests carry the admin namespace on the netapp element
+            name = api.tag.rsplit('}', 1)[-1]
+            for elem in api.iter():
+                elem.tag = elem.tag.rsplit('}', 1)[-1]
+            self.server.pause(name)
+            results = ('<results status="passed">%s</results>' %
+                       ''.join(self.server.state.call(name, api)))
+            failed = False
+        except (ET.ParseError, IndexError):
+            self.server.pause(name)
+            results = ('<results status="failed" errno="%s" reason="%s"/>' %
+                       (EINVAL, 'Invalid ZAPI request'))
+            failed = True
+        except ZapiError as e:
+            results = ('<results status="failed" errno="%s" reason="%s"/>' %
+                       (e.errno, escape(e.reason, {'"' : '&quot;'})))
+            failed = True
+
+        out = ("<?xml version='1.0' encoding='UTF-8' ?>"
+               "<netapp version='%s' xmlns='%s'>%s</netapp>" %
+               (ZAPI_VERSION, ZAPI_NS, results)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset="UTF-8"')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+        self.server.stats.add(name, time.time() - start, failed)
+
+    def do_GET(self):
+        if not self.path.startswith('/stats'):
+            self.send_error(404)
+            return
+        stats = {'calls' : self.server.stats.get('reset' in self.path),
+                 'inventory' : self.server.state.counts()}
+        out = json.dumps(stats, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ZapiSimulator(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''
+    HTTP(S) server of the simulated array
+
+    address : (host, port) to listen on, port 0 picks a free port
+    state : ArrayState served
+    latency : seconds added to every call
+    jitter : up to this many random seconds added to every call
+    api_latency : dict of ZAPI name to seconds, replaces latency for that call
+    certfile : PEM certificate (and key) file, serves HTTPS when set
+    keyfile : PEM key file if not in certfile
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state, latency=0.0, jitter=0.0,
+                 api_latency=None, certfile=None, keyfile=None):
+        http.server.HTTPServer.__init__(self, address, ZapiRequestHandler)
+        self.state = state
+        self.stats = CallStats()
+        self.latency_ = latency
+        self.jitter_ = jitter
+        self.api_latency_ = api_latency or {}
+        self.transport = 'HTTP'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+            self.transport = 'HTTPS'
+
+    def port(self):
+        return self.server_address[1]
+
+    def pause(self, name):
+        '''
+        Waits for the latency of the call
+
+        name : ZAPI name
+        '''
+        delay = self.api_latency_.get(name, self.latency_)
+        if self.jitter_:
+            delay += random.uniform(0, self.jitter_)
+        if delay > 0:
+            time.sleep(delay)
+
+    def start(self):
+        '''
+        Serves the calls on a background thread
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def parse_api_latency(values):
+    '''
+    Returns the dict of ZAPI name to latency
+
+    values : list of NAME=SECONDS strings
+    '''
+    api_latency = {}
+    for value in values or []:
+        name, sep, seconds = value.partition('=')
+        if not sep:
+            raise ValueError("Expected NAME=SECONDS, got " + value)
+        api_latency[name.strip()] = float(seconds)
+    return api_latency
+
+
+def add_simulator_options(parser):
+    '''
+    Adds the options of the simulated array to the parser,
+    shared with handoff_bench.py
+
+    parser : optparse parser
+    '''
+    parser.add_option("--volumes",
+                      type="int",
+                      default=VOLUMES,
+                      help="Number of volumes of the simulated array")
+    parser.add_option("--luns-per-volume",
+                      type="int",
+                      default=LUNS_PER_VOLUME,
+                      help="Number of luns in each volume")
+    parser.add_option("--access-group",
+                      type="string",
+                      default=ACCESS_GROUP,
+                      help="Initiator group of the proxy hosts")
+    parser.add_option("--latency",
+                      type="float",
+                      default=0.0,
+                      help="Seconds added to every ZAPI call")
+    parser.add_option("--jitter",
+                      type="float",
+                      default=0.0,
+                      help="Up to this many random seconds added to every call")
+    parser.add_option("--api-latency",
+                      action="append",
+                      default=[],
+                      metavar="NAME=SECONDS",
+                      help="Latency of one ZAPI call, replaces --latency for"
+                           " it, can be repeated")
+    parser.add_option("--cert",
+                      type="string",
+                      default="",
+                      help="PEM certificate file, serves HTTPS when set")
+    parser.add_option("--key",
+                      type="string",
+                      default="",
+                      help="PEM key file if the key is not in the certificate")
+
+
+def create_simulator(options, address=ADDRESS, port=0):
+    '''
+    Returns a ZapiSimulator set up from the parsed options
+
+    options : options added by add_simulator_options
+    address : address to listen on
+    port : port to listen on, 0 picks a free port
+    '''
+    state = ArrayState(options.volumes, options.luns_per_volume,
+                       options.access_group)
+    return ZapiSimulator((address, port), state, options.latency,
+                         options.jitter, parse_api_latency(options.api_latency),
+                         options.cert or None, options.key or None)
+
+
+def get_option_parser():
+    '''
+    Returns argument parser
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option("--address",
+                      type="string",
+                      default=ADDRESS,
+                      help="Local address to listen on")
+    parser.add_option("--port",
+                      type="int",
+                      default=PORT,
+                      help="Local port to listen on")
+    add_simulator_options(parser)
+    return parser
+
+
+if __name__ == '__main__':
+    options, argsleft = get_option_parser().parse_args()
+    try:
+        server = create_simulator(options, options.address, options.port)
+    except (ValueError, OSError) as e:
+        script_log("Error: %s\n" % str(e))
+        sys.exit(1)
+
+    script_log("Serving %d luns in %d volumes over %s on %s:%d\n" %
+               (options.volumes * options.luns_per_volume, options.volumes,
+                server.transport, options.address, server.port()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()